@@ -4,6 +4,7 @@ from lizard_workspace.models import Category, LayerFolder, Tag
 from lizard_workspace.models import Layer
 from lizard_workspace.models import LayerCollage
 from lizard_workspace.models import LayerCollageItem
+from lizard_workspace.models import LayerCollageItemStats
 from lizard_workspace.models import LayerWorkspace
 from lizard_workspace.models import LayerWorkspaceItem
 from lizard_workspace.models import AppScreenAppItems
@@ -42,6 +43,12 @@ class LayerCollageAdmin(admin.ModelAdmin):
     list_filter = ('owner', 'is_temp')
 
 
+class LayerCollageItemStatsAdmin(admin.ModelAdmin):
+    list_display = ('collage_item', 'period_start', 'period_end',
+                    'timestamp_computed', 'timestamp_read')
+    raw_id_fields = ('collage_item', )
+
+
 class LayerAdmin(admin.ModelAdmin):
     search_fields = ['name']
     list_filter = ('valid', 'data_set', 'source_ident', 'is_local_server', )
@@ -85,6 +92,7 @@ admin.site.register(Category, CategoryAdmin)
 admin.site.register(Layer, LayerAdmin)
 admin.site.register(LayerWorkspace, LayerWorkspaceAdmin)
 admin.site.register(LayerCollage, LayerCollageAdmin)
+admin.site.register(LayerCollageItemStats, LayerCollageItemStatsAdmin)
 #admin.site.register(Theme, ThemeAdmin)
 
 admin.site.register(App, AppAdmin)
@@ -14,7 +14,10 @@ from lizard_workspace.api.views import LayerWorkspaceView
 from lizard_workspace.api.views import LayerCollageView
 from lizard_workspace.api.views import AvailableLayersView
 from lizard_workspace.api.views import AppLayerTreeView
+from lizard_workspace.api.views import LayerFolderView
+from lizard_workspace.api.views import LayerSearchView
 from lizard_workspace.api.views import AppScreenView
+from lizard_workspace.api.views import CollageStatsView
 
 admin.autodiscover()
 
@@ -56,9 +59,18 @@ urlpatterns = patterns(
     url(r'^app_layer_tree/$',
         AppLayerTreeView.as_view(),
         name=NAME_PREFIX + 'app_layer_tree'),
+    url(r'^layer_folder/$',
+        LayerFolderView.as_view(),
+        name=NAME_PREFIX + 'layer_folder'),
+    url(r'^layer_search/$',
+        LayerSearchView.as_view(),
+        name=NAME_PREFIX + 'layer_search'),
     url(r'^appscreen/$',
         AppScreenView.as_view(),
         name=NAME_PREFIX + 'appscreen'),
+    url(r'^collage_stats/$',
+        CollageStatsView.as_view(),
+        name=NAME_PREFIX + 'collage_stats'),
 
 
     )
@@ -1,4 +1,11 @@
+import datetime
+import iso8601
 import json
+from django.http import Http404
+from django.http import HttpResponse
+from django.http import HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date
 from django.shortcuts import get_object_or_404
 
 from djangorestframework.views import View
@@ -7,17 +14,76 @@ from django.core.urlresolvers import reverse
 from djangorestframework.views import ListOrCreateModelView
 from lizard_api.base import BaseApiView
 from lizard_history.utils import get_simple_history
+from lizard_map.daterange import current_start_end_dates
 
+from lizard_workspace import collagestats
+from lizard_workspace import layersearch
+from lizard_workspace import layertree
+from lizard_workspace.cachekeys import digest
 from lizard_workspace.models import AppScreen
 from lizard_workspace.models import Layer
 from lizard_workspace.models import LayerFolder
 from lizard_workspace.models import LayerCollage
 from lizard_workspace.models import LayerWorkspace
+from lizard_workspace.tasks import collage_stats_job
 
 from lizard_registration.models import Organisation
 from lizard_registration.models import UserProfile
 
 
+# Default and maximum number of layers per LayerFolderView page.
+LAYER_PAGE_SIZE = 100
+MAX_LAYER_PAGE_SIZE = 1000
+# Default and maximum number of LayerSearchView results.
+SEARCH_SIZE = 20
+MAX_SEARCH_SIZE = 100
+
+
+def _permission_parts(request):
+    """Return what the layers a user sees depend on: they are
+    filtered on the data sets of the user, see lizard_security."""
+    data_set_ids = sorted(
+        getattr(request, 'allowed_data_set_ids', None) or [])
+    is_superuser = getattr(request.user, 'is_superuser', False)
+    return (data_set_ids, is_superuser)
+
+
+class CatalogVersionMixin(object):
+    """
+    Conditional GET for views that only depend on the layer catalog
+    (see layertree.catalog_version), the request and the user.
+
+    The ETag is a digest of the catalog version, the url and the
+    permissions of the user. A matching If-None-Match gets a 304
+    before the view runs any query.
+    """
+    def catalog_etag(self, request):
+        return '"%s"' % digest(
+            layertree.catalog_version(), request.get_full_path(),
+            getattr(request.user, 'id', None), _permission_parts(request))
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method != 'GET':
+            return super(CatalogVersionMixin, self).dispatch(
+                request, *args, **kwargs)
+        etag = self.catalog_etag(request)
+        if_none_match = [
+            tag.strip() for tag in
+            request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]
+        if etag in if_none_match or '*' in if_none_match:
+            response = HttpResponseNotModified()
+        else:
+            response = super(CatalogVersionMixin, self).dispatch(
+                request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+            response['Last-Modified'] = http_date(
+                layertree.catalog_modified())
+        response['ETag'] = etag
+        patch_vary_headers(response, ('Cookie', ))
+        return response
+
+
 class RootView(View):
     """
     Class based REST root view for lizard_workspace.
@@ -30,6 +96,9 @@ class RootView(View):
             'collage': {
                 'name': 'identifier',
                 'url': reverse("lizard_workspace_api_collage_view")},
+            'collage_stats': {
+                'name': 'secret_slug',
+                'url': reverse("lizard_workspace_api_collage_stats")},
             }
 
 
@@ -253,7 +322,7 @@ class LayerCollageView(LayerWorkspaceView):
             request).exclude(is_temp=True)
 
 
-class AvailableLayersView(BaseApiView):
+class AvailableLayersView(CatalogVersionMixin, BaseApiView):
     """
     Show available layers
     """
@@ -305,7 +374,7 @@ class AvailableLayersView(BaseApiView):
 
 
 
-class AppLayerTreeView(View):
+class AppLayerTreeView(CatalogVersionMixin, View):
     """
     Return tree of LayerFolder
     """
@@ -320,14 +389,73 @@ class AppLayerTreeView(View):
             parent_id = request.GET['object_id']
             if not parent_id:
                 parent_id = None
-            result = LayerFolder.tree_dict(parent_id)
+            result = LayerFolder.tree_json(
+                parent_id, cache_parts=_permission_parts(request))
         except:
-            result = []
+            result = '[]'
+
+        return HttpResponse(result, mimetype='application/json')
+
 
+class LayerFolderView(CatalogVersionMixin, View):
+    """
+    Lazy layer tree: one LayerFolder at a time.
+
+    - object_id: id of the LayerFolder, empty for the root folders
+    - start, limit: page of the layers of the folder (default the
+      first LAYER_PAGE_SIZE)
+    - query: only layers with this text in their name
+
+    Returns the child folders with their number of layers, and the
+    page of layers, see LayerFolder.folder_page.
+    """
+    def get(self, request):
+        object_id = request.GET.get('object_id', None)
+        start = _int(request.GET.get('start'), 0)
+        limit = min(_int(request.GET.get('limit'), LAYER_PAGE_SIZE),
+                    MAX_LAYER_PAGE_SIZE)
+        if object_id:
+            try:
+                object_id = int(object_id)
+            except ValueError:
+                raise Http404
+            layer_folder = get_object_or_404(LayerFolder, id=object_id)
+            result = layer_folder.folder_page(
+                start=start, limit=limit,
+                query=request.GET.get('query', None))
+        else:
+            result = LayerFolder.root_page()
+        result['start'] = start
+        result['limit'] = limit
+        result['success'] = True
         return result
 
 
-class AppScreenView(View):
+class LayerSearchView(CatalogVersionMixin, View):
+    """
+    Search layers on name, slug, tags and source_ident, for typeahead.
+
+    - query: the words to search for, prefixes of layer words or
+      words with a typo (see lizard_workspace.layersearch)
+    - limit: maximum number of layers (default SEARCH_SIZE)
+
+    Returns the layers that the user may see, best match first.
+    """
+    def get(self, request):
+        query = request.GET.get('query', '')
+        limit = min(_int(request.GET.get('limit'), SEARCH_SIZE),
+                    MAX_SEARCH_SIZE)
+        data = []
+        for layer, score in layersearch.search_layers(
+            query, limit=limit,
+            layers=Layer.objects.select_related('server')):
+            item = layer.get_object_dict()
+            item['score'] = score
+            data.append(item)
+        return {'data': data, 'count': len(data), 'success': True}
+
+
+class AppScreenView(CatalogVersionMixin, View):
 
     def get(self, request):
 
@@ -368,3 +496,88 @@ class AppScreenView(View):
         return {
             'data': output
         }
+
+
+def _api_event(event):
+    """Return info_stats min/max event as dict."""
+    if event is None:
+        return None
+    dt, (value, flag, comment) = event
+    return {
+        'datetime': dt,
+        'value': value,
+        'flag': flag,
+        'comment': comment}
+
+
+def _api_item_stats(item_stats):
+    """Return info_stats of a collage item for the api."""
+    result = dict(item_stats)
+    result['standard'] = dict(item_stats['standard'])
+    result['standard']['min'] = _api_event(item_stats['standard']['min'])
+    result['standard']['max'] = _api_event(item_stats['standard']['max'])
+    return result
+
+
+def _int(value, default):
+    """Return value as a non-negative int, or default."""
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return default
+
+
+def _date(value):
+    """Parse iso8601 date, without time and tz info like CollageView."""
+    dt = iso8601.parse_date(value)
+    return datetime.datetime(dt.year, dt.month, dt.day)
+
+
+class CollageStatsView(View):
+    """
+    Statistics of the items of a collage, computed in a celery job so
+    the request does not wait for FEWS-norm.
+
+    - secret_slug, dt_start and dt_end (iso8601, default: period of
+      the session): find or start the job for the collage and period.
+    - job_id: poll a job, offset (default 0): only return the items
+      from offset on. A job whose worker died is started again.
+
+    Returns the job state with the stats of the items that are done
+    so far. When status is 'done' all items are there; finished jobs
+    are served from the cache until they expire.
+    """
+    def get(self, request):
+        job_id = request.GET.get('job_id', None)
+        offset = _int(request.GET.get('offset'), 0)
+        if job_id:
+            state = collagestats.job_state(job_id, offset=offset)
+            if state is None:
+                raise Http404
+            if collagestats.restart_stale_job(state):
+                collage_stats_job.delay(state['job_id'])
+        else:
+            offset = 0
+            collage = get_object_or_404(
+                LayerCollage, secret_slug=request.GET.get('secret_slug'))
+            if 'dt_start' in request.GET and 'dt_end' in request.GET:
+                start = _date(request.GET['dt_start'])
+                end = _date(request.GET['dt_end'])
+            else:
+                start, end = current_start_end_dates(request)
+            state, created = collagestats.new_job(collage, start, end)
+            if created:
+                collage_stats_job.delay(state['job_id'])
+
+        return {
+            'job_id': state['job_id'],
+            'status': state['status'],
+            'secret_slug': state['secret_slug'],
+            'dt_start': state['start'],
+            'dt_end': state['end'],
+            'total': state['total'],
+            'done': state['done'],
+            'offset': offset,
+            'items': [_api_item_stats(item_stats)
+                      for item_stats in state['items']],
+            }
@@ -0,0 +1,247 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Deterministic, versioned cache keys.
+
+Keys used to be str(hash(...)) of a formatted string. With hash
+randomization that differs per process, so gunicorn workers never
+shared cache entries, and a 64 bit hash can collide.
+
+Keys are now a sha1 digest of a canonical json form of the key parts
+(identifier dicts with sorted keys, datetimes in iso format), prefixed
+with the key family and a version:
+
+    lizard_workspace:<family>:<CACHE_VERSION>.<namespace>:<digest>
+
+CACHE_VERSION (setting LIZARD_WORKSPACE_CACHE_VERSION) is for code
+changes; the namespace version is stored in the cache and can be
+bumped at runtime with bump_namespace_version() to invalidate all
+keys at once.
+
+Families created with compress=True pickle their values themselves
+and zlib compress the ones of at least
+LIZARD_WORKSPACE_CACHE_COMPRESS_THRESHOLD bytes, with
+LIZARD_WORKSPACE_CACHE_COMPRESS_LEVEL. Raw and stored sizes and the
+encode and decode times are recorded per family, see metrics().
+"""
+import cPickle as pickle
+import datetime
+import hashlib
+import json
+import logging
+import threading
+import time
+import zlib
+
+from django.conf import settings
+from django.core.cache import cache
+
+KEY_PREFIX = 'lizard_workspace'
+CACHE_VERSION = getattr(settings, 'LIZARD_WORKSPACE_CACHE_VERSION', 1)
+
+# Pickled values of at least this many bytes are compressed, None
+# disables compression.
+COMPRESS_THRESHOLD = getattr(
+    settings, 'LIZARD_WORKSPACE_CACHE_COMPRESS_THRESHOLD', 16 * 1024)
+COMPRESS_LEVEL = getattr(settings, 'LIZARD_WORKSPACE_CACHE_COMPRESS_LEVEL', 6)
+
+# Markers of encoded values, other values are returned as they are.
+PICKLED = 'lizard_workspace:pickle'
+COMPRESSED = 'lizard_workspace:zlib'
+
+NAMESPACE_KEY = '%s:namespace' % KEY_PREFIX
+# The namespace must outlive the keys in it. When it expires anyway,
+# a new (time based) namespace is started, old keys are never reused.
+NAMESPACE_TIMEOUT = 30 * 24 * 3600
+# Seconds a process may use its copy of the namespace version.
+NAMESPACE_LOCAL_TTL = 5
+
+_namespace = {'version': None, 'expires': 0}
+_counters = {}
+_metrics = {}
+_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+
+def _canonical_default(obj):
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj)
+    return unicode(obj)
+
+
+def canonical(obj):
+    """Return canonical json string for obj."""
+    return json.dumps(obj, sort_keys=True, separators=(',', ':'),
+                      default=_canonical_default)
+
+
+def digest(*parts):
+    return hashlib.sha1(canonical(parts)).hexdigest()
+
+
+def _new_namespace_version():
+    return int(time.time() * 1000)
+
+
+def namespace_version():
+    """Return current namespace version."""
+    now = time.time()
+    if _namespace['version'] is not None and now < _namespace['expires']:
+        return _namespace['version']
+    version = cache.get(NAMESPACE_KEY)
+    if version is None:
+        cache.add(NAMESPACE_KEY, _new_namespace_version(),
+                  NAMESPACE_TIMEOUT)
+        version = cache.get(NAMESPACE_KEY) or _new_namespace_version()
+    _namespace['version'] = version
+    _namespace['expires'] = now + NAMESPACE_LOCAL_TTL
+    return version
+
+
+def bump_namespace_version():
+    """Invalidate all keys of all families.
+
+    Other processes notice within NAMESPACE_LOCAL_TTL seconds."""
+    version = max(_new_namespace_version(),
+                  (cache.get(NAMESPACE_KEY) or 0) + 1)
+    cache.set(NAMESPACE_KEY, version, NAMESPACE_TIMEOUT)
+    _namespace['version'] = version
+    _namespace['expires'] = time.time() + NAMESPACE_LOCAL_TTL
+    return version
+
+
+def counters():
+    """Return hits and misses per family for this process:
+
+    {'ts': {'hits': 10, 'misses': 2}, ...}"""
+    with _lock:
+        return dict((family, dict(counts))
+                    for family, counts in _counters.items())
+
+
+def _new_metrics():
+    return {'encoded': 0, 'compressed': 0, 'raw_bytes': 0,
+            'stored_bytes': 0, 'encode_seconds': 0.0,
+            'decoded': 0, 'decode_seconds': 0.0}
+
+
+def metrics():
+    """Return payload metrics per compressed family for this process:
+
+    {'ts': {'encoded': 10, 'compressed': 4, 'raw_bytes': 123456,
+            'stored_bytes': 23456, 'encode_seconds': 0.1,
+            'decoded': 12, 'decode_seconds': 0.05}, ...}"""
+    with _lock:
+        return dict((family, dict(values))
+                    for family, values in _metrics.items())
+
+
+class CacheFamily(object):
+    """Keys and cache access for one kind of cached object."""
+    def __init__(self, name, timeout=None, compress=False):
+        self.name = name
+        self.timeout = timeout
+        self.compress = compress
+        with _lock:
+            _counters.setdefault(self.name, {'hits': 0, 'misses': 0})
+            if compress:
+                _metrics.setdefault(self.name, _new_metrics())
+
+    def key(self, *parts):
+        return '%s:%s:%s.%s:%s' % (
+            KEY_PREFIX, self.name, CACHE_VERSION, namespace_version(),
+            digest(*parts))
+
+    def _count(self, hits, misses):
+        with _lock:
+            _counters[self.name]['hits'] += hits
+            _counters[self.name]['misses'] += misses
+
+    def _measure(self, **values):
+        with _lock:
+            family_metrics = _metrics[self.name]
+            for name, value in values.items():
+                family_metrics[name] += value
+
+    def encode(self, value):
+        """Return value as it is stored in the cache."""
+        if not self.compress or value is None:
+            return value
+        started = time.time()
+        raw = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        compressed = (COMPRESS_THRESHOLD is not None and
+                      len(raw) >= COMPRESS_THRESHOLD)
+        if compressed:
+            payload = (COMPRESSED, zlib.compress(raw, COMPRESS_LEVEL))
+        else:
+            payload = (PICKLED, raw)
+        self._measure(encoded=1, compressed=int(compressed),
+                      raw_bytes=len(raw), stored_bytes=len(payload[1]),
+                      encode_seconds=time.time() - started)
+        return payload
+
+    def decode(self, payload):
+        """Inverse of encode. Values that are not encoded (stored by
+        an older version) are returned as they are, broken ones as
+        None."""
+        if not (self.compress and isinstance(payload, tuple) and
+                len(payload) == 2 and payload[0] in (PICKLED, COMPRESSED)):
+            return payload
+        started = time.time()
+        marker, data = payload
+        try:
+            if marker == COMPRESSED:
+                data = zlib.decompress(data)
+            value = pickle.loads(data)
+        except Exception:
+            logger.exception('Could not decode %s cache value' % self.name)
+            return None
+        self._measure(decoded=1, decode_seconds=time.time() - started)
+        return value
+
+    def get(self, key):
+        value = self.decode(cache.get(key))
+        self._count(int(value is not None), int(value is None))
+        return value
+
+    def get_many(self, keys):
+        values = {}
+        for key, value in cache.get_many(keys).items():
+            value = self.decode(value)
+            if value is not None:
+                values[key] = value
+        self._count(len(values), len(keys) - len(values))
+        return values
+
+    def cached_keys(self, keys):
+        """Return the set of keys that are in the cache, without
+        decoding their values."""
+        return set(key for key, value in cache.get_many(keys).items()
+                   if value is not None)
+
+    def set_many(self, data):
+        data = dict((key, self.encode(value)) for key, value in data.items())
+        if self.timeout is None:
+            cache.set_many(data)
+        else:
+            cache.set_many(data, self.timeout)
+
+    def add(self, key, value):
+        """Set value only if key is not in the cache yet, return
+        True if it was set."""
+        if self.timeout is None:
+            return cache.add(key, self.encode(value))
+        return cache.add(key, self.encode(value), self.timeout)
+
+    def set(self, key, value):
+        if self.timeout is None:
+            cache.set(key, self.encode(value))
+        else:
+            cache.set(key, self.encode(value), self.timeout)
+
+
+TIME_SERIES = CacheFamily('ts', compress=True)
+PARTIAL_AGGREGATES = CacheFamily('partials', compress=True)
+PERIOD_SKETCHES = CacheFamily('period_sketches', compress=True)
@@ -0,0 +1,678 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Statistics for all items of a collage.
+
+Fresh stored statistics (LayerCollageItemStats) are used when
+available. Every LayerCollageItem.info_stats call can block for
+seconds on a FEWS-norm query, so the other items are computed in a
+bounded thread pool. The number of concurrent queries per
+FewsNormSource is capped as well, so one collage cannot flood a
+single FEWS database.
+
+For the API, the statistics of a collage can be computed in a celery
+job (see tasks.collage_stats_job). The job state and the result of
+every item that is done live in the cache under a job id that is
+determined by the collage, its settings and the period. A running
+job that made no progress for JOB_STALE seconds (its worker died) is
+started again by the next request for it.
+
+warm_collage_stats fills the caches of shared (non-temp) collages in
+advance, for the items that were viewed recently (see mark_accessed).
+The partial aggregates of the whole months are read by any period
+that covers them. The stored statistics are only read for exactly the
+same period, so they are warmed for the day aligned periods that
+links with dt_start and dt_end give.
+"""
+import datetime
+import logging
+import os
+import threading
+import time
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connections
+
+from lizard_workspace import cachekeys
+from lizard_workspace import fetch
+from lizard_workspace import partials
+from lizard_workspace.cachekeys import CacheFamily
+from lizard_workspace.cachekeys import digest
+from lizard_workspace.models import LayerCollage
+from lizard_workspace.models import LayerCollageItemStats
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of collage items that are computed at the same time.
+MAX_THREADS = getattr(
+    settings, 'LIZARD_WORKSPACE_COLLAGE_STATS_THREADS', 8)
+# Maximum number of concurrent computations per FewsNormSource.
+MAX_PER_SOURCE = getattr(
+    settings, 'LIZARD_WORKSPACE_COLLAGE_STATS_PER_SOURCE', 4)
+
+# Seconds that a collage stats job and its results are kept.
+JOB_TIMEOUT = getattr(
+    settings, 'LIZARD_WORKSPACE_COLLAGE_STATS_JOB_TIMEOUT', 3600)
+
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+# Seconds without a finished item after which a running job is
+# considered dead.
+JOB_STALE = getattr(settings, 'LIZARD_WORKSPACE_COLLAGE_STATS_JOB_STALE', 600)
+
+JOBS = CacheFamily('collage_stats_job', timeout=JOB_TIMEOUT)
+
+# Periods that are warmed: this many days up to today, as whole months
+# before the current month.
+WARM_PERIODS = getattr(settings, 'LIZARD_WORKSPACE_WARM_PERIODS', [365])
+# Number of items that are warmed at the same time.
+WARM_THREADS = getattr(settings, 'LIZARD_WORKSPACE_WARM_THREADS', 2)
+# Only items that were viewed in the last ACCESS_MAX_AGE seconds are
+# warmed.
+ACCESS_MAX_AGE = getattr(
+    settings, 'LIZARD_WORKSPACE_WARM_ACCESS_MAX_AGE', 7 * 24 * 3600)
+
+ACCESS = CacheFamily('collage_item_access', timeout=ACCESS_MAX_AGE)
+
+# Per item and per request budgets (in seconds) for CollageView, see
+# iter_compute_stats. None is no limit.
+ITEM_BUDGET = getattr(settings, 'LIZARD_WORKSPACE_COLLAGE_ITEM_BUDGET', 20)
+REQUEST_BUDGET = getattr(
+    settings, 'LIZARD_WORKSPACE_COLLAGE_REQUEST_BUDGET', 45)
+
+# AsyncResults of the items that are being computed in this process.
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+_source_semaphores = {}
+_source_semaphores_lock = threading.Lock()
+
+# Thread pools of this process, per size, see thread_pool.
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def thread_pool(threads):
+    """Return the (process wide) ThreadPool with `threads` threads.
+
+    All requests of a process share the pool, so the number of
+    threads stays bounded also when requests stop waiting for their
+    items (see iter_compute_stats). A pool that was created before a
+    fork is not used in the child.
+    """
+    with _pools_lock:
+        pid, pool = _pools.get(threads, (None, None))
+        if pid != os.getpid():
+            pool = ThreadPool(threads)
+            _pools[threads] = (os.getpid(), pool)
+        return pool
+
+
+def source_semaphore(source_slug):
+    """Return the (process wide) semaphore for a FewsNormSource."""
+    with _source_semaphores_lock:
+        if source_slug not in _source_semaphores:
+            _source_semaphores[source_slug] = threading.BoundedSemaphore(
+                MAX_PER_SOURCE)
+        return _source_semaphores[source_slug]
+
+
+def item_identifier(collage_item):
+    """Return parsed identifier of collage item, or None."""
+    try:
+        identifier = collage_item.parsed_identifier()
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(identifier, dict):
+        return None
+    return identifier
+
+
+def item_source_slug(collage_item):
+    """Return fews_norm_source_slug of collage item, or None."""
+    return collage_item.fews_norm_source_slug
+
+
+def stored_stats(collage_items, start, end, mark_read=True):
+    """Return {collage item id: info_stats} for the items that have
+    fresh LayerCollageItemStats for their current settings, using one
+    query (and, with mark_read, one to mark rows as read now and
+    then)."""
+    by_id = dict((collage_item.id, collage_item)
+                 for collage_item in collage_items)
+    now = datetime.datetime.now()
+    result = {}
+    read_ids = []
+    rows = LayerCollageItemStats.objects.filter(
+        collage_item__in=by_id.keys(),
+        period_start=start, period_end=end)
+    for row in rows:
+        collage_item = by_id[row.collage_item_id]
+        if row.is_fresh(now) and row.matches(collage_item):
+            result[collage_item.id] = row.info_stats()
+            if mark_read and row.needs_read_update(now):
+                read_ids.append(row.id)
+    if read_ids:
+        # Keeps the rows from being removed, see
+        # tasks.refresh_collage_stats.
+        LayerCollageItemStats.objects.filter(id__in=read_ids).update(
+            timestamp_read=now)
+    return result
+
+
+def safe_info_stats(collage_item, start, end):
+    """Return info_stats of collage item with its id, and store them
+    as LayerCollageItemStats.
+
+    A failing item gets the empty stats with 'error' set, so it does
+    not break the whole collage.
+    """
+    try:
+        result = collage_item.info_stats(start=start, end=end)
+        collage_item.store_info_stats(start, end, result)
+    except Exception:
+        logger.exception(
+            'Error calculating stats for collage item %s' % collage_item.id)
+        result = collage_item.empty_stats()
+        result['error'] = True
+    result['id'] = collage_item.id
+    return result
+
+
+def pending_stats(collage_item):
+    """Return placeholder stats for an item that is still being
+    computed."""
+    result = collage_item.empty_stats()
+    result['pending'] = True
+    result['id'] = collage_item.id
+    return result
+
+
+def _prefetch(collage_items, start, end):
+    identifiers = [item_identifier(collage_item)
+                   for collage_item in collage_items]
+    # Items with months in the partial aggregates cache only fetch
+    # the missing months, see partials.period_buckets.
+    fetch.prefetch_time_series(
+        [identifier for identifier in identifiers
+         if identifier and partials.nothing_cached(identifier, start, end)],
+        start, end)
+
+
+def _close_connections():
+    # Database connections are per thread, do not leave them open.
+    for connection in connections.all():
+        connection.close()
+
+
+def _threaded_prefetch(collage_items, start, end, prefetched):
+    try:
+        _prefetch(collage_items, start, end)
+    except Exception:
+        logger.exception('Prefetching time series failed')
+    finally:
+        prefetched.set()
+        _close_connections()
+
+
+def _threaded_info_stats(collage_item, start, end, key, prefetched):
+    prefetched.wait()
+    semaphore = source_semaphore(item_source_slug(collage_item))
+    semaphore.acquire()
+    try:
+        return safe_info_stats(collage_item, start, end)
+    finally:
+        semaphore.release()
+        with _in_flight_lock:
+            _in_flight.pop(key, None)
+        _close_connections()
+
+
+def _in_flight_key(collage_item, start, end):
+    return (collage_item.id, start, end,
+            tuple(sorted(collage_item.stats_settings().items())))
+
+
+def _submit(collage_items, start, end, threads):
+    """Start computing the items in a thread pool, return an
+    AsyncResult per item.
+
+    Items that are already being computed in this process (for an
+    earlier request) are not started again, their AsyncResult is
+    reused.
+    """
+    with _in_flight_lock:
+        keys = [_in_flight_key(collage_item, start, end)
+                for collage_item in collage_items]
+        new_items = [
+            (collage_item, key)
+            for collage_item, key in zip(collage_items, keys)
+            if key not in _in_flight or _in_flight[key].ready()]
+        if new_items:
+            pool = thread_pool(threads)
+            prefetched = threading.Event()
+            # The workers take tasks in order, so the prefetch starts
+            # before the items that wait for it.
+            pool.apply_async(
+                _threaded_prefetch,
+                ([collage_item for collage_item, key in new_items],
+                 start, end, prefetched))
+            # The pool finishes the items in the background, also
+            # when we stop waiting for them.
+            for collage_item, key in new_items:
+                _in_flight[key] = pool.apply_async(
+                    _threaded_info_stats,
+                    (collage_item, start, end, key, prefetched))
+        return [_in_flight[key] for key in keys]
+
+
+def _timeout(item_budget, deadline):
+    timeouts = []
+    if item_budget is not None:
+        timeouts.append(item_budget)
+    if deadline is not None:
+        timeouts.append(max(0, deadline - time.time()))
+    if not timeouts:
+        return None
+    return min(timeouts)
+
+
+def collage_stats(collage_items, start, end, threads=None,
+                  item_budget=None, request_budget=None):
+    """Return info_stats for collage items, in the original order.
+
+    Fresh stored statistics are used where possible. For the other
+    items the time series are prefetched with as few queries as
+    possible, see fetch.prefetch_time_series, and the items are
+    computed concurrently in at most `threads` threads (default
+    LIZARD_WORKSPACE_COLLAGE_STATS_THREADS).
+
+    With budgets (in seconds), items that are not ready in time are
+    returned as pending_stats, see iter_compute_stats.
+    """
+    return list(iter_collage_stats(
+            collage_items, start, end, threads=threads,
+            item_budget=item_budget, request_budget=request_budget))
+
+
+def iter_collage_stats(collage_items, start, end, threads=None,
+                       item_budget=None, request_budget=None):
+    """Like collage_stats, but yield the info_stats of each item as
+    soon as it (and all items before it) is ready."""
+    collage_items = list(collage_items)
+    stored = stored_stats(collage_items, start, end)
+    missing = [collage_item for collage_item in collage_items
+               if collage_item.id not in stored]
+    computed = iter_compute_stats(
+        missing, start, end, threads=threads,
+        item_budget=item_budget, request_budget=request_budget)
+    for collage_item in collage_items:
+        if collage_item.id in stored:
+            item_stats = stored[collage_item.id]
+            item_stats['id'] = collage_item.id
+            yield item_stats
+        else:
+            yield computed.next()
+
+
+def compute_stats(collage_items, start, end, threads=None):
+    """Return freshly computed info_stats for collage items, in the
+    original order."""
+    return list(iter_compute_stats(
+            collage_items, start, end, threads=threads))
+
+
+def iter_compute_stats(collage_items, start, end, threads=None,
+                       item_budget=None, request_budget=None):
+    """Yield freshly computed info_stats for collage items, in the
+    original order, as soon as they are ready.
+
+    With budgets, we wait at most item_budget seconds for each item
+    (after the one before it) and at most request_budget seconds in
+    total. Items that are not ready by then are yielded as
+    pending_stats. Their computation continues in the background and
+    stores its result, so they are there on the next request.
+    """
+    if not collage_items:
+        return
+    if threads is None:
+        threads = MAX_THREADS
+    if ((threads <= 1 or len(collage_items) == 1) and
+        item_budget is None and request_budget is None):
+        _prefetch(collage_items, start, end)
+        for collage_item in collage_items:
+            yield safe_info_stats(collage_item, start, end)
+        return
+
+    deadline = None
+    if request_budget is not None:
+        deadline = time.time() + request_budget
+    results = _submit(collage_items, start, end, max(threads, 1))
+    for collage_item, result in zip(collage_items, results):
+        try:
+            yield result.get(_timeout(item_budget, deadline))
+        except TimeoutError:
+            yield pending_stats(collage_item)
+
+
+def safe_split_stats(collage_item, start, end, split):
+    """Return split_info_stats of collage item, each with its id.
+
+    A failing item gets a single row with the empty stats and 'error'
+    set.
+    """
+    try:
+        result = collage_item.split_info_stats(start, end, split)
+    except Exception:
+        logger.exception(
+            'Error calculating split stats for collage item %s' %
+            collage_item.id)
+        result = [collage_item.empty_stats()]
+        result[0]['error'] = True
+        result[0]['period'] = None
+    for item_stats in result:
+        item_stats['id'] = collage_item.id
+    return result
+
+
+def _threaded_split_stats(collage_item, start, end, split):
+    semaphore = source_semaphore(item_source_slug(collage_item))
+    semaphore.acquire()
+    try:
+        return safe_split_stats(collage_item, start, end, split)
+    finally:
+        semaphore.release()
+        _close_connections()
+
+
+def iter_split_stats(collage_items, start, end, split, threads=None):
+    """Yield safe_split_stats of collage items, in the original order,
+    as soon as they are ready.
+
+    The time series are prefetched and the items computed like in
+    iter_compute_stats, without budgets.
+    """
+    collage_items = list(collage_items)
+    if not collage_items:
+        return
+    _prefetch(collage_items, start, end)
+    if threads is None:
+        threads = MAX_THREADS
+    if threads <= 1 or len(collage_items) == 1:
+        for collage_item in collage_items:
+            yield safe_split_stats(collage_item, start, end, split)
+        return
+    pool = thread_pool(threads)
+    results = [pool.apply_async(_threaded_split_stats,
+                                (collage_item, start, end, split))
+               for collage_item in collage_items]
+    for result in results:
+        yield result.get()
+
+
+def job_id(collage, collage_items, start, end):
+    """Return id of the stats job for collage and period.
+
+    The id changes when the collage or item settings change, so a
+    finished job is never served for other settings.
+    """
+    return digest(
+        'collage_stats', collage.secret_slug, start, end,
+        sorted((collage_item.id, collage_item.stats_settings())
+               for collage_item in collage_items))
+
+
+def job_state(job_id, offset=0):
+    """Return state of job, or None if it is unknown (or expired):
+
+    {'job_id': ..., 'status': JOB_PENDING, JOB_RUNNING, JOB_DONE or
+     JOB_FAILED, 'secret_slug': ..., 'start': ..., 'end': ...,
+     'total': number of items, 'done': number of items that are done,
+     'updated': time of the last progress,
+     'items': info_stats of the items that are done from offset on,
+     in the original order}
+    """
+    state = JOBS.get(JOBS.key(job_id))
+    if state is None:
+        return None
+    keys = [_item_key(job_id, index)
+            for index in range(max(offset, 0), state['done'])]
+    items = JOBS.get_many(keys)
+    if len(items) < len(keys):
+        logger.warning('Collage stats job %s has expired items' % job_id)
+        return None
+    state['items'] = [items[key] for key in keys]
+    return state
+
+
+def _item_key(job_id, index):
+    return JOBS.key(job_id, 'item', index)
+
+
+def _set_job_state(state):
+    state = dict(state)
+    state.pop('items', None)
+    JOBS.set(JOBS.key(state['job_id']), state)
+
+
+def load_collage_items(collage):
+    """Return list of the items of collage, with their layers and
+    sharing the collage object (like views.CollageContext), so the
+    stats settings of the items take no queries."""
+    result = list(collage.layercollageitem_set.select_related('layer'))
+    for collage_item in result:
+        collage_item.layer_collage = collage
+    return result
+
+
+def new_job(collage, start, end):
+    """Return (state, created) of the stats job for collage and period.
+
+    created is True if the job is new (or failed or died before), the
+    caller must then start it (see tasks.collage_stats_job).
+    """
+    collage_items = load_collage_items(collage)
+    mark_accessed(collage_items)
+    state = {
+        'job_id': job_id(collage, collage_items, start, end),
+        'status': JOB_PENDING,
+        'secret_slug': collage.secret_slug,
+        'start': start,
+        'end': end,
+        'total': len(collage_items),
+        'done': 0,
+        'updated': time.time(),
+        'items': []}
+    if JOBS.add(JOBS.key(state['job_id']), state):
+        return state, True
+    existing = job_state(state['job_id'])
+    if existing is None or existing['status'] == JOB_FAILED:
+        _set_job_state(state)
+        return state, True
+    return existing, restart_stale_job(existing)
+
+
+def restart_stale_job(state):
+    """Return True if the job is running without progress for
+    JOB_STALE seconds, it is then reset and the caller must start it
+    again. Only one caller gets True."""
+    if (state['status'] != JOB_RUNNING or
+        state['updated'] > time.time() - JOB_STALE):
+        return False
+    if not JOBS.add(JOBS.key(state['job_id'], 'restart', state['updated']),
+                    True):
+        return False
+    logger.warning('Restarting stale collage stats job %s' % state['job_id'])
+    state.update({'status': JOB_PENDING, 'done': 0, 'items': [],
+                  'updated': time.time()})
+    _set_job_state(state)
+    return True
+
+
+def run_job(job_id):
+    """Compute the statistics of a job, storing each item's result in
+    the cache as soon as it is ready."""
+    state = JOBS.get(JOBS.key(job_id))
+    if state is None:
+        logger.warning('Collage stats job %s has expired' % job_id)
+        return None
+    state.update({'status': JOB_RUNNING, 'done': 0, 'updated': time.time()})
+    _set_job_state(state)
+    try:
+        collage = LayerCollage.objects.get(secret_slug=state['secret_slug'])
+        for index, item_stats in enumerate(iter_collage_stats(
+                load_collage_items(collage),
+                start=state['start'], end=state['end'])):
+            # Only the new item and the small state are written.
+            JOBS.set(_item_key(job_id, index), item_stats)
+            state.update({'done': index + 1, 'updated': time.time()})
+            _set_job_state(state)
+    except Exception:
+        logger.exception('Collage stats job %s failed' % job_id)
+        state['status'] = JOB_FAILED
+    else:
+        state['status'] = JOB_DONE
+    state['updated'] = time.time()
+    _set_job_state(state)
+    return state['status']
+
+
+def mark_accessed(collage_items):
+    """Remember that the collage items were viewed, see
+    recently_accessed."""
+    now = time.time()
+    ACCESS.set_many(dict((ACCESS.key(collage_item.id), now)
+                         for collage_item in collage_items))
+
+
+def recently_accessed(collage_items):
+    """Return the collage items that were viewed in the last
+    ACCESS_MAX_AGE seconds."""
+    keys = dict((ACCESS.key(collage_item.id), collage_item)
+                for collage_item in collage_items)
+    accessed = ACCESS.get_many(keys.keys())
+    return [collage_item for key, collage_item in keys.items()
+            if key in accessed]
+
+
+def warm_periods(periods=None, today=None):
+    """Return inclusive (start, end) for the periods (default
+    WARM_PERIODS), each a number of days up to today, as whole months
+    before the current month."""
+    if periods is None:
+        periods = WARM_PERIODS
+    if today is None:
+        today = datetime.date.today()
+    end = (datetime.datetime(today.year, today.month, 1) -
+           datetime.timedelta(microseconds=1))
+    result = []
+    for days in periods:
+        start = today - datetime.timedelta(days=days)
+        result.append((datetime.datetime(start.year, start.month, 1), end))
+    return result
+
+
+def warm_stats_periods(periods=None, today=None):
+    """Return (start, end) for the periods (default WARM_PERIODS), each
+    a number of days up to today at midnight, like the dt_start and
+    dt_end of CollageView and the stats API."""
+    if periods is None:
+        periods = WARM_PERIODS
+    if today is None:
+        today = datetime.date.today()
+    end = datetime.datetime(today.year, today.month, today.day)
+    return [(end - datetime.timedelta(days=days), end) for days in periods]
+
+
+def _threaded_warm(identifier, start, end):
+    semaphore = source_semaphore(identifier.get('fews_norm_source_slug'))
+    semaphore.acquire()
+    try:
+        # Time series of the warmed period itself are not cached, a
+        # session period hardly ever matches it.
+        partials.period_buckets(
+            identifier, start, end, cache_time_series=False)
+    except Exception:
+        logger.exception('Error warming partial aggregates of %r' % (
+                identifier, ))
+    finally:
+        semaphore.release()
+        _close_connections()
+
+
+def warm_collage_stats(periods=None, threads=None, logger=logger):
+    """Fill the caches of the non-temp collages for the standard
+    periods: first the partial aggregates of the whole months (see
+    warm_periods), then the stored statistics of the day aligned
+    periods (see warm_stats_periods), which only need to fetch the
+    current month and the days before the first month.
+
+    Items that were not viewed recently are skipped, as are
+    identifiers that were already warmed for the period and items
+    with fresh stored statistics. At most `threads` (default
+    WARM_THREADS) items are computed at the same time.
+
+    Return list of (collage, start, end, number of items, seconds).
+    """
+    if threads is None:
+        threads = WARM_THREADS
+    timings = []
+    collages = LayerCollage.objects.filter(is_temp=False)
+    accessed = [(collage, recently_accessed(load_collage_items(collage)))
+                for collage in collages]
+    for start, end in warm_periods(periods):
+        warmed = set()
+        for collage, collage_items in accessed:
+            identifiers = {}
+            for collage_item in collage_items:
+                identifier = item_identifier(collage_item)
+                if identifier is None:
+                    continue
+                key = digest(identifier)
+                if key not in warmed:
+                    identifiers[key] = identifier
+            if not identifiers:
+                continue
+            warmed.update(identifiers.keys())
+            started = time.time()
+            pool = thread_pool(max(threads, 1))
+            results = [pool.apply_async(_threaded_warm,
+                                        (identifier, start, end))
+                       for identifier in identifiers.values()]
+            for result in results:
+                result.get()
+            seconds = time.time() - started
+            logger.info('Warmed %s (%d items) for %s - %s in %.1f s' % (
+                    collage, len(identifiers), start, end, seconds))
+            timings.append((collage, start, end, len(identifiers), seconds))
+    for start, end in warm_stats_periods(periods):
+        for collage, collage_items in accessed:
+            # Warming does not keep unread rows alive, see
+            # tasks.refresh_collage_stats.
+            stored = stored_stats(collage_items, start, end,
+                                  mark_read=False)
+            missing = [collage_item for collage_item in collage_items
+                       if collage_item.id not in stored]
+            if not missing:
+                continue
+            started = time.time()
+            compute_stats(missing, start, end, threads=max(threads, 1))
+            seconds = time.time() - started
+            logger.info('Stored stats of %s (%d items) for %s - %s in '
+                        '%.1f s' % (collage, len(missing), start, end,
+                                    seconds))
+            timings.append((collage, start, end, len(missing), seconds))
+    logger.info('Warmed %d collages in %.1f s' % (
+            len(timings), sum(timing[4] for timing in timings)))
+    for family, values in sorted(cachekeys.metrics().items()):
+        logger.info(
+            'Cache %s: %d values encoded (%d compressed), %d bytes raw, '
+            '%d bytes stored, %.1f s encoding, %.1f s decoding' % (
+                family, values['encoded'], values['compressed'],
+                values['raw_bytes'], values['stored_bytes'],
+                values['encode_seconds'], values['decode_seconds']))
+    return timings
@@ -0,0 +1,206 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Disk tier for large cached time series.
+
+Memcached refuses items over its size limit (1MB by default), so long
+series were fetched from FEWS-norm on every request. With
+LIZARD_WORKSPACE_DISK_CACHE_DIR set, time series payloads with at
+least LIZARD_WORKSPACE_DISK_CACHE_MIN_EVENTS events are stored on
+local disk as well: per cache key a .npy file with the events of all
+its series as records, and a .meta file with the series keys,
+comments and tzinfo.
+
+The .npy files are opened with mmap_mode='r', so the gunicorn workers
+on one host share the pages through the OS page cache instead of each
+holding a copy. Files are written under a temporary name and renamed,
+so readers never see half written files. Reading a file touches its
+mtime; when the directory grows over
+LIZARD_WORKSPACE_DISK_CACHE_MAX_SIZE bytes the least recently used
+files are removed.
+"""
+import cPickle as pickle
+import errno
+import logging
+import os
+import tempfile
+import time
+
+import numpy as np
+from django.conf import settings
+
+from lizard_workspace.cachekeys import digest
+from lizard_workspace.stats import EventArrays
+
+logger = logging.getLogger(__name__)
+
+# None disables the disk tier.
+DIRECTORY = getattr(settings, 'LIZARD_WORKSPACE_DISK_CACHE_DIR', None)
+MAX_SIZE = getattr(
+    settings, 'LIZARD_WORKSPACE_DISK_CACHE_MAX_SIZE', 2 * 1024 ** 3)
+# Smaller time series only go to the django cache.
+MIN_EVENTS = getattr(settings, 'LIZARD_WORKSPACE_DISK_CACHE_MIN_EVENTS', 50000)
+
+# Bump when the file layout changes, old files are then ignored.
+PAYLOAD_VERSION = 1
+
+DATA_EXTENSION = '.npy'
+META_EXTENSION = '.meta'
+TEMP_PREFIX = '.tmp-'
+# Seconds after which left over temporary files are removed.
+TEMP_MAX_AGE = 3600
+
+RECORD = np.dtype([('timestamps', np.int64),
+                   ('values', np.float64),
+                   ('flags', np.int16)], align=True)
+
+
+def enabled():
+    return bool(DIRECTORY)
+
+
+def _paths(key):
+    """Return data and meta path for cache key."""
+    base = os.path.join(DIRECTORY, digest(key))
+    return base + DATA_EXTENSION, base + META_EXTENSION
+
+
+def _makedirs():
+    try:
+        os.makedirs(DIRECTORY)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _write_atomic(path, write):
+    """Call write(f) with a temporary file that is renamed to path."""
+    fd, temp_path = tempfile.mkstemp(dir=DIRECTORY, prefix=TEMP_PREFIX)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.rename(temp_path, path)
+    except:
+        _remove(temp_path)
+        raise
+
+
+def event_count(time_series):
+    return sum(len(arrays) for arrays in time_series.values())
+
+
+def contains(key):
+    """Return True if cache key is on disk."""
+    return enabled() and os.path.exists(_paths(key)[1])
+
+
+def set_time_series(key, time_series):
+    """Store dict {key: EventArrays} under cache key, if it is big
+    enough. Return True if it was stored."""
+    count = event_count(time_series)
+    if not enabled() or not count or count < MIN_EVENTS:
+        return False
+    records = np.empty(count, dtype=RECORD)
+    meta = []
+    position = 0
+    for series_key, arrays in time_series.items():
+        stop = position + len(arrays)
+        records['timestamps'][position:stop] = arrays.timestamps
+        records['values'][position:stop] = arrays.values
+        records['flags'][position:stop] = arrays.flags
+        meta.append((series_key, position, stop,
+                     arrays.comments, arrays.tzinfo))
+        position = stop
+
+    data_path, meta_path = _paths(key)
+    try:
+        _makedirs()
+        # Data first: a meta file means the data file is complete.
+        _write_atomic(data_path, lambda f: np.save(f, records))
+        _write_atomic(meta_path, lambda f: pickle.dump(
+                (PAYLOAD_VERSION, meta), f, pickle.HIGHEST_PROTOCOL))
+    except (IOError, OSError):
+        logger.exception('Could not write %s' % data_path)
+        return False
+    evict()
+    return True
+
+
+def get_time_series(key):
+    """Return dict {key: EventArrays} for cache key, or None.
+
+    The arrays are read only views on the memory mapped file."""
+    if not enabled():
+        return None
+    data_path, meta_path = _paths(key)
+    try:
+        with open(meta_path, 'rb') as f:
+            version, meta = pickle.load(f)
+        if version != PAYLOAD_VERSION:
+            return None
+        records = np.load(data_path, mmap_mode='r')
+    except (IOError, OSError, EOFError, ValueError,
+            pickle.UnpicklingError):
+        return None
+    try:
+        # Mark as recently used.
+        os.utime(data_path, None)
+    except OSError:
+        pass
+
+    result = {}
+    for series_key, start, stop, comments, tzinfo in meta:
+        part = records[start:stop]
+        result[series_key] = EventArrays(
+            np.asarray(part['timestamps']), np.asarray(part['values']),
+            np.asarray(part['flags']), comments, tzinfo)
+    return result
+
+
+def evict(max_size=None):
+    """Remove least recently used files until the data files take at
+    most max_size (default LIZARD_WORKSPACE_DISK_CACHE_MAX_SIZE)
+    bytes. Return the number of removed files."""
+    if max_size is None:
+        max_size = MAX_SIZE
+    try:
+        names = os.listdir(DIRECTORY)
+    except OSError:
+        return 0
+    now = time.time()
+    entries = []
+    total = 0
+    for name in names:
+        path = os.path.join(DIRECTORY, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        if name.startswith(TEMP_PREFIX):
+            if stat.st_mtime < now - TEMP_MAX_AGE:
+                _remove(path)
+        elif name.endswith(DATA_EXTENSION):
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+    if total <= max_size:
+        return 0
+
+    removed = 0
+    for mtime, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        # Meta first, so readers do not find the data gone. Processes
+        # that have the data mapped keep their (unlinked) copy.
+        _remove(path[:-len(DATA_EXTENSION)] + META_EXTENSION)
+        _remove(path)
+        total -= size
+        removed += 1
+    logger.debug('Removed %d time series files from %s' % (
+            removed, DIRECTORY))
+    return removed
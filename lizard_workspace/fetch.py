@@ -0,0 +1,180 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Fetching (cached) FEWS-norm time series for collage items.
+
+An identifier is the parsed LayerCollageItem.identifier, like:
+
+{"geo_ident":"511004","par_ident":"Cl","stp_ident":"NETS",
+ "mod_ident":"Import_Reeksen","qua_ident":null,"fews_norm_source_slug":"hhnk"}
+
+Fetching one identifier at a time costs a query per collage item.
+prefetch_time_series groups the identifiers of a whole collage by
+source and (parameter, module, timestep, qualifier), runs one query
+per group for all locations and fills the per-identifier cache.
+"""
+import logging
+
+from lizard_fewsnorm.models import Event
+from lizard_fewsnorm.models import FewsNormSource
+from lizard_fewsnorm.models import Series
+
+from lizard_workspace import diskcache
+from lizard_workspace import tscache
+from lizard_workspace.cachekeys import TIME_SERIES
+
+logger = logging.getLogger(__name__)
+
+
+def series_params(identifier):
+    """Return Series.from_raw params for identifier."""
+    params = {}
+    if 'geo_ident' in identifier:
+        params['location'] = identifier['geo_ident']
+    if 'par_ident' in identifier:
+        params['parameter'] = identifier['par_ident']
+    if 'mod_ident' in identifier:
+        params['moduleinstance'] = identifier['mod_ident']
+    if 'stp_ident' in identifier:
+        params['timestep'] = identifier['stp_ident']
+    if 'qua_ident' in identifier and identifier['qua_ident']:
+        params['qualifierset'] = identifier['qua_ident']
+    return params
+
+
+def time_series_key(identifier, start, end):
+    return TIME_SERIES.key(identifier, start, end)
+
+
+def _store(identifier, start, end, raw_time_series):
+    """Put raw Event.time_series result in the cache, return payload."""
+    payload = tscache.encode_time_series(raw_time_series)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            'Time series cache payload for %r: %d bytes, was %d bytes' % (
+                identifier, tscache.payload_size(payload),
+                tscache.payload_size(raw_time_series)))
+    cache_key = time_series_key(identifier, start, end)
+    TIME_SERIES.set(cache_key, payload)
+    if diskcache.enabled():
+        diskcache.set_time_series(
+            cache_key, tscache.decode_time_series(payload))
+    return payload
+
+
+def _time_series(source_slug, params, start, end):
+    """Run the actual FEWS-norm query."""
+    source = FewsNormSource.objects.get(slug=source_slug)
+    series = Series.from_raw(
+        schema_prefix=source.database_schema_name,
+        params=params).using(source.database_name)
+    return Event.time_series(source, series, start, end)
+
+
+def time_series(identifier, start, end):
+    """Uncached time series, dict {key: EventArrays}."""
+    return tscache.time_series_arrays(_time_series(
+            identifier['fews_norm_source_slug'], series_params(identifier),
+            start, end))
+
+
+def cached_time_series(identifier, start, end):
+    """
+    Cached time series
+
+    Returns dict {key: EventArrays}. The cache holds the compact
+    payload from tscache.encode_time_series. Large time series are
+    also kept on local disk, see lizard_workspace.diskcache.
+    """
+    cache_key = time_series_key(identifier, start, end)
+    ts = tscache.decode_time_series(TIME_SERIES.get(cache_key))
+    if ts is None:
+        ts = diskcache.get_time_series(cache_key)
+    if ts is None:
+        # Actually fetching time series
+        raw_time_series = _time_series(
+            identifier['fews_norm_source_slug'], series_params(identifier),
+            start, end)
+        ts = tscache.decode_time_series(
+            _store(identifier, start, end, raw_time_series))
+    return ts
+
+
+class FetchGroup(object):
+    """Identifiers that can be fetched with one query: same source and
+    same params except for the location."""
+    def __init__(self, source_slug, params):
+        self.source_slug = source_slug
+        self.params = params
+        self.identifiers = []
+
+    def locations(self):
+        return sorted(set(
+            identifier['geo_ident'] for identifier in self.identifiers))
+
+
+def plan_fetches(identifiers):
+    """Return list of FetchGroups for identifiers.
+
+    Identifiers without source or location are left out, they are
+    fetched one by one by cached_time_series.
+    """
+    groups = {}
+    for identifier in identifiers:
+        if not ('fews_norm_source_slug' in identifier and
+                'geo_ident' in identifier):
+            continue
+        params = series_params(identifier)
+        del params['location']
+        group_key = (identifier['fews_norm_source_slug'],
+                     tuple(sorted(params.items())))
+        if group_key not in groups:
+            groups[group_key] = FetchGroup(
+                identifier['fews_norm_source_slug'], params)
+        groups[group_key].identifiers.append(identifier)
+    return groups.values()
+
+
+def _location_ident(location):
+    """Event.time_series keys are (location, parameter, unit). The
+    location is a fewsnorm Location (its id is the ident) or the ident
+    itself."""
+    return getattr(location, 'id', location)
+
+
+def fetch_group(group, start, end):
+    """Fetch all locations of group in one query and cache the time
+    series per identifier."""
+    params = dict(group.params)
+    params['location'] = group.locations()
+    raw_time_series = _time_series(group.source_slug, params, start, end)
+
+    by_location = {}
+    for key, ts in raw_time_series.items():
+        by_location.setdefault(
+            _location_ident(key[0]), {})[key] = ts
+    for identifier in group.identifiers:
+        _store(identifier, start, end,
+               by_location.get(identifier['geo_ident'], {}))
+
+
+def prefetch_time_series(identifiers, start, end):
+    """Fill the time series cache for identifiers that are not cached
+    yet, with one query per FetchGroup.
+
+    Groups that fail are logged and left to cached_time_series.
+    """
+    keys = dict((time_series_key(identifier, start, end), identifier)
+                for identifier in identifiers)
+    cached = TIME_SERIES.get_many(keys.keys())
+    missing = [identifier for key, identifier in keys.items()
+               if tscache.decode_time_series(cached.get(key)) is None and
+               not diskcache.contains(key)]
+    for group in plan_fetches(missing):
+        if len(group.locations()) < 2:
+            continue
+        try:
+            fetch_group(group, start, end)
+        except Exception:
+            logger.exception(
+                'Batched fetch failed for %s %r, fetching one by one' % (
+                    group.source_slug, group.params))
@@ -0,0 +1,358 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+In-process search index for layers.
+
+Finding a layer used to mean downloading all layers
+(AvailableLayersView) and filtering in the browser. The index holds
+the words of Layer.name, slug, source_ident and the slugs of the
+layer tags:
+
+- a sorted list of all words, for prefix matches with bisect
+- postings {word: {layer id: weight}}, name words weigh more, and
+  the same layer ids ordered best first
+- {trigram: set of words}, for words with a typo
+
+A layer matches when every query word is a prefix of one of its words,
+or (for query words of at least 3 characters with few prefix matches)
+looks like one of them. Exact words score higher than prefixes,
+prefixes higher than trigram matches.
+
+The index is per process. When the catalog version changes (see
+layertree.catalog_version) the layer rows are loaded again, without
+model instances, and only the layers that changed are re-indexed.
+"""
+import bisect
+import heapq
+import itertools
+import logging
+import re
+import threading
+
+from lizard_workspace import layertree
+from lizard_workspace.models import Layer
+
+logger = logging.getLogger(__name__)
+
+NAME_WEIGHT = 2.0
+OTHER_WEIGHT = 1.0
+EXACT_SCORE = 3.0
+PREFIX_SCORE = 2.0
+TRIGRAM_SCORE = 1.5
+# Minimum trigram similarity (shared / all trigrams) of a word.
+MIN_SIMILARITY = 0.5
+# Trigrams of more words are too common to find candidates with, they
+# only count for the similarity.
+MAX_TRIGRAM_WORDS = 1000
+# Number of candidates that are scored for a query, see
+# LayerIndex.search.
+MAX_CANDIDATES = 500
+
+WORD_SEPARATOR = re.compile(r'[^0-9a-z]+')
+
+
+def words(text):
+    """Return the lower case words of text."""
+    if not text:
+        return []
+    return [word for word in WORD_SEPARATOR.split(text.lower()) if word]
+
+
+def trigrams(word):
+    padded = '  %s ' % word
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class LayerIndex(object):
+    """Search index over layer documents.
+
+    A document is (name, slug, source_ident, tag slugs), see
+    load_documents.
+    """
+    def __init__(self):
+        self.documents = {}
+        self.names = {}
+        # {layer id: {word: weight}}
+        self.layer_words = {}
+        self.postings = {}
+        # {word: layer ids}, best first: by weight, then short names.
+        self.ranked = {}
+        self.sorted_words = []
+        self.word_trigrams = {}
+        self.trigram_counts = {}
+        self.posting_counts = [0]
+        self.prefix_best = {}
+        self.version = None
+
+    def _document_words(self, document):
+        name, slug, source_ident, tag_slugs = document
+        result = {}
+        for word in words(name):
+            result[word] = NAME_WEIGHT
+        for text in [slug, source_ident] + list(tag_slugs):
+            for word in words(text):
+                result.setdefault(word, OTHER_WEIGHT)
+        return result
+
+    def _add(self, layer_id, document):
+        self.documents[layer_id] = document
+        self.names[layer_id] = document[0] or ''
+        self.layer_words[layer_id] = self._document_words(document)
+        for word, weight in self.layer_words[layer_id].items():
+            if word not in self.postings:
+                self.postings[word] = {}
+                bisect.insort(self.sorted_words, word)
+                word_trigrams = trigrams(word)
+                self.trigram_counts[word] = len(word_trigrams)
+                for trigram in word_trigrams:
+                    self.word_trigrams.setdefault(trigram, set()).add(word)
+            self.postings[word][layer_id] = weight
+
+    def _remove(self, layer_id):
+        del self.documents[layer_id]
+        del self.names[layer_id]
+        for word in self.layer_words.pop(layer_id):
+            postings = self.postings[word]
+            del postings[layer_id]
+            if not postings:
+                del self.postings[word]
+                del self.ranked[word]
+                del self.trigram_counts[word]
+                del self.sorted_words[
+                    bisect.bisect_left(self.sorted_words, word)]
+                for trigram in trigrams(word):
+                    self.word_trigrams[trigram].discard(word)
+
+    def update(self, documents):
+        """Make the index hold documents {layer id: document}, only
+        re-indexing the ones that changed. Return number of changed
+        documents."""
+        changed_words = set()
+        changed = 0
+        for layer_id in set(self.documents) - set(documents):
+            changed_words.update(self.layer_words[layer_id])
+            self._remove(layer_id)
+            changed += 1
+        for layer_id, document in documents.items():
+            old = self.documents.get(layer_id)
+            if old == document:
+                continue
+            if old is not None:
+                changed_words.update(self.layer_words[layer_id])
+                self._remove(layer_id)
+            self._add(layer_id, document)
+            changed_words.update(self.layer_words[layer_id])
+            changed += 1
+        if changed:
+            names = self.names
+            for word in changed_words:
+                postings = self.postings.get(word)
+                if postings:
+                    self.ranked[word] = sorted(
+                        postings, key=lambda layer_id: (
+                            -postings[layer_id], len(names[layer_id]),
+                            layer_id))
+            self.posting_counts = [0]
+            for word in self.sorted_words:
+                self.posting_counts.append(
+                    self.posting_counts[-1] + len(self.postings[word]))
+            for word in changed_words:
+                for end in range(1, len(word) + 1):
+                    self.prefix_best.pop(word[:end], None)
+        return changed
+
+    def _prefix_range(self, query_word):
+        """Return the slice of sorted_words that start with
+        query_word."""
+        start = bisect.bisect_left(self.sorted_words, query_word)
+        # Words only have 0-9 and a-z, '{' sorts after them.
+        return start, bisect.bisect_left(
+            self.sorted_words, query_word + '{', start)
+
+    def _size(self, query_word):
+        """Return the number of postings of the words starting with
+        query_word."""
+        start, end = self._prefix_range(query_word)
+        return self.posting_counts[end] - self.posting_counts[start]
+
+    def _ranked(self, score, word):
+        """Yield (-score, name length, layer id) of the postings of
+        word, best first."""
+        postings = self.postings[word]
+        names = self.names
+        for layer_id in self.ranked[word]:
+            yield (-score * postings[layer_id], len(names[layer_id]),
+                   layer_id)
+
+    def _prefix_ranked(self, query_word, count):
+        """Return _ranked items of the best `count` layers with a word
+        starting with query_word.
+
+        Short prefixes have thousands of words, the result is kept
+        until one of the words changes."""
+        cached = count == MAX_CANDIDATES
+        if cached and query_word in self.prefix_best:
+            return self.prefix_best[query_word]
+        best = {}
+        start, end = self._prefix_range(query_word)
+        for word in self.sorted_words[start:end]:
+            score = EXACT_SCORE if word == query_word else PREFIX_SCORE
+            # The best of every word suffice.
+            for item in itertools.islice(self._ranked(score, word), count):
+                layer_id = item[2]
+                if layer_id not in best or item < best[layer_id]:
+                    best[layer_id] = item
+        result = heapq.nsmallest(count, best.itervalues())
+        if cached:
+            self.prefix_best[query_word] = result
+        return result
+
+    def _trigram_scores(self, query_word):
+        """Return {word: score} for the words that look like
+        query_word."""
+        query_trigrams = trigrams(query_word)
+        shared = {}
+        common = []
+        for trigram in query_trigrams:
+            trigram_words = self.word_trigrams.get(trigram, ())
+            if len(trigram_words) > MAX_TRIGRAM_WORDS:
+                common.append(trigram_words)
+                continue
+            for word in trigram_words:
+                shared[word] = shared.get(word, 0) + 1
+        scores = {}
+        for word, count in shared.iteritems():
+            count += sum(1 for trigram_words in common
+                         if word in trigram_words)
+            similarity = float(count) / (
+                len(query_trigrams) + self.trigram_counts[word] - count)
+            if similarity >= MIN_SIMILARITY:
+                scores[word] = TRIGRAM_SCORE * similarity
+        return scores
+
+    def _candidates(self, query_word, typo_scores, count):
+        """Return {layer id: score} of the best `count` layers for
+        query_word."""
+        merged = heapq.merge(
+            self._prefix_ranked(query_word, count),
+            *[self._ranked(score, word)
+              for word, score in typo_scores.iteritems()])
+        result = {}
+        for negative_score, length, layer_id in merged:
+            if layer_id in result:
+                continue
+            if len(result) == count:
+                break
+            result[layer_id] = -negative_score
+        return result
+
+    def _narrow(self, scores, query_word, typo_scores):
+        """Return {layer id: score} for the layers in scores that also
+        match query_word, with its score added."""
+        result = {}
+        for layer_id, total in scores.iteritems():
+            best = 0
+            for word, weight in self.layer_words[layer_id].iteritems():
+                if word == query_word:
+                    score = EXACT_SCORE
+                elif word.startswith(query_word):
+                    score = PREFIX_SCORE
+                else:
+                    score = typo_scores.get(word, 0)
+                if score * weight > best:
+                    best = score * weight
+            if best:
+                result[layer_id] = total + best
+        return result
+
+    def search(self, query, limit=20):
+        """Return [(layer id, score)] of the best matches, best
+        first.
+
+        The candidates are the best MAX_CANDIDATES (or limit) layers
+        of the rarest query word, the other words only narrow them
+        down. So the result is exact when the rarest word matches at
+        most that many layers, and a larger limit looks further.
+        """
+        query_words = words(query)
+        if not query_words:
+            return []
+        sizes = []
+        for query_word in query_words:
+            size = self._size(query_word)
+            typo_scores = {}
+            # Only look for typos when the word itself is rare.
+            if len(query_word) >= 3 and size < limit:
+                typo_scores = self._trigram_scores(query_word)
+                if not size and not typo_scores:
+                    return []
+            sizes.append((size, query_word, typo_scores))
+        sizes.sort()
+        size, query_word, typo_scores = sizes[0]
+        total = self._candidates(
+            query_word, typo_scores, max(MAX_CANDIDATES, limit))
+        for size, query_word, typo_scores in sizes[1:]:
+            total = self._narrow(total, query_word, typo_scores)
+        names = self.names
+        return heapq.nlargest(
+            limit, total.iteritems(),
+            key=lambda item: (item[1], -len(names[item[0]]), -item[0]))
+
+
+def load_documents():
+    """Return {layer id: document} of all layers, with two queries.
+
+    The base manager is used, so the index does not depend on the user
+    that happens to build it; search results are filtered later.
+    """
+    tag_slugs = {}
+    for layer_id, tag_slug in Layer.tags.through.objects.values_list(
+        'layer', 'tag__slug'):
+        tag_slugs.setdefault(layer_id, []).append(tag_slug)
+    return dict(
+        (layer_id, (name, slug, source_ident,
+                    tuple(sorted(tag_slugs.get(layer_id, ())))))
+        for layer_id, name, slug, source_ident in
+        Layer._base_manager.values_list(
+            'id', 'name', 'slug', 'source_ident'))
+
+
+_index = LayerIndex()
+_lock = threading.Lock()
+
+
+def search(query, limit=20):
+    """Search the index of this process, after updating it to the
+    current catalog version. Return [(layer id, score)]."""
+    version = layertree.catalog_version()
+    with _lock:
+        if _index.version != version:
+            changed = _index.update(load_documents())
+            _index.version = version
+            logger.debug('Layer search index: %d layers changed' % changed)
+        return _index.search(query, limit=limit)
+
+
+def search_layers(query, limit=20, layers=None):
+    """Return [(layer, score)] of the best matches in the queryset
+    layers (default Layer.objects, the layers of the data sets of the
+    user).
+
+    The index does not know the user: more matches are asked for
+    until limit of them are in layers, or there are no more.
+    """
+    if layers is None:
+        layers = Layer.objects.all()
+    loaded = {}
+    checked = set()
+    fetch = 2 * limit
+    while True:
+        found = search(query, limit=fetch)
+        new_ids = [layer_id for layer_id, score in found
+                   if layer_id not in checked]
+        checked.update(new_ids)
+        loaded.update(layers.in_bulk(new_ids))
+        result = [(loaded[layer_id], score) for layer_id, score in found
+                  if layer_id in loaded]
+        if len(result) >= limit or len(found) < fetch:
+            return result[:limit]
+        fetch *= 4
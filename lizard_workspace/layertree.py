@@ -0,0 +1,147 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Layer catalog version and cached layer tree payloads.
+
+The layer catalog (layers, folders, tags, servers and apps) only
+changes when a sync task or an admin edit runs, but AppLayerTreeView
+used to build the folder tree for every request. The json of the tree
+is now cached per object_id (and per set of data set permissions)
+under the current catalog version. The read-mostly api views use the
+version for ETags, see api.views.CatalogVersionMixin.
+
+Saving or deleting catalog objects, or changing their many to many
+relations, bumps the catalog version (see the signal handlers in
+models.py), so all cached trees are invalid at once. The version is
+the time of the last change in milliseconds. Sync tasks run with
+deferred_invalidation: the version is bumped once at the end of the
+task instead of for every changed row.
+"""
+import contextlib
+import functools
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from lizard_workspace.cachekeys import CacheFamily
+from lizard_workspace.cachekeys import KEY_PREFIX
+
+logger = logging.getLogger(__name__)
+
+# Seconds that a tree payload is kept.
+TREE_TIMEOUT = getattr(
+    settings, 'LIZARD_WORKSPACE_LAYER_TREE_TIMEOUT', 24 * 3600)
+# The version must outlive the trees.
+VERSION_TIMEOUT = 30 * 24 * 3600
+
+VERSION_KEY = '%s:catalog_version' % KEY_PREFIX
+
+TREES = CacheFamily('layer_tree', timeout=TREE_TIMEOUT)
+
+_state = threading.local()
+# Called at the end of deferred_invalidation when the catalog changed,
+# before the version is bumped.
+_deferred_callbacks = []
+
+
+def _new_version():
+    return int(time.time() * 1000)
+
+
+def catalog_version():
+    """Return current version of the layer catalog."""
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, _new_version(), VERSION_TIMEOUT)
+        version = cache.get(VERSION_KEY) or _new_version()
+    return version
+
+
+def catalog_modified():
+    """Return time of the last catalog change, in seconds since
+    EPOCH."""
+    return catalog_version() / 1000.0
+
+
+def bump_catalog_version():
+    """Invalidate all cached trees."""
+    version = max(_new_version(), (cache.get(VERSION_KEY) or 0) + 1)
+    cache.set(VERSION_KEY, version, VERSION_TIMEOUT)
+    logger.debug('Layer catalog version is now %s' % version)
+    return version
+
+
+def on_deferred_change(callback):
+    """Call callback() at the end of every deferred_invalidation in
+    which the catalog changed, for work that the signal handlers skip
+    while deferred()."""
+    _deferred_callbacks.append(callback)
+
+
+def deferred():
+    """Return True within deferred_invalidation."""
+    return bool(getattr(_state, 'depth', 0))
+
+
+def invalidate():
+    """The catalog changed: bump the version, or remember to do so at
+    the end of deferred_invalidation."""
+    if deferred():
+        _state.changed = True
+    else:
+        bump_catalog_version()
+
+
+@contextlib.contextmanager
+def deferred_invalidation():
+    """Bump the catalog version at most once, at the end of the
+    block. Blocks can be nested.
+
+    The callbacks (see on_deferred_change) also run when the block
+    raised: sync tasks commit row by row, so the changes before the
+    error are there. Queryset .update() sends no signals, call
+    invalidate() after it."""
+    if not getattr(_state, 'depth', 0):
+        _state.changed = False
+    _state.depth = getattr(_state, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _state.depth -= 1
+        if not _state.depth and _state.changed:
+            _state.changed = False
+            try:
+                _run_deferred_callbacks()
+            finally:
+                bump_catalog_version()
+
+
+def _run_deferred_callbacks():
+    # A failing callback must not keep the others from running.
+    for callback in _deferred_callbacks:
+        try:
+            callback()
+        except Exception:
+            logger.exception('Deferred catalog update %r failed' % callback)
+
+
+def defer_invalidation(func):
+    """Decorator that runs func with deferred_invalidation."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with deferred_invalidation():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def cached_json(build, *key_parts):
+    """Return the cached json bytes for key_parts under the current
+    catalog version, or build() them and cache them."""
+    key = TREES.key(catalog_version(), *key_parts)
+    payload = TREES.get(key)
+    if payload is None:
+        payload = build()
+        TREES.set(key, payload)
+    return payload
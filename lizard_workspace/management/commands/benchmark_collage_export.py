@@ -0,0 +1,96 @@
+import datetime
+import resource
+from multiprocessing import Process
+from multiprocessing import Queue
+from optparse import make_option
+from StringIO import StringIO
+
+import xlwt as excel
+from django.core.management.base import BaseCommand
+
+from lizard_workspace.views import COLLAGE_HEADER
+from lizard_workspace.views import XLSWriter
+from lizard_workspace.views import XLS_CHUNK_SIZE
+from lizard_workspace.views import save_xls
+
+
+def collage_rows(items):
+    """Yield rows like CollageView.collage_rows for a fake collage."""
+    yield ['naam', 'benchmark']
+    yield ['periode', '2012-01-01', '2013-01-01']
+    yield ['zomer of winter', 'zomer']
+    yield ['dag of nacht', 'dag']
+    yield ['maand', None]
+    yield ['dag van de week', None]
+    yield COLLAGE_HEADER
+    dt = datetime.datetime(2012, 6, 1, 12, 0)
+    for index in range(items):
+        yield ['locatie %d' % index, 8760, 0.1 * index, dt,
+               10.0 + index, dt, 5.0, 43800.0 + index, 7.5, 6000, 2760,
+               5.1, 9.2, 8.3, 80.0]
+
+
+def old_xls(rows):
+    """The previous xls_response: StringIO, then a copy with read()."""
+    wb = excel.Workbook()
+    writer = XLSWriter(wb.add_sheet('collage'))
+    for row in rows:
+        writer.writerow(row)
+    xls = StringIO()
+    wb.save(xls)
+    del wb
+    xls.seek(0)
+    content = xls.read()
+    return len(content)
+
+
+def new_xls(rows):
+    """The current xls_response: temporary file, sent in chunks."""
+    xls, size = save_xls(rows)
+    sent = 0
+    while True:
+        chunk = xls.read(XLS_CHUNK_SIZE)
+        if not chunk:
+            break
+        sent += len(chunk)
+    xls.close()
+    return sent
+
+
+def _measure(function, items, queue):
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    size = function(collage_rows(items))
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((size, before, after))
+
+
+class Command(BaseCommand):
+    help = ("""
+Compare peak memory (RSS) of the old and new collage xls export.
+
+Every export runs in its own process, so the peaks do not influence
+each other.
+
+Example: bin/django benchmark_collage_export --items=20000
+""")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--items',
+                    help='number of collage items',
+                    type='int',
+                    default=10000),
+        )
+
+    def handle(self, *args, **options):
+        items = options['items']
+        for name, function in (('StringIO', old_xls),
+                               ('tempfile', new_xls)):
+            queue = Queue()
+            process = Process(target=_measure,
+                              args=(function, items, queue))
+            process.start()
+            size, before, after = queue.get()
+            process.join()
+            # ru_maxrss is in kilobytes on linux.
+            print '%s: %d items, %d bytes xls, peak rss %d kB (+%d kB)' % (
+                name, items, size, after, after - before)
@@ -0,0 +1,68 @@
+import random
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from lizard_workspace.layersearch import LayerIndex
+
+PARAMETERS = ['Chlorofyl', 'Chloride', 'Waterstand', 'Stuw stand', 'Debiet',
+              'Meetpunt temperatuur', 'Zuurstof', 'Fosfaat totaal',
+              'Stikstof', 'Geleidendheid', 'Wind snelheid', 'Neerslag']
+OWNERS = ['hhnk', 'wrij', 'hhsk', 'waternet', 'rijnland', 'agv']
+QUERIES = ['w', 'k', 'chlor hhnk', 'stuw wrij', 'fewsnorm', 'meetpnt',
+           'hhnk00012', 'ws krw']
+
+
+def documents(layers, seed=1):
+    """Return {layer id: document} of fake layers, like
+    layersearch.load_documents."""
+    rand = random.Random(seed)
+    result = {}
+    for layer_id in range(layers):
+        owner = rand.choice(OWNERS)
+        name = '%s %s%05d %s' % (
+            rand.choice(PARAMETERS), owner.upper(), rand.randint(0, 99999),
+            rand.choice(['', 'meetpunt', 'stuw', 'gemaal']))
+        result[layer_id] = (
+            name, name.lower().replace(' ', '-'),
+            rand.choice(['fewsnorm::%s' % owner, 'ekr::%s' % owner, None]),
+            tuple(sorted([owner, rand.choice(['krw', 'ekr', 'ws'])])))
+    return result
+
+
+def timings(index, queries=QUERIES, repeat=5):
+    """Return [(query, milliseconds)], after a first search that fills
+    the caches of the index."""
+    result = []
+    for query in queries:
+        index.search(query)
+        started = time.time()
+        for _ in range(repeat):
+            index.search(query)
+        result.append((query, (time.time() - started) / repeat * 1000))
+    return result
+
+
+class Command(BaseCommand):
+    help = ("""
+Time typeahead searches in a layer search index of fake layers.
+
+Example: bin/django benchmark_layer_search --layers=50000
+""")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--layers',
+                    help='number of layers',
+                    type='int',
+                    default=50000),
+        )
+
+    def handle(self, *args, **options):
+        index = LayerIndex()
+        started = time.time()
+        index.update(documents(options['layers']))
+        print 'index of %d layers built in %.1f s' % (
+            options['layers'], time.time() - started)
+        for query, milliseconds in timings(index):
+            print '%-12s %6.1f ms' % (query, milliseconds)
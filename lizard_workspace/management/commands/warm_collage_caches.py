@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from lizard_workspace.tasks import warm_collage_caches
+
+
+class Command(BaseCommand):
+    help = ("""
+Fill the partial aggregates cache of the non-temp collages for the
+whole months of the standard periods (LIZARD_WORKSPACE_WARM_PERIODS),
+and their stored statistics for these periods up to today.
+
+Example: bin/django warm_collage_caches --days=365 --days=30 --threads=4
+""")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days',
+                    help='months of this many days up to today, can be repeated',
+                    type='int',
+                    action='append',
+                    default=None),
+        make_option('--threads',
+                    help='number of items that are computed at the same time',
+                    type='int',
+                    default=None),
+        )
+
+    def handle(self, *args, **options):
+        print warm_collage_caches(
+            periods=options['days'], threads=options['threads'])
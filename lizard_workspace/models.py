@@ -1,11 +1,12 @@
 # (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+import datetime
 import json
 import logging
 import string
 import random
 
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.db import models
 
@@ -16,9 +17,10 @@ from lizard_map.models import WorkspaceStorage
 from lizard_map.models import ADAPTER_CLASS_WMS
 from treebeard.al_tree import AL_Node
 
-from lizard_fewsnorm.models import Event
-from lizard_fewsnorm.models import FewsNormSource
-from lizard_fewsnorm.models import Series
+from lizard_workspace import layertree
+from lizard_workspace import partials
+from lizard_workspace import stats
+from lizard_workspace.cachekeys import digest
 
 logger = logging.getLogger(__name__)
 
@@ -26,6 +28,16 @@ logger = logging.getLogger(__name__)
 SECRET_SLUG_CHARS = string.ascii_lowercase
 SECRET_SLUG_LENGTH = 8
 
+# Seconds that stored collage item statistics are used.
+STORED_STATS_MAX_AGE = getattr(
+    settings, 'LIZARD_WORKSPACE_STORED_STATS_MAX_AGE', 3600)
+# Stored statistics that were not read in this many seconds are
+# removed by refresh_collage_stats instead of refreshed.
+STORED_STATS_READ_MAX_AGE = getattr(
+    settings, 'LIZARD_WORKSPACE_STORED_STATS_READ_MAX_AGE', 7 * 24 * 3600)
+# Seconds between updates of LayerCollageItemStats.timestamp_read.
+STORED_STATS_READ_RESOLUTION = 3600
+
 
 class Category(models.Model):
     name = models.CharField(max_length=80)
@@ -533,6 +545,37 @@ class LayerCollage(LayerContainerMixin):
             result.append(item)
         return result
 
+    def period_filter(self):
+        """Return period settings as keyword arguments for
+        partials.calc_stats.
+
+        Collage settings:
+        summer_or_winter
+        restrict_to_month
+        day_of_week
+        day_or_night
+        """
+        months = None
+        if self.summer_or_winter == self.SUMMER_WINTER_SUMMER:
+            months = set(range(4, 10))
+        elif self.summer_or_winter == self.SUMMER_WINTER_WINTER:
+            months = set(range(1, 13)) - set(range(4, 10))
+        if self.restrict_to_month:
+            months = set([self.restrict_to_month]) & (
+                months or set([self.restrict_to_month]))
+
+        hours = None
+        if self.day_or_night == self.DAY_NIGHT_DAY:
+            # Note: filters out 0:00-5:00.
+            hours = range(5, 24)
+        elif self.day_or_night == self.DAY_NIGHT_NIGHT:
+            hours = range(0, 6)
+
+        return {
+            'months': months,
+            'hours': hours,
+            'weekday': self.day_of_week}
+
     def display_month(self):
         months = {
             None: 'Alle maanden',
@@ -596,12 +639,58 @@ class LayerCollageItem(models.Model):
     # Percentile value for statistics (blank = median).
     percentile_value = models.FloatField(blank=True, null=True)
 
+    # Copies of the identifier fields, kept in sync on save, so items
+    # can be grouped and filtered in the database.
+    fews_norm_source_slug = models.CharField(
+        max_length=128, null=True, blank=True, db_index=True)
+    geo_ident = models.CharField(
+        max_length=128, null=True, blank=True, db_index=True)
+    par_ident = models.CharField(
+        max_length=128, null=True, blank=True, db_index=True)
+    mod_ident = models.CharField(
+        max_length=128, null=True, blank=True, db_index=True)
+    stp_ident = models.CharField(
+        max_length=128, null=True, blank=True, db_index=True)
+    qua_ident = models.CharField(
+        max_length=128, null=True, blank=True, db_index=True)
+
+    IDENTIFIER_FIELDS = (
+        'fews_norm_source_slug', 'geo_ident', 'par_ident', 'mod_ident',
+        'stp_ident', 'qua_ident')
+
     class Meta:
         ordering = ('grouping_hint', 'name', )
 
     def __unicode__(self):
         return '%s %s' % (self.layer_collage, self.layer)
 
+    def sync_identifier_fields(self):
+        """Set the IDENTIFIER_FIELDS from identifier."""
+        try:
+            identifier = self.parsed_identifier()
+        except (TypeError, ValueError):
+            identifier = None
+        if not isinstance(identifier, dict):
+            identifier = {}
+        for field in self.IDENTIFIER_FIELDS:
+            value = identifier.get(field)
+            if value is not None:
+                value = unicode(value)
+            setattr(self, field, value)
+
+    def save(self, *args, **kwargs):
+        self.sync_identifier_fields()
+        return super(LayerCollageItem, self).save(*args, **kwargs)
+
+    def parsed_identifier(self):
+        """Return json.loads of identifier, parsed once per instance
+        (as long as identifier does not change)."""
+        parsed = getattr(self, '_parsed_identifier', None)
+        if parsed is None or parsed[0] != self.identifier:
+            parsed = (self.identifier, json.loads(self.identifier))
+            self._parsed_identifier = parsed
+        return parsed[1]
+
     def graph_url(self, only_parameters=False):
         """Return url of graph or None
 
@@ -614,7 +703,7 @@ class LayerCollageItem(models.Model):
         if not self.identifier:
             return None
 
-        identifier = json.loads(self.identifier)
+        identifier = self.parsed_identifier()
         if not 'geo_ident' in identifier:
             return None
 
@@ -634,181 +723,9 @@ class LayerCollageItem(models.Model):
             parameters.append('legend-location=7')
             return base_url + '?' + '&'.join(parameters)
 
-    def info_stats(self, start, end):
-        """Return statistics on time series
-
-        Only works when collage item is from a fews location
-        """
-        def cached_time_series(identifier, start, end):
-            """
-            Cached time series
-            """
-            def time_series_key(identifier, start, end):
-                return str(hash(('ts::%s::%s:%s' % (
-                    str(identifier), start, end)).replace(' ', '_')))
-            cache_key = time_series_key(identifier, start, end)
-            ts = cache.get(cache_key)
-            if ts is None:
-                # Actually fetching time series
-                source_name = identifier['fews_norm_source_slug']
-                source = FewsNormSource.objects.get(slug=source_name)
-                params = {}
-                if 'geo_ident' in identifier:
-                    params['location'] = identifier['geo_ident']
-                if 'par_ident' in identifier:
-                    params['parameter'] = identifier['par_ident']
-                if 'mod_ident' in identifier:
-                    params['moduleinstance'] = identifier['mod_ident']
-                if 'stp_ident' in identifier:
-                    params['timestep'] = identifier['stp_ident']
-                if 'qua_ident' in identifier and identifier['qua_ident']:
-                    params['qualifierset'] = identifier['qua_ident']
-                series = Series.from_raw(
-                    schema_prefix=source.database_schema_name,
-                    params=params).using(source.database_name)
-                ts = Event.time_series(source, series, start, end)
-                cache.set(cache_key, ts)
-            return ts
-
-        def filter_ts_period(ts):
-            """
-            Use collage settings to filter out unwanted dates.
-
-            Collage settings:
-            summer_or_winter
-            restrict_to_month
-            day_of_week
-            day_or_night
-
-            """
-            collage = self.layer_collage
-
-            # Filter out winter.
-            if collage.summer_or_winter == LayerCollage.SUMMER_WINTER_SUMMER:
-                for timestamp in ts.keys():
-                    if timestamp.month < 4 or timestamp.month > 9:
-                        del ts[timestamp]
-
-            # Filter out summer.
-            if collage.summer_or_winter == LayerCollage.SUMMER_WINTER_WINTER:
-                for timestamp in ts.keys():
-                    if timestamp.month >= 4 and timestamp.month <= 9:
-                        del ts[timestamp]
-
-            # Only a single month.
-            if collage.restrict_to_month:
-                for timestamp in ts.keys():
-                    if timestamp.month != collage.restrict_to_month:
-                        del ts[timestamp]
-
-            # Filter out night.
-            if collage.day_or_night == LayerCollage.DAY_NIGHT_DAY:
-                for timestamp in ts.keys():
-                    if timestamp.hour >= 0 and timestamp.hour < 5:
-                        del ts[timestamp]
-
-            # Filter out day.
-            if collage.day_or_night == LayerCollage.DAY_NIGHT_NIGHT:
-                for timestamp in ts.keys():
-                    print timestamp.hour
-                    if timestamp.hour >= 6:
-                        del ts[timestamp]
-
-            # Only one day of week
-            if collage.day_of_week is not None:
-                for timestamp in ts.keys():
-                    if timestamp.weekday() != collage.day_of_week:
-                        del ts[timestamp]
-
-            return ts
-
-        def cached_filter_ts_period(identifier, start, end, collage, ts):
-            """
-            Cache wrapper for filter_ts_period.
-
-            We have no about the timeseries, so you must provide them.
-            """
-            def filtered_ts_cache_key(identifier, start, end, collage):
-                cache_key_full = 'filtered_ts::%s::%s:%s::%s:%s:%s:%s' % (
-                    identifier, start, end,
-                    collage.summer_or_winter, collage.restrict_to_month,
-                    collage.day_of_week, collage.day_or_night)
-                return str(hash(cache_key_full))
-            cache_key = filtered_ts_cache_key(identifier, start, end, collage)
-            time_series = cache.get(cache_key)
-            if time_series is None:
-                time_series = filter_ts_period(ts)
-                cache.set(cache_key, time_series)
-            return time_series
-
-        def calc_stats(ts):
-            """Return stats for time series and settings in this
-            collage item.
-
-            Return value is a dict with all the numbers in a fixed
-            structure.
-            """
-            result = {}
-
-            # Calc boundary value
-            if self.boundary_value is not None:
-                boundary_result = {
-                    'amount_less_equal': 0,
-                    'amount_greater': 0,
-                    'value': self.boundary_value}
-                for dt, (value, flag, comment) in ts.get_events(start_date=start, end_date=end):
-                    if value <= self.boundary_value:
-                        boundary_result['amount_less_equal'] += 1
-                    else:
-                        boundary_result['amount_greater'] += 1
-                result['boundary'] = boundary_result
-
-            # Remember: (datetime, (value, flag, comment))
-            items = ts.get_events(start_date=start, end_date=end)
-            result['item_count'] = len(items)
-
-            # Calc min, max, avg, sum
-            if items:
-                # reduce: see the docs of reduce :-) We also want the date/times of the min/max.
-                items_sum = sum([i[1][0] for i in items])
-                standard_result = {
-                    'min': reduce(lambda a, b: a if a[1][0] <= b[1][0] else b, items),
-                    'max': reduce(lambda a, b: a if a[1][0] >= b[1][0] else b, items),
-                    'sum': items_sum,
-                    'avg': float(items_sum) / len(items),
-                    }
-                result['standard'] = standard_result
-
-            # Calc percentiles
-            sorted_items = sorted(
-                items,
-                key=lambda i: i[1][0])
-            if sorted_items:
-                percentile_result = {
-                    'value': self.percentile_value,
-                    'median': sorted_items[int(50 * len(sorted_items) / 100)][1][0],
-                    '90': sorted_items[int(90 * len(sorted_items) / 100)][1][0],
-                    'user': None
-                    }
-                try:
-                    percentile_result['user'] = sorted_items[
-                        int(self.percentile_value * len(sorted_items) / 100)][1][0]
-                except:
-                    # percentile_value is not valid.
-                    pass
-                result['percentile'] = percentile_result
-
-            return result
-
-        identifier = json.loads(self.identifier)
-
-        # Time series is a dict.
-
-        # Note: it is somewhat ineffective to fetch time series here
-        # and then fetch the filtered time series from cache later.
-        time_series = cached_time_series(identifier, start, end)
-
-        result = {
+    def empty_stats(self):
+        """Return info_stats structure without numbers."""
+        return {
             'name': self.name,
             'item_count': None,
             'boundary': {
@@ -827,20 +744,154 @@ class LayerCollageItem(models.Model):
                 '90': None}
             }
 
-        # Assume there is only 1, else do not calculate stats.
-        if len(time_series) == 1:
-            # Ignoring key ('location', 'parameter', 'unit')
-            ts = time_series.values()[0]
-            ts = cached_filter_ts_period(identifier, start, end, self.layer_collage, ts)
-            result.update(calc_stats(ts))
-        else:
-            logger.warning(
-                'Multiple time series found for identifier=%r, skipped stats' %
-                identifier)
+    def stats_settings(self):
+        """Return the item and collage settings that info_stats
+        depends on, as LayerCollageItemStats fields."""
+        collage = self.layer_collage
+        return {
+            'summer_or_winter': collage.summer_or_winter,
+            'restrict_to_month': collage.restrict_to_month,
+            'day_of_week': collage.day_of_week,
+            'day_or_night': collage.day_or_night,
+            'boundary_value': self.boundary_value,
+            'percentile_value': self.percentile_value}
+
+    def stats_key(self):
+        """Return digest of stats_settings, see
+        LayerCollageItemStats.stats_key."""
+        return digest(sorted(self.stats_settings().items()))
+
+    def store_info_stats(self, start, end, result):
+        """Store info_stats result as LayerCollageItemStats.
+
+        A new row counts as read; refreshing an existing row leaves
+        its timestamp_read alone."""
+        now = datetime.datetime.now()
+        stats_text = stats.dumps_stats(result)
+        defaults = self.stats_settings()
+        defaults.update({
+                'stats': stats_text,
+                'timestamp_computed': now,
+                'timestamp_read': now})
+        # Threads and processes can store the same row at the same
+        # time, get_or_create handles the IntegrityError.
+        row, created = LayerCollageItemStats.objects.get_or_create(
+            collage_item=self, period_start=start, period_end=end,
+            stats_key=self.stats_key(), defaults=defaults)
+        if not created:
+            LayerCollageItemStats.objects.filter(id=row.id).update(
+                stats=stats_text, timestamp_computed=now)
+        return row
+
+    def info_stats(self, start, end):
+        """Return statistics on time series
+
+        Only works when collage item is from a fews location.
+
+        The statistics are combined from cached per-month partial
+        aggregates, see lizard_workspace.partials: changing the
+        period or the collage settings only fetches months that were
+        not seen before. Percentiles of long periods are approximate,
+        see partials.period_stats.
+        """
+        identifier = self.parsed_identifier()
+        result = self.empty_stats()
+
+        item_stats = partials.period_stats(
+            identifier, start, end,
+            boundary_value=self.boundary_value,
+            percentile_value=self.percentile_value,
+            **self.layer_collage.period_filter())
+        if item_stats is not None:
+            result.update(item_stats)
+        return result
+
+    def split_info_stats(self, start, end, split):
+        """Return info_stats for every year, season or month (see
+        partials.split_keys) of the period, with the sub-period label
+        as 'period'.
 
+        All sub-periods are computed from the same buckets, so the time
+        series is fetched once. The sub-periods are always exact.
+        """
+        identifier = self.parsed_identifier()
+        buckets = partials.period_buckets(identifier, start, end)
+        if buckets is None:
+            return []
+        result = []
+        for label, split_stats in partials.split_stats(
+            buckets, split,
+            boundary_value=self.boundary_value,
+            percentile_value=self.percentile_value,
+            **self.layer_collage.period_filter()):
+            item_stats = self.empty_stats()
+            item_stats.update(split_stats)
+            item_stats['period'] = label
+            result.append(item_stats)
         return result
 
 
+class LayerCollageItemStats(models.Model):
+    """
+    Stored LayerCollageItem.info_stats result.
+
+    One row per collage item, period and the statistics settings of
+    the item and its collage at the time of computing (stats_key).
+    Filled by the collage views and refreshed by the
+    refresh_collage_stats task, so a shared collage costs one query
+    instead of a FEWS-norm scan. Rows that are not read for
+    LIZARD_WORKSPACE_STORED_STATS_READ_MAX_AGE seconds are removed.
+    """
+    collage_item = models.ForeignKey(LayerCollageItem)
+    period_start = models.DateTimeField()
+    period_end = models.DateTimeField()
+
+    summer_or_winter = models.IntegerField()
+    restrict_to_month = models.IntegerField(blank=True, null=True)
+    day_of_week = models.IntegerField(blank=True, null=True)
+    day_or_night = models.IntegerField()
+    boundary_value = models.FloatField(blank=True, null=True)
+    percentile_value = models.FloatField(blank=True, null=True)
+
+    stats_key = models.CharField(
+        max_length=40,
+        help_text='digest of the settings, see LayerCollageItem.stats_key')
+
+    stats = models.TextField(help_text='info_stats result, see stats.dumps_stats')
+    timestamp_computed = models.DateTimeField()
+    timestamp_read = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = (
+            ('collage_item', 'period_start', 'period_end', 'stats_key'), )
+
+    def __unicode__(self):
+        return '%s %s - %s' % (
+            self.collage_item, self.period_start, self.period_end)
+
+    def is_fresh(self, now=None):
+        if now is None:
+            now = datetime.datetime.now()
+        return self.timestamp_computed >= now - datetime.timedelta(
+            seconds=STORED_STATS_MAX_AGE)
+
+    def matches(self, collage_item):
+        """Return True if the row was computed with the current
+        settings of collage_item (and its collage)."""
+        return self.stats_key == collage_item.stats_key()
+
+    def needs_read_update(self, now=None):
+        """Return True if timestamp_read is older than
+        STORED_STATS_READ_RESOLUTION."""
+        if now is None:
+            now = datetime.datetime.now()
+        return self.timestamp_read < now - datetime.timedelta(
+            seconds=STORED_STATS_READ_RESOLUTION)
+
+    def info_stats(self):
+        return stats.loads_stats(self.stats)
+
+
 class LayerFolder(AL_Node):
     """
     maps with layers
@@ -859,32 +910,120 @@ class LayerFolder(AL_Node):
     def __unicode__(self):
         return self.name
 
+    def folder_layers(self):
+        """
+        Return queryset of the layers and the valid layers referenced
+        by tags, ordered by name, see LayerFolderMembership.
+        """
+        return Layer.objects.filter(
+            layerfoldermembership__layer_folder=self).order_by('name')
+
+    def resolve_layer_ids(self):
+        """
+        Return ids of the layers and the valid layers referenced by
+        tags, from the many to many tables.
+        """
+        layer_ids = set(LayerFolder.layers.through.objects.filter(
+                layerfolder=self).values_list('layer', flat=True))
+        layer_ids.update(Layer.tags.through.objects.filter(
+                tag__layerfolder=self,
+                layer__valid=True).values_list('layer', flat=True))
+        return layer_ids
+
+    def update_membership(self):
+        """
+        Make the LayerFolderMembership rows of the folder match
+        resolve_layer_ids. Return the number of added and removed
+        rows.
+        """
+        layer_ids = self.resolve_layer_ids()
+        current = set(self.layerfoldermembership_set.values_list(
+                'layer', flat=True))
+        removed = current - layer_ids
+        if removed:
+            self.layerfoldermembership_set.filter(
+                layer__in=removed).delete()
+        added = layer_ids - current
+        if added:
+            LayerFolderMembership.objects.bulk_create([
+                    LayerFolderMembership(layer_folder=self, layer_id=layer_id)
+                    for layer_id in added])
+        return len(removed) + len(added)
+
+    @classmethod
+    def update_memberships(cls, folder_ids=None):
+        """
+        Update the LayerFolderMembership rows of the folders, default
+        all folders. Return the number of added and removed rows.
+        """
+        layer_folders = cls.objects.all()
+        if folder_ids is not None:
+            layer_folders = layer_folders.filter(id__in=folder_ids)
+        return sum(layer_folder.update_membership()
+                   for layer_folder in layer_folders)
+
     def layers_dict(self):
         """
         Return layers and layers referenced by tags in a dict form.
 
         TODO: add 'checked' to the layers that are in the current workspace.
         """
-        layers = (
-            self.layers.all() |
-            Layer.objects.filter(
-                tags__in=self.layer_tag.all(),
-                valid=True,
-            )).distinct().order_by('name')
+        return [layer_item(layer) for layer in self.folder_layers()]
 
-        output = []
+    def folder_page(self, start=0, limit=None, query=None):
+        """
+        Return the child folders with their number of layers, and a
+        page of the layers of this folder (see folder_layers), for
+        loading big folders on demand:
 
-        for layer in layers:
-            item = layer.get_object_dict()
-            item['plid'] = layer.id
-            item['text'] = layer.name
-            item['leaf'] = True
-            item['checked'] = False
-            #del item['id']
+            {'folders': [{'id': 3, 'text': 'map3', 'layer_count': 2,
+                          'folder_count': 0, 'leaf': False}],
+             'layers': [{'plid':4, 'text': 'leaf 4', 'leaf': True}],
+             'count': 1200}
 
-            output.append(item)
+        count is the number of layers whose name contains query.
+        """
+        layers = self.folder_layers()
+        if query:
+            layers = layers.filter(name__icontains=query)
+        count = layers.count()
+        if limit is not None:
+            layers = layers[start:start + limit]
+        elif start:
+            layers = layers[start:]
+        return {
+            'folders': self.folders_dict(self.children_set.all()),
+            'layers': [layer_item(layer) for layer in layers],
+            'count': count}
 
-        return output
+    @classmethod
+    def root_page(cls):
+        """Return folder_page of the root: only folders."""
+        return {
+            'folders': cls.folders_dict(cls.objects.filter(parent=None)),
+            'layers': [],
+            'count': 0}
+
+    @classmethod
+    def folders_dict(cls, folders):
+        """Return folder_page folders for a queryset of folders."""
+        folders = list(folders.annotate(
+                folder_count=models.Count('children_set')).order_by('name'))
+        # All counts in one query, through the Layer manager like
+        # folder_layers.
+        layer_counts = dict(Layer.objects.filter(
+                layerfoldermembership__layer_folder__in=[
+                    folder.id for folder in folders]).order_by().values(
+                'layerfoldermembership__layer_folder').annotate(
+                layer_count=models.Count('id')).values_list(
+                'layerfoldermembership__layer_folder', 'layer_count'))
+        return [
+            {'id': folder.id,
+             'text': folder.name,
+             'layer_count': layer_counts.get(folder.id, 0),
+             'folder_count': folder.folder_count,
+             'leaf': False}
+            for folder in folders]
 
     @classmethod
     def tree_dict(cls, parent_id=None):
@@ -896,22 +1035,114 @@ class LayerFolder(AL_Node):
                 {'plid':4, 'text': 'leaf 4', 'leaf': True},
             ]},
             {'plid':2, 'text': 'map2', 'children': []}
+
+        All folders and layers are loaded at once, see LayerFolderTree.
         """
+        return LayerFolderTree.load().tree_dict(parent_id)
+
+    @classmethod
+    def tree_json(cls, parent_id=None, cache_parts=()):
+        """Return tree_dict as json, cached until the layer catalog
+        changes (see lizard_workspace.layertree).
+
+        cache_parts must identify everything else the tree depends
+        on, like the data sets of the user."""
+        return layertree.cached_json(
+            lambda: json.dumps(cls.tree_dict(parent_id)),
+            parent_id and int(parent_id), *cache_parts)
+
+    def children_str(self):
+        return ', '.join([str (c) for c in self.children_set.all()])
+
+
+class LayerFolderMembership(models.Model):
+    """
+    Materialized contents of a LayerFolder: its layers and the valid
+    layers with one of its tags.
+
+    Kept current by the signal handlers at the bottom of this module;
+    sync tasks update all folders once, when they are done or failed
+    (see layertree.deferred_invalidation). Queryset .update() of
+    layers or tags sends no signals: it must be followed by
+    layertree.invalidate() within deferred_invalidation, or by
+    LayerFolder.update_memberships().
+    """
+    layer_folder = models.ForeignKey(LayerFolder)
+    layer = models.ForeignKey(Layer)
+
+    class Meta:
+        unique_together = (('layer_folder', 'layer'), )
+
+    def __unicode__(self):
+        return '%s: %s' % (self.layer_folder, self.layer)
+
+
+def layer_item(layer):
+    """Return tree dict of a layer in a LayerFolder."""
+    item = layer.get_object_dict()
+    item['plid'] = layer.id
+    item['text'] = layer.name
+    item['leaf'] = True
+    item['checked'] = False
+    #del item['id']
+    return item
+
+
+class LayerFolderTree(object):
+    """
+    All LayerFolders with their layers, loaded with a fixed number of
+    queries.
+
+    LayerFolder.tree_dict used to query the folder, its children and
+    its layers for every folder. The folder layers are the same as in
+    LayerFolder.layers_dict, see LayerFolderMembership.
+    """
+    def __init__(self, folders, layers, folder_layers):
+        self.folders = dict((folder.id, folder) for folder in folders)
+        # Folders are ordered by name within their parent.
+        self.children = {}
+        for folder in folders:
+            self.children.setdefault(folder.parent_id, []).append(folder)
+        self.layers = dict((layer.id, layer) for layer in layers)
+        # Layers are ordered by name.
+        self.layer_order = dict(
+            (layer.id, index) for index, layer in enumerate(layers))
+        self.folder_layers = folder_layers
+
+    @classmethod
+    def load(cls):
+        folders = list(LayerFolder.objects.all())
+
+        folder_layers = {}
+        for folder_id, layer_id in LayerFolderMembership.objects.values_list(
+            'layer_folder', 'layer'):
+            folder_layers.setdefault(folder_id, set()).add(layer_id)
+
+        # Through the Layer manager, so the same layers are filtered
+        # out as in layers_dict.
+        layers = Layer.objects.filter(
+            layerfoldermembership__isnull=False).distinct(
+            ).order_by('name').select_related('server')
+        return cls(folders, list(layers), folder_layers)
+
+    def layers_dict(self, folder_id):
+        """Return LayerFolder.layers_dict of folder."""
+        layer_ids = self.folder_layers.get(folder_id, set())
+        layer_ids = sorted(layer_ids & set(self.layers),
+                           key=self.layer_order.get)
+        return [layer_item(self.layers[layer_id]) for layer_id in layer_ids]
+
+    def tree_dict(self, parent_id=None):
+        """Return LayerFolder.tree_dict."""
         result = []
         if parent_id is not None:
-            parent_folder = cls.objects.get(id=parent_id)
-            layer_folders = cls.objects.filter(parent=parent_folder)
+            parent_id = int(parent_id)
+            if parent_id not in self.folders:
+                raise LayerFolder.DoesNotExist
+            result.extend(self.layers_dict(parent_id))
 
-            # Add layers and layers filtered by tags
-            layer_folder_dict = parent_folder.layers_dict()
-            result.extend(layer_folder_dict)
-        else:
-            layer_folders = cls.objects.filter(parent=None)
-        layer_folders = list(layer_folders)  # Fetch from db.
-
-        # Add children
-        for layer_folder in layer_folders:
-            children_layer_tree = cls.tree_dict(parent_id=layer_folder.id)
+        for layer_folder in self.children.get(parent_id, ()):
+            children_layer_tree = self.tree_dict(layer_folder.id)
             if children_layer_tree:
                 result.append(
                     {'text': layer_folder.name,
@@ -919,9 +1150,6 @@ class LayerFolder(AL_Node):
 
         return result
 
-    def children_str(self):
-        return ', '.join([str (c) for c in self.children_set.all()])
-
 
 # class LayerFolderItem(models.Models):
 #     layer = model.ForeignKey(Layer)
@@ -1017,3 +1245,92 @@ class App(models.Model):
 
     def __unicode__(self):
         return self.name
+
+
+def update_folders_of_tags(tag_ids):
+    """Update the memberships of the folders with one of the tags,
+    None for all folders with tags."""
+    links = LayerFolder.layer_tag.through.objects.all()
+    if tag_ids is not None:
+        links = links.filter(tag__in=tag_ids)
+    LayerFolder.update_memberships(
+        set(links.values_list('layerfolder', flat=True)))
+
+
+def update_memberships_m2m(sender, instance, action, reverse, pk_set,
+                           **kwargs):
+    """Update LayerFolderMembership after a change of Layer.tags,
+    LayerFolder.layers or LayerFolder.layer_tag."""
+    if not action.startswith('post_') or layertree.deferred():
+        return
+    if sender is Layer.tags.through:
+        if reverse:
+            update_folders_of_tags([instance.id])
+        else:
+            # pk_set is None after clear, the tags are gone by then.
+            update_folders_of_tags(pk_set)
+    elif reverse:
+        # Changed from the layer or tag side, pk_set are folders.
+        LayerFolder.update_memberships(pk_set)
+    else:
+        instance.update_membership()
+
+
+def update_memberships_layer(sender, instance, created, **kwargs):
+    """Layer.valid may have changed."""
+    if created or layertree.deferred():
+        return
+    update_folders_of_tags(instance.tags.values_list('id', flat=True))
+
+
+def remember_folders_of_tag(sender, instance, **kwargs):
+    """Remember the folders of a tag that is deleted, its links are
+    gone by the time of update_memberships_tag."""
+    if not layertree.deferred():
+        instance._membership_folder_ids = set(
+            LayerFolder.layer_tag.through.objects.filter(
+                tag=instance).values_list('layerfolder', flat=True))
+
+
+def update_memberships_tag(sender, instance, **kwargs):
+    """Deleting a tag removes its links without m2m signals, also
+    the last tag of a folder."""
+    if not layertree.deferred():
+        LayerFolder.update_memberships(
+            getattr(instance, '_membership_folder_ids', None))
+
+
+# Memberships first, so the layer tree is not rebuilt from stale
+# memberships.
+for catalog_relation in (Layer.tags, LayerFolder.layers, LayerFolder.layer_tag):
+    models.signals.m2m_changed.connect(
+        update_memberships_m2m, sender=catalog_relation.through,
+        dispatch_uid='memberships_m2m_%s' % catalog_relation.through.__name__)
+models.signals.post_save.connect(
+    update_memberships_layer, sender=Layer,
+    dispatch_uid='memberships_save_Layer')
+models.signals.pre_delete.connect(
+    remember_folders_of_tag, sender=Tag,
+    dispatch_uid='memberships_pre_delete_Tag')
+models.signals.post_delete.connect(
+    update_memberships_tag, sender=Tag,
+    dispatch_uid='memberships_delete_Tag')
+layertree.on_deferred_change(LayerFolder.update_memberships)
+
+
+def invalidate_layer_tree(sender, **kwargs):
+    layertree.invalidate()
+
+
+for catalog_model in (Layer, LayerFolder, Tag, WmsServer,
+                      App, AppScreen, AppScreenAppItems, AppIcons):
+    models.signals.post_save.connect(
+        invalidate_layer_tree, sender=catalog_model,
+        dispatch_uid='layer_tree_save_%s' % catalog_model.__name__)
+    models.signals.post_delete.connect(
+        invalidate_layer_tree, sender=catalog_model,
+        dispatch_uid='layer_tree_delete_%s' % catalog_model.__name__)
+for catalog_relation in (Layer.tags, LayerFolder.layers, LayerFolder.layer_tag):
+    models.signals.m2m_changed.connect(
+        invalidate_layer_tree, sender=catalog_relation.through,
+        dispatch_uid='layer_tree_m2m_%s' % catalog_relation.through.__name__)
@@ -0,0 +1,575 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Mergeable per-month partial aggregates for collage statistics.
+
+Changing the period or the month/day/night settings of a collage used
+to fetch and scan the whole time series again. Instead, the events of
+each identifier are summarized per calendar month (a Bucket) and
+cached. A Bucket has a cell for every (day of week, hour) with:
+
+- the number of events and their sum
+- the min and max event (the first occurrence)
+- the values, sorted per cell, for boundary counts and percentiles
+
+Month buckets are always exact. A single month has too few events
+per cell to be worth a sketch, so for periods with more than
+LIZARD_WORKSPACE_SKETCH_THRESHOLD events (after the month filter)
+period_stats merges the buckets and keeps a quantile sketch per cell
+(see lizard_workspace.sketch), with a rank error of at most
+LIZARD_WORKSPACE_SKETCH_EPSILON of the selected events. The merged
+sketch is cached per identifier, period, months and boundary value
+(whose counts it keeps exactly), so changing the percentile or the
+hours only reads that one payload. Below the threshold the statistics
+are exact.
+
+Every collage period filter selects whole months and whole cells, so
+the statistics for a new filter are a combination of cached cells.
+Only months that were never seen before are fetched. The first and
+last month of a period are clipped to the period; buckets that end
+after now are never cached, their data may still change.
+"""
+import datetime
+import logging
+
+import numpy as np
+from django.conf import settings
+
+from lizard_workspace import fetch
+from lizard_workspace import sketch
+from lizard_workspace import stats
+from lizard_workspace.cachekeys import PARTIAL_AGGREGATES
+from lizard_workspace.cachekeys import PERIOD_SKETCHES
+
+logger = logging.getLogger(__name__)
+
+# Bump when the payload layout changes, old payloads are then ignored.
+PAYLOAD_VERSION = 3
+
+# Periods with more events than this use a merged quantile sketch.
+SKETCH_THRESHOLD = getattr(
+    settings, 'LIZARD_WORKSPACE_SKETCH_THRESHOLD', 100000)
+# Maximum rank error of the sketches, as a fraction of the events.
+SKETCH_EPSILON = getattr(settings, 'LIZARD_WORKSPACE_SKETCH_EPSILON', 0.01)
+
+SPLIT_YEAR = 'year'
+SPLIT_SEASON = 'season'
+SPLIT_MONTH = 'month'
+SPLITS = (SPLIT_YEAR, SPLIT_SEASON, SPLIT_MONTH)
+
+HOURS = 24
+CELLS = 7 * HOURS
+MIN = 0
+MAX = 1
+
+
+def next_month(dt):
+    if dt.month == 12:
+        return datetime.datetime(dt.year + 1, 1, 1)
+    return datetime.datetime(dt.year, dt.month + 1, 1)
+
+
+def bucket_ranges(start, end):
+    """Return half open ranges (epoch microseconds) of the months in
+    the inclusive period start - end, clipped to the period. No
+    ranges if end is before start."""
+    if end < start:
+        return []
+    period_start = stats.datetime_to_epoch(start)
+    period_end = stats.datetime_to_epoch(end) + 1
+    ranges = []
+    month = datetime.datetime(start.year, start.month, 1)
+    while stats.datetime_to_epoch(month) < period_end:
+        following = next_month(month)
+        ranges.append((
+                max(period_start, stats.datetime_to_epoch(month)),
+                min(period_end, stats.datetime_to_epoch(following))))
+        month = following
+    return ranges
+
+
+def cell_mask(hours=None, weekday=None):
+    """Return boolean array of the cells within the period filter:
+    allowed hours (0-23) and day of week (0=monday), None for all."""
+    allowed_hours = np.ones(HOURS, dtype=np.bool_)
+    if hours is not None:
+        allowed_hours[:] = False
+        allowed_hours[list(hours)] = True
+    allowed_weekdays = np.ones(7, dtype=np.bool_)
+    if weekday is not None:
+        allowed_weekdays[:] = False
+        allowed_weekdays[weekday] = True
+    return (allowed_weekdays[:, np.newaxis] &
+            allowed_hours[np.newaxis, :]).ravel()
+
+
+class Bucket(object):
+    """
+    Partial aggregate of the events in a half open range (epoch
+    microseconds) within one calendar month.
+
+    - counts, sums: per cell (weekday * 24 + hour)
+    - values: all values, sorted by cell, then value (nan last)
+    - sizes, weights: for a sketched (merged) bucket the number of
+      values per cell and the weight of every value, else None
+    - boundary_counts: for a sketched bucket {boundary value: exact
+      number of values <= boundary value per cell}
+    - extreme_timestamps, extreme_values, extreme_flags: arrays of
+      shape (2, CELLS) with the MIN and MAX event of every cell
+    - extreme_comments: {(MIN or MAX, cell): comment}, if not None
+    """
+    def __init__(self, start, end, counts, sums, values,
+                 extreme_timestamps, extreme_values, extreme_flags,
+                 extreme_comments, tzinfo, sizes=None, weights=None,
+                 boundary_counts=None):
+        self.start = start
+        self.end = end
+        self.counts = counts
+        self.sums = sums
+        self.values = values
+        self.sizes = sizes
+        self.weights = weights
+        self.boundary_counts = boundary_counts or {}
+        self.extreme_timestamps = extreme_timestamps
+        self.extreme_values = extreme_values
+        self.extreme_flags = extreme_flags
+        self.extreme_comments = extreme_comments
+        self.tzinfo = tzinfo
+
+    @property
+    def month(self):
+        return stats.epoch_to_datetime(self.start).month
+
+    @property
+    def is_sketched(self):
+        return self.weights is not None
+
+    @classmethod
+    def from_arrays(cls, arrays, start, end):
+        """Aggregate the EventArrays, that must all be within start -
+        end."""
+        calendar = arrays.calendar
+        cells = calendar.weekday * HOURS + calendar.hour
+        values = arrays.values
+        counts = np.bincount(cells, minlength=CELLS)
+        sums = np.bincount(cells, weights=values, minlength=CELLS)
+        nan_counts = np.bincount(
+            cells[np.isnan(values)], minlength=CELLS)
+        firsts = np.cumsum(counts) - counts
+        # In both orders the nans come last within a cell, ties keep
+        # their time order. The extreme of a cell is its first event,
+        # or its first nan, like argmin/argmax.
+        offsets = firsts + np.where(nan_counts > 0, counts - nan_counts, 0)
+        in_use = counts > 0
+        order_min = np.lexsort((values, cells))
+        order_max = np.lexsort((-values, cells))
+
+        extreme_indices = np.zeros((2, CELLS), dtype=np.intp)
+        extreme_indices[MIN, in_use] = order_min[offsets[in_use]]
+        extreme_indices[MAX, in_use] = order_max[offsets[in_use]]
+        extreme_comments = {}
+        if arrays.comments:
+            for side in (MIN, MAX):
+                for cell in np.flatnonzero(in_use):
+                    comment = arrays.comments.get(
+                        int(extreme_indices[side, cell]))
+                    if comment is not None:
+                        extreme_comments[(side, int(cell))] = comment
+        if not len(arrays):
+            extreme_indices = np.zeros((2, 0), dtype=np.intp)
+        return cls(
+            start, end, counts.astype(np.int32), sums,
+            values[order_min],
+            arrays.timestamps[extreme_indices],
+            values[extreme_indices],
+            arrays.flags[extreme_indices],
+            extreme_comments, arrays.tzinfo)
+
+    @classmethod
+    def merge(cls, buckets):
+        """Return one exact Bucket with the events of the exact
+        buckets, from the start of the first to the end of the last."""
+        counts = np.zeros(CELLS, dtype=np.int32)
+        sums = np.zeros(CELLS)
+        for bucket in buckets:
+            counts += bucket.counts
+            sums += bucket.sums
+        cells = np.concatenate(
+            [np.empty(0, dtype=np.intp)] +
+            [np.repeat(np.arange(CELLS), bucket.counts)
+             for bucket in buckets])
+        values = np.concatenate(
+            [np.empty(0)] + [bucket.values for bucket in buckets])
+        extremes = [_merged_extremes(buckets, side) for side in (MIN, MAX)]
+        extreme_comments = extremes[MIN][3]
+        extreme_comments.update(extremes[MAX][3])
+        tzinfo = None
+        for bucket in buckets:
+            tzinfo = tzinfo or bucket.tzinfo
+        return cls(
+            buckets[0].start if buckets else 0,
+            buckets[-1].end if buckets else 0,
+            counts, sums, values[np.lexsort((values, cells))],
+            np.array([extremes[MIN][0], extremes[MAX][0]]),
+            np.array([extremes[MIN][1], extremes[MAX][1]]),
+            np.array([extremes[MIN][2], extremes[MAX][2]]),
+            extreme_comments, tzinfo)
+
+    def sketch(self, boundary_values=()):
+        """Replace the values by a quantile sketch per cell, keeping
+        the exact boundary counts for boundary_values. Nothing changes
+        when no cell has more than sketch.capacity values."""
+        max_size = sketch.capacity(SKETCH_EPSILON)
+        if not (self.counts > max_size).any():
+            return
+        cells = np.repeat(np.arange(CELLS), self.counts)
+        firsts = np.cumsum(self.counts) - self.counts
+        sketched_values = []
+        sketched_weights = []
+        sizes = np.zeros(CELLS, dtype=np.int32)
+        for cell in np.flatnonzero(self.counts):
+            cell_values, cell_weights = sketch.compact(
+                self.values[firsts[cell]:firsts[cell] + self.counts[cell]],
+                max_size)
+            sketched_values.append(cell_values)
+            sketched_weights.append(cell_weights)
+            sizes[cell] = len(cell_values)
+        self.boundary_counts = dict(
+            (boundary_value, np.bincount(
+                    cells[self.values <= boundary_value],
+                    minlength=CELLS).astype(np.int32))
+            for boundary_value in boundary_values)
+        self.values = np.concatenate(sketched_values)
+        self.weights = np.concatenate(sketched_weights)
+        self.sizes = sizes
+
+    def selected(self, mask):
+        """Return (values, weights) of the cells in mask, weights of an
+        exact bucket are all 1."""
+        if not self.is_sketched:
+            values = self.values[np.repeat(mask, self.counts)]
+            return values, np.ones(len(values), dtype=np.int64)
+        selection = np.repeat(mask, self.sizes)
+        return self.values[selection], self.weights[selection]
+
+    def amount_less_equal(self, boundary_value, mask):
+        """Return number of values <= boundary_value in the cells in
+        mask, approximate if not known exactly."""
+        if boundary_value in self.boundary_counts:
+            return int(self.boundary_counts[boundary_value][mask].sum())
+        values, weights = self.selected(mask)
+        return sketch.rank(values, weights, boundary_value)
+
+    def encode(self):
+        return (PAYLOAD_VERSION, (
+                self.start, self.end, self.counts, self.sums, self.values,
+                self.extreme_timestamps, self.extreme_values,
+                self.extreme_flags, self.extreme_comments, self.tzinfo,
+                self.sizes, self.weights, self.boundary_counts))
+
+    @classmethod
+    def decode(cls, payload):
+        """Return Bucket for payload, or None."""
+        try:
+            version, contents = payload
+        except (TypeError, ValueError):
+            return None
+        if version != PAYLOAD_VERSION:
+            return None
+        return cls(*contents)
+
+    def extremes(self, side, mask):
+        """Return (timestamps, values, flags, comments) of the side
+        (MIN or MAX) events of the cells in mask."""
+        cells = np.flatnonzero(mask & (self.counts > 0))
+        if not self.extreme_timestamps.shape[1]:
+            cells = cells[:0]
+        comments = [self.extreme_comments.get((side, int(cell)))
+                    for cell in cells]
+        return (self.extreme_timestamps[side, cells],
+                self.extreme_values[side, cells],
+                self.extreme_flags[side, cells],
+                comments)
+
+
+def _merged_extremes(buckets, side):
+    """Return (timestamps, values, flags, comments) of the side (MIN or
+    MAX) events of all cells of the buckets, with the same order as
+    _extreme_event."""
+    parts = [bucket for bucket in buckets
+             if bucket.extreme_timestamps.shape[1]]
+    if not parts:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0),
+                np.zeros(0, dtype=np.int16), {})
+    timestamps = np.array([part.extreme_timestamps[side] for part in parts])
+    values = np.array([part.extreme_values[side] for part in parts])
+    flags = np.array([part.extreme_flags[side] for part in parts])
+    unused = np.array([part.counts == 0 for part in parts])
+    is_nan = np.isnan(values)
+    ordered = np.where(is_nan, 0.0, values)
+    if side == MAX:
+        ordered = -ordered
+    # Per cell the index of the winning bucket.
+    choice = np.lexsort((timestamps, ordered, ~is_nan, unused), axis=0)[0]
+    cells = np.arange(CELLS)
+    comments = {}
+    for cell in np.flatnonzero(~unused[choice, cells]):
+        comment = parts[choice[cell]].extreme_comments.get((side, int(cell)))
+        if comment is not None:
+            comments[(side, int(cell))] = comment
+    return (timestamps[choice, cells], values[choice, cells],
+            flags[choice, cells], comments)
+
+
+def _extreme_event(buckets, side, mask):
+    """Return the first min (or max) event of the cells in mask of
+    all buckets, a nan wins like it does with argmin/argmax."""
+    parts = [bucket.extremes(side, mask) for bucket in buckets]
+    timestamps = np.concatenate([part[0] for part in parts])
+    values = np.concatenate([part[1] for part in parts])
+    flags = np.concatenate([part[2] for part in parts])
+    comments = sum([part[3] for part in parts], [])
+    is_nan = np.isnan(values)
+    ordered = np.where(is_nan, 0.0, values)
+    if side == MAX:
+        ordered = -ordered
+    index = np.lexsort((timestamps, ordered, ~is_nan))[0]
+    tzinfo = None
+    for bucket in buckets:
+        tzinfo = tzinfo or bucket.tzinfo
+    return (
+        stats.epoch_to_datetime(timestamps[index], tzinfo),
+        (None if is_nan[index] else float(values[index]),
+         None if flags[index] == stats.FLAG_NONE else int(flags[index]),
+         comments[index]))
+
+
+def calc_stats(buckets, months=None, hours=None, weekday=None,
+               boundary_value=None, percentile_value=None):
+    """Return stats.values_stats result for the events in the buckets
+    within the period filter: allowed months (1-12), see cell_mask for
+    hours and weekday.
+
+    Percentiles (and boundary counts) are approximate if one of the
+    buckets is sketched, the rest is always exact. See period_stats.
+    """
+    mask = cell_mask(hours=hours, weekday=weekday)
+    if months is not None:
+        buckets = [bucket for bucket in buckets if bucket.month in months]
+    weights = None
+    amount_less_equal = None
+    if any(bucket.is_sketched for bucket in buckets):
+        selected = [bucket.selected(mask) for bucket in buckets]
+        values = np.concatenate([part[0] for part in selected])
+        weights = np.concatenate([part[1] for part in selected])
+        if boundary_value is not None:
+            amount_less_equal = sum(
+                bucket.amount_less_equal(boundary_value, mask)
+                for bucket in buckets)
+    else:
+        values = np.concatenate(
+            [np.empty(0)] +
+            [bucket.values[np.repeat(mask, bucket.counts)]
+             for bucket in buckets])
+    if not len(values):
+        return stats.values_stats(values, boundary_value=boundary_value)
+    return stats.values_stats(
+        values, boundary_value=boundary_value,
+        percentile_value=percentile_value,
+        values_sum=float(sum(bucket.sums[mask].sum()
+                             for bucket in buckets)),
+        min_event=_extreme_event(buckets, MIN, mask),
+        max_event=_extreme_event(buckets, MAX, mask),
+        weights=weights, amount_less_equal=amount_less_equal)
+
+
+def split_keys(buckets, split):
+    """Return an array with the sub-period key of each bucket, in
+    chronological order of the sub-periods.
+
+    - 'year': calendar year
+    - 'season': summer (april - september) and winter (october -
+      march) as in LayerCollage.SUMMER_WINTER_CHOICES
+    - 'month': calendar month
+    """
+    calendar = stats.calendar_fields(
+        np.array([bucket.start for bucket in buckets], dtype=np.int64))
+    if split == SPLIT_YEAR:
+        return calendar.year
+    if split == SPLIT_MONTH:
+        return calendar.year * 12 + calendar.month - 1
+    if split == SPLIT_SEASON:
+        # A winter belongs to the year in which it starts.
+        summer = (calendar.month >= 4) & (calendar.month <= 9)
+        year = calendar.year - (calendar.month <= 3)
+        return year * 2 + np.where(summer, 0, 1)
+    raise ValueError('Unknown split %r' % split)
+
+
+def split_label(key, split):
+    """Return a readable label of a split_keys key."""
+    key = int(key)
+    if split == SPLIT_MONTH:
+        return '%04d-%02d' % (key // 12, key % 12 + 1)
+    if split == SPLIT_SEASON:
+        year, winter = divmod(key, 2)
+        if winter:
+            return 'winter %d-%d' % (year, year + 1)
+        return 'zomer %d' % year
+    return '%d' % key
+
+
+def split_stats(buckets, split, **kwargs):
+    """Return [(label, calc_stats result)] for every sub-period
+    (see split_keys) of the buckets, in chronological order.
+
+    Buckets never cross a month, so every bucket belongs to exactly
+    one sub-period and the events are only scanned once. kwargs are
+    passed to calc_stats.
+    """
+    if not buckets:
+        return []
+    keys = split_keys(buckets, split)
+    unique_keys, groups = np.unique(keys, return_inverse=True)
+    return [(split_label(key, split),
+             calc_stats([buckets[i] for i in np.flatnonzero(groups == index)],
+                        **kwargs))
+            for index, key in enumerate(unique_keys)]
+
+
+def bucket_key(identifier, bucket_range):
+    return PARTIAL_AGGREGATES.key(identifier, bucket_range[0], bucket_range[1])
+
+
+def cached_buckets(identifier, ranges):
+    """Return {range: Bucket} for the ranges that are in the cache."""
+    keys = dict((bucket_key(identifier, bucket_range), bucket_range)
+                for bucket_range in ranges)
+    result = {}
+    for key, payload in PARTIAL_AGGREGATES.get_many(keys.keys()).items():
+        bucket = Bucket.decode(payload)
+        if bucket is not None:
+            result[keys[key]] = bucket
+    return result
+
+
+def nothing_cached(identifier, start, end):
+    """Return True if none of the buckets for the period are cached,
+    so period_buckets will use the time series of the whole
+    period. Only checks the keys, the buckets are not decoded."""
+    return not PARTIAL_AGGREGATES.cached_keys(
+        [bucket_key(identifier, bucket_range)
+         for bucket_range in bucket_ranges(start, end)])
+
+
+def _spans(ranges):
+    """Join adjacent ranges."""
+    spans = []
+    for range_start, range_end in ranges:
+        if spans and spans[-1][1] == range_start:
+            spans[-1] = (spans[-1][0], range_end)
+        else:
+            spans.append((range_start, range_end))
+    return spans
+
+
+def period_buckets(identifier, start, end, now=None, cache_time_series=True):
+    """Return the Buckets for the period, or None if the identifier
+    has no time series in the period or more than one.
+
+    Missing buckets are fetched with a query per span of adjacent
+    missing months; when the whole period is missing the (prefetched)
+    time series cache is used, unless cache_time_series is False. A
+    span without events (the series stopped, or did not start yet)
+    gets empty buckets.
+    """
+    if now is None:
+        now = datetime.datetime.now()
+    ranges = bucket_ranges(start, end)
+    buckets = cached_buckets(identifier, ranges)
+    missing = [bucket_range for bucket_range in ranges
+               if bucket_range not in buckets]
+    complete_before = stats.datetime_to_epoch(now)
+
+    # Cached buckets were made from the one time series.
+    found = bool(buckets)
+    new_buckets = {}
+    for span_start, span_end in _spans(missing):
+        if (cache_time_series and
+            span_start == ranges[0][0] and span_end == ranges[-1][1]):
+            time_series = fetch.cached_time_series(identifier, start, end)
+        else:
+            time_series = fetch.time_series(
+                identifier, stats.epoch_to_datetime(span_start),
+                stats.epoch_to_datetime(span_end - 1))
+        # Assume there is only 1, else do not calculate stats.
+        if len(time_series) > 1:
+            logger.warning(
+                'Multiple time series found for identifier=%r, '
+                'skipped stats' % identifier)
+            return None
+        if time_series:
+            found = True
+            arrays = time_series.values()[0]
+        else:
+            arrays = stats.EventArrays.from_events([])
+        for bucket_range in missing:
+            if not span_start <= bucket_range[0] < span_end:
+                continue
+            first, last = np.searchsorted(arrays.timestamps, bucket_range)
+            new_buckets[bucket_range] = Bucket.from_arrays(
+                arrays.take(np.arange(first, last)), *bucket_range)
+    if not found:
+        logger.debug('No time series found for identifier=%r' % identifier)
+        return None
+
+    for bucket_range, bucket in new_buckets.items():
+        buckets[bucket_range] = bucket
+        if bucket_range[1] <= complete_before:
+            PARTIAL_AGGREGATES.set(
+                bucket_key(identifier, bucket_range), bucket.encode())
+    return [buckets[bucket_range] for bucket_range in ranges]
+
+
+def period_stats(identifier, start, end, months=None, hours=None,
+                 weekday=None, boundary_value=None, percentile_value=None,
+                 now=None):
+    """Return calc_stats result for the period and period filter, or
+    None (see period_buckets).
+
+    Above SKETCH_THRESHOLD events in the selected months the buckets
+    are merged into one sketched bucket, that is cached when the
+    period ended before now.
+    """
+    if now is None:
+        now = datetime.datetime.now()
+    ranges = bucket_ranges(start, end)
+    if not ranges:
+        # End before start.
+        return calc_stats([], boundary_value=boundary_value)
+    complete = ranges[-1][1] <= stats.datetime_to_epoch(now)
+    key = PERIOD_SKETCHES.key(
+        identifier, ranges[0][0], ranges[-1][1], months, boundary_value)
+    merged = None
+    if complete:
+        merged = Bucket.decode(PERIOD_SKETCHES.get(key))
+    if merged is None:
+        buckets = period_buckets(identifier, start, end, now=now)
+        if buckets is None:
+            return None
+        if months is not None:
+            buckets = [bucket for bucket in buckets
+                       if bucket.month in months]
+        if sum(int(bucket.counts.sum()) for bucket in buckets) <= (
+            SKETCH_THRESHOLD):
+            return calc_stats(
+                buckets, hours=hours, weekday=weekday,
+                boundary_value=boundary_value,
+                percentile_value=percentile_value)
+        merged = Bucket.merge(buckets)
+        merged.sketch(boundary_values=[boundary_value]
+                      if boundary_value is not None else [])
+        if complete:
+            PERIOD_SKETCHES.set(key, merged.encode())
+    return calc_stats(
+        [merged], hours=hours, weekday=weekday,
+        boundary_value=boundary_value, percentile_value=percentile_value)
@@ -0,0 +1,75 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Mergeable quantile sketches for very long time series.
+
+A sketch is a pair of arrays (values, weights): every value stands
+for `weight` original values. Compacting works like a KLL compactor:
+the values of the lowest weight are sorted, and of every pair only
+one is kept, with double weight. One compaction of weight w changes
+the rank of any value by at most w. Values of one weight are
+compacted at most once, so with `capacity(epsilon)` values left the
+rank error is at most epsilon times the number of original values.
+
+Sketches are merged by concatenating them, the bound holds for the
+merged sketch too. A sketch of values that were never compacted
+(all weights 1) gives exact answers.
+"""
+import math
+
+import numpy as np
+
+
+def capacity(epsilon):
+    """Return number of values to keep for rank error epsilon."""
+    return max(2, int(math.ceil(4.0 / epsilon)))
+
+
+def compact(values, max_size):
+    """Return sketch (values, weights) of at most max_size values,
+    sorted by value (nan last)."""
+    values = np.sort(values)
+    weights = np.ones(len(values), dtype=np.int64)
+    offset = 0
+    while len(values) > max_size:
+        # The lowest weight (a power of two) with at least a pair of
+        # values.
+        sizes = np.bincount(np.log2(weights).astype(np.intp))
+        candidates = np.flatnonzero(sizes >= 2)
+        if not len(candidates):
+            break
+        weight = 2 ** int(candidates[0])
+        level = weights == weight
+        compacted = values[level]
+        rest_values = values[~level]
+        rest_weights = weights[~level]
+        if len(compacted) % 2:
+            # The odd one out is kept as is.
+            rest_values = np.append(rest_values, compacted[-1])
+            rest_weights = np.append(rest_weights, weight)
+            compacted = compacted[:-1]
+        # Alternate between keeping the lower and the upper value of
+        # each pair, so the errors of the levels do not add up.
+        compacted = compacted[offset::2]
+        offset = 1 - offset
+        values = np.concatenate([rest_values, compacted])
+        weights = np.concatenate([
+                rest_weights,
+                np.repeat(np.int64(2 * weight), len(compacted))])
+        order = np.argsort(values, kind='mergesort')
+        values = values[order]
+        weights = weights[order]
+    return values, weights
+
+
+def rank(values, weights, value):
+    """Return (approximate) number of original values <= value."""
+    return int(weights[values <= value].sum())
+
+
+def at_ranks(values, weights, indices):
+    """Return the values at the given indices in the sorted original
+    values, like sorted(original)[index]."""
+    order = np.argsort(values, kind='mergesort')
+    cumulative = np.cumsum(weights[order])
+    positions = np.searchsorted(cumulative, indices, side='right')
+    return values[order][positions]
@@ -0,0 +1,297 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Statistics on time series events for collage items.
+
+Events come from timeseries' get_events as a list of (datetime,
+(value, flag, comment)). Walking that list in python for every
+statistic is slow for long series, so the events are converted once
+into columnar numpy arrays (EventArrays) and everything is computed
+on those.
+
+Collage statistics are computed from per-month partial aggregates
+(see lizard_workspace.partials), which use the calendar fields and
+values_stats of this module.
+"""
+import datetime
+import json
+
+import numpy as np
+
+from lizard_workspace import sketch
+
+# Timestamps are stored as wall clock microseconds since EPOCH.
+EPOCH = datetime.datetime(1970, 1, 1)
+# Stored in the flags array when an event has no flag.
+FLAG_NONE = -1
+
+MICROSECONDS_PER_HOUR = 3600 * 1000000
+MICROSECONDS_PER_DAY = 24 * MICROSECONDS_PER_HOUR
+
+
+def datetime_to_epoch(dt):
+    """Return wall clock microseconds since EPOCH, ignoring tzinfo."""
+    delta = dt.replace(tzinfo=None) - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def epoch_to_datetime(microseconds, tzinfo=None):
+    """Inverse of datetime_to_epoch."""
+    dt = EPOCH + datetime.timedelta(microseconds=int(microseconds))
+    if tzinfo is not None:
+        dt = dt.replace(tzinfo=tzinfo)
+    return dt
+
+
+class EventArrays(object):
+    """
+    Events of a single time series in columnar form.
+
+    - timestamps: int64 wall clock microseconds since EPOCH, sorted
+    - values: float64, None becomes nan
+    - flags: small signed ints, None becomes FLAG_NONE
+    - comments: sparse dict {index: comment}, only comments that are
+      not None
+    - tzinfo: tzinfo of the original datetimes (they share one)
+    """
+    def __init__(self, timestamps, values, flags, comments=None,
+                 tzinfo=None):
+        self.timestamps = timestamps
+        self.values = values
+        self.flags = flags
+        self.comments = comments or {}
+        self.tzinfo = tzinfo
+        self._calendar = None
+
+    @classmethod
+    def from_events(cls, events):
+        """Convert list of (datetime, (value, flag, comment))."""
+        count = len(events)
+        timestamps = np.empty(count, dtype=np.int64)
+        values = np.empty(count, dtype=np.float64)
+        flags = np.empty(count, dtype=np.int16)
+        comments = {}
+        tzinfo = None
+        for index, (dt, (value, flag, comment)) in enumerate(events):
+            timestamps[index] = datetime_to_epoch(dt)
+            values[index] = np.nan if value is None else value
+            flags[index] = FLAG_NONE if flag is None else int(flag)
+            if comment is not None:
+                comments[index] = comment
+            if tzinfo is None:
+                tzinfo = dt.tzinfo
+        result = cls(timestamps, values, flags, comments, tzinfo)
+        if count > 1 and (np.diff(timestamps) < 0).any():
+            result = result.take(np.argsort(timestamps, kind='mergesort'))
+        return result
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def datetime(self, index):
+        return epoch_to_datetime(self.timestamps[index], self.tzinfo)
+
+    def event(self, index):
+        """Return event in get_events form:
+
+        (datetime, (value, flag, comment))"""
+        value = self.values[index]
+        flag = self.flags[index]
+        return (
+            self.datetime(index),
+            (None if np.isnan(value) else float(value),
+             None if flag == FLAG_NONE else int(flag),
+             self.comments.get(int(index))))
+
+    @property
+    def calendar(self):
+        """Calendar, see calendar_fields. Computed once."""
+        if self._calendar is None:
+            self._calendar = calendar_fields(self.timestamps)
+        return self._calendar
+
+    def take(self, indices):
+        """Return new EventArrays with only the given indices (or
+        boolean mask)."""
+        indices = np.asarray(indices)
+        if indices.dtype == np.bool_:
+            indices = np.flatnonzero(indices)
+        else:
+            indices = indices.astype(np.intp)
+        comments = {}
+        if self.comments:
+            for new_index, old_index in enumerate(indices):
+                comment = self.comments.get(int(old_index))
+                if comment is not None:
+                    comments[new_index] = comment
+        return EventArrays(
+            self.timestamps[indices], self.values[indices],
+            self.flags[indices], comments, self.tzinfo)
+
+
+class Calendar(object):
+    """int arrays year, month (1-12), hour (0-23) and weekday
+    (0=monday) for an array of timestamps."""
+    def __init__(self, year, month, hour, weekday):
+        self.year = year
+        self.month = month
+        self.hour = hour
+        self.weekday = weekday
+
+
+def calendar_fields(timestamps):
+    """Return Calendar for wall clock microseconds since EPOCH.
+
+    Uses the days-to-civil algorithm on whole arrays instead of
+    creating a datetime per timestamp.
+    """
+    days = timestamps // MICROSECONDS_PER_DAY
+    hour = (timestamps // MICROSECONDS_PER_HOUR) % 24
+    # 1970-01-01 was a thursday.
+    weekday = (days + 3) % 7
+
+    # Shift to eras of 400 years starting at 0000-03-01.
+    z = days + 719468
+    era = z // 146097
+    day_of_era = z - era * 146097
+    year_of_era = (day_of_era - day_of_era // 1460 + day_of_era // 36524 -
+                   day_of_era // 146096) // 365
+    day_of_year = day_of_era - (
+        365 * year_of_era + year_of_era // 4 - year_of_era // 100)
+    shifted_month = (5 * day_of_year + 2) // 153  # 0 = march
+    month = np.where(shifted_month < 10, shifted_month + 3, shifted_month - 9)
+    year = year_of_era + era * 400 + (month <= 2)
+    return Calendar(year, month, hour, weekday)
+
+
+def percentile_index(percentile, count):
+    """Return index into sorted values for percentile, or None.
+
+    Same rule as the original list based implementation:
+    sorted_items[int(percentile * count / 100)], where an index that
+    is out of range (or a missing percentile) yields None.
+    """
+    try:
+        index = int(percentile * count / 100.0)
+    except (TypeError, ValueError):
+        return None
+    if index < -count or index >= count:
+        return None
+    return index % count
+
+
+def values_stats(values, boundary_value=None, percentile_value=None,
+                 values_sum=None, min_event=None, max_event=None,
+                 weights=None, amount_less_equal=None):
+    """Return statistics for the values, in any order, as a dict in
+    the fixed structure of LayerCollageItem.info_stats.
+
+    The sum and the min and max events (the first occurrence) must be
+    given if there are values.
+
+    values and weights can be a quantile sketch (see
+    lizard_workspace.sketch), the percentiles are then approximate.
+    So is the boundary count, unless amount_less_equal is given.
+    """
+    result = {}
+    if weights is None:
+        count = len(values)
+    else:
+        count = int(weights.sum())
+
+    if boundary_value is not None:
+        if amount_less_equal is not None:
+            pass
+        elif weights is None:
+            amount_less_equal = int(
+                np.count_nonzero(values <= boundary_value))
+        else:
+            amount_less_equal = sketch.rank(values, weights, boundary_value)
+        result['boundary'] = {
+            'amount_less_equal': amount_less_equal,
+            'amount_greater': count - amount_less_equal,
+            'value': boundary_value}
+
+    result['item_count'] = count
+    if not count:
+        return result
+
+    result['standard'] = {
+        'min': min_event,
+        'max': max_event,
+        'sum': values_sum,
+        'avg': values_sum / count,
+        }
+
+    # Calc percentiles, using partition instead of a full sort.
+    median_index = 50 * count // 100
+    index_90 = 90 * count // 100
+    user_index = percentile_index(percentile_value, count)
+    kth = set([median_index, index_90])
+    if user_index is not None:
+        kth.add(user_index)
+    kth = sorted(kth)
+    if weights is None:
+        ranked = dict(zip(kth, np.partition(values, kth)[kth]))
+    else:
+        ranked = dict(zip(kth, sketch.at_ranks(values, weights, kth)))
+    result['percentile'] = {
+        'value': percentile_value,
+        'median': float(ranked[median_index]),
+        '90': float(ranked[index_90]),
+        'user': (None if user_index is None
+                 else float(ranked[user_index])),
+        }
+    return result
+
+
+class FixedOffset(datetime.tzinfo):
+    """Fixed offset in minutes east from UTC."""
+    def __init__(self, minutes):
+        self._offset = datetime.timedelta(minutes=minutes)
+
+    def utcoffset(self, dt):
+        return self._offset
+
+    def dst(self, dt):
+        return datetime.timedelta(0)
+
+    def tzname(self, dt):
+        return None
+
+
+def _stats_default(obj):
+    if isinstance(obj, datetime.datetime):
+        offset = obj.utcoffset()
+        return {'__datetime__': obj.replace(tzinfo=None).isoformat(),
+                'offset': (None if offset is None
+                           else offset.days * 1440 + offset.seconds // 60)}
+    raise TypeError('%r is not JSON serializable' % obj)
+
+
+def _stats_object_hook(obj):
+    if '__datetime__' in obj:
+        text = obj['__datetime__']
+        if '.' not in text:
+            text += '.000000'
+        dt = datetime.datetime.strptime(text, '%Y-%m-%dT%H:%M:%S.%f')
+        if obj['offset'] is not None:
+            dt = dt.replace(tzinfo=FixedOffset(obj['offset']))
+        return dt
+    return obj
+
+
+def dumps_stats(result):
+    """Return json for a values_stats / info_stats result."""
+    return json.dumps(result, default=_stats_default)
+
+
+def loads_stats(text):
+    """Inverse of dumps_stats. min and max are events again:
+    (datetime, (value, flag, comment))."""
+    result = json.loads(text, object_hook=_stats_object_hook)
+    standard = result.get('standard') or {}
+    for key in ('min', 'max'):
+        if standard.get(key) is not None:
+            dt, (value, flag, comment) = standard[key]
+            standard[key] = (dt, (value, flag, comment))
+    return result
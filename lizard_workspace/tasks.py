@@ -1,14 +1,21 @@
 # Celery tasks
 import logging
 import datetime
+from celery.task import periodic_task
 from celery.task import task
 from lizard_task.task import task_logging
 from copy import deepcopy
+from django.conf import settings
 from django.template.defaultfilters import slugify
 from django.utils import simplejson
 from owslib.wms import WebMapService
 
 from lizard_task.handler import get_handler
+from lizard_workspace.collagestats import compute_stats
+from lizard_workspace.collagestats import run_job
+from lizard_workspace.collagestats import warm_collage_stats
+from lizard_workspace import layertree
+from lizard_workspace.layertree import defer_invalidation
 from lizard_workspace.models import Layer
 from lizard_workspace.models import Tag
 from lizard_workspace.models import LayerCollage
@@ -18,13 +25,20 @@ from lizard_workspace.models import SyncTask
 from lizard_layers.models import ServerMapping
 from lizard_workspace.models import LayerWorkspaceItem
 from lizard_workspace.models import LayerWorkspace
+from lizard_workspace.models import LayerCollageItemStats
+from lizard_workspace.models import STORED_STATS_MAX_AGE
+from lizard_workspace.models import STORED_STATS_READ_MAX_AGE
 
 
 LOGGER_NAME = 'lizard_workspace_tasks'
 logger = logging.getLogger(LOGGER_NAME)
 
+# Seconds between two runs of warm_collage_caches.
+WARM_INTERVAL = getattr(settings, 'LIZARD_WORKSPACE_WARM_INTERVAL', 3600)
+
 
 @task
+@defer_invalidation
 def sync_layers_ekr(slug='vss_area_value',
                     username=None,
                     taskname=None,
@@ -145,6 +159,7 @@ def sync_layers_ekr(slug='vss_area_value',
 
 
 @task
+@defer_invalidation
 def sync_layers_fewsnorm(slug='vss_fews_locations',
                          username=None,
                          taskname=None,
@@ -248,6 +263,7 @@ def sync_layers_fewsnorm(slug='vss_fews_locations',
 
 
 @task
+@defer_invalidation
 def sync_layers_measure(slug='vss_measure',
                         username=None,
                         taskname=None,
@@ -358,6 +374,7 @@ def sync_layers_measure(slug='vss_measure',
 
 
 @task
+@defer_invalidation
 def sync_layers_track(slug='vss_track_records',
                       username=None,
                       taskname=None,
@@ -575,6 +592,7 @@ def perform_sync_task(task):
 
 
 @task
+@defer_invalidation
 def sync_layers_with_wmsserver(synctask=None,
                                all=False,
                                username=None,
@@ -609,6 +627,7 @@ def sync_layers_with_wmsserver(synctask=None,
 
 
 @task
+@defer_invalidation
 def workspace_update_baselayers(username=None, taskname=None, loglevel=20):
     """
     Reconfigure layers that have is_base_layer=True
@@ -638,6 +657,8 @@ def workspace_update_baselayers(username=None, taskname=None, loglevel=20):
     ).exclude(
         pk=osm.pk,
     ).update(is_base_layer=False)
+    # Sends no signals.
+    layertree.invalidate()
 
     # Remove old baselayer(s) for the top10nl if it exists
     Layer.objects.filter(slug=TOP10NL_LAYER_SLUG).delete()
@@ -683,6 +704,7 @@ def workspace_update_baselayers(username=None, taskname=None, loglevel=20):
 
 
 @task
+@defer_invalidation
 def workspace_update_watersystem(username=None, taskname=None, loglevel=20):
     """
     Reconfigure layers for the watersystem map.
@@ -860,6 +882,7 @@ def workspace_update_watersystem(username=None, taskname=None, loglevel=20):
 
 
 @task
+@defer_invalidation
 def workspace_update_trackrecords(username=None, taskname=None, loglevel=20):
     """
     Create or replace trackrecordslayers in correct workspace
@@ -978,6 +1001,7 @@ def _create_single_layer_workspace(
 
 
 @task
+@defer_invalidation
 def workspace_update_minimap(username=None, taskname=None, loglevel=20):
     """
     Add an area layer with a special style.
@@ -1029,6 +1053,7 @@ def workspace_update_minimap(username=None, taskname=None, loglevel=20):
 
 @task
 @task_logging
+@defer_invalidation
 def workspace_update_thememaps(username=None, taskname=None, loglevel=20):
     """
     Add an area layer with a special style.
@@ -1059,6 +1084,8 @@ def workspace_update_thememaps(username=None, taskname=None, loglevel=20):
         ).update(
             name=new_name,
         )
+    # Sends no signals.
+    layertree.invalidate()
     logger.info('Renamed %s layers', count_updated)
 
     return 'OK'
@@ -1066,6 +1093,7 @@ def workspace_update_thememaps(username=None, taskname=None, loglevel=20):
 
 @task
 @task_logging
+@defer_invalidation
 def workspace_update_measure(username=None, taskname=None, loglevel=20):
     """
     Create / update LayerWorkspace thema_kaart_maatregelen with
@@ -1125,3 +1153,74 @@ def cleanup_temp_collages(username=None, taskname=None, loglevel=20):
 
     collages.delete()
     logger.info('done')
+
+
+@periodic_task(run_every=datetime.timedelta(seconds=STORED_STATS_MAX_AGE))
+@task_logging
+def refresh_collage_stats(username=None, taskname=None, loglevel=20):
+    """
+    Refresh stale LayerCollageItemStats of non-temp collages.
+
+    Only rows that were read in the last STORED_STATS_READ_MAX_AGE
+    seconds are refreshed, the others are removed. Rows computed with
+    settings that are no longer current, and rows of temp collages,
+    are removed as well.
+    """
+    logger = logging.getLogger(taskname)
+    now = datetime.datetime.now()
+    expiration_date = now - datetime.timedelta(seconds=STORED_STATS_MAX_AGE)
+    read_after = now - datetime.timedelta(seconds=STORED_STATS_READ_MAX_AGE)
+    unread = LayerCollageItemStats.objects.filter(
+        timestamp_read__lt=read_after)
+    removed = unread.count()
+    unread.delete()
+    rows = LayerCollageItemStats.objects.filter(
+        timestamp_computed__lt=expiration_date,
+        timestamp_read__gte=read_after).select_related(
+        'collage_item', 'collage_item__layer_collage')
+    logger.info('stale collage stats: %d, unread: %d' % (
+            rows.count(), removed))
+
+    by_period = {}
+    for row in rows:
+        collage_item = row.collage_item
+        if (collage_item.layer_collage.is_temp or
+            not row.matches(collage_item)):
+            row.delete()
+            removed += 1
+            continue
+        by_period.setdefault(
+            (row.period_start, row.period_end), {})[
+            collage_item.id] = collage_item
+
+    refreshed = 0
+    for (start, end), collage_items in by_period.items():
+        for result in compute_stats(collage_items.values(), start, end):
+            if not result.get('error'):
+                refreshed += 1
+    logger.info('refreshed %d, removed %d' % (refreshed, removed))
+    return 'OK'
+
+
+@task
+def collage_stats_job(job_id):
+    """
+    Compute the statistics of a collage for the API, see
+    collagestats.new_job.
+    """
+    return run_job(job_id)
+
+
+@periodic_task(run_every=datetime.timedelta(seconds=WARM_INTERVAL))
+@task_logging
+def warm_collage_caches(username=None, taskname=None, loglevel=20,
+                        periods=None, threads=None):
+    """
+    Fill the caches of the non-temp collages for the standard periods,
+    see collagestats.warm_collage_stats.
+    """
+    logger = logging.getLogger(taskname)
+    timings = warm_collage_stats(
+        periods=periods, threads=threads, logger=logger)
+    return 'OK, warmed %d collages in %.1f s' % (
+        len(timings), sum(timing[4] for timing in timings))
@@ -1,9 +1,1129 @@
 # (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+import csv
+import datetime
+import json
+import shutil
+import tempfile
+import time
 
+import numpy as np
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.http import Http404
+from django.http import HttpResponse
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.views.generic import View
+
+from lizard_workspace import cachekeys
+from lizard_workspace import collagestats
+from lizard_workspace import diskcache
+from lizard_workspace import fetch
+from lizard_workspace import layersearch
+from lizard_workspace import layertree
+from lizard_workspace import partials
+from lizard_workspace import sketch
+from lizard_workspace import stats
+from lizard_workspace import tscache
+from lizard_workspace.api import views as api_views
+from lizard_workspace.management.commands import benchmark_layer_search
+from lizard_workspace.models import Layer
+from lizard_workspace.models import LayerCollage
+from lizard_workspace.models import LayerCollageItem
+from lizard_workspace.models import LayerCollageItemStats
+from lizard_workspace.models import LayerFolder
+from lizard_workspace.models import LayerFolderMembership
+from lizard_workspace.models import LayerFolderTree
+from lizard_workspace.models import Tag
+from lizard_workspace.views import COLLAGE_HEADER
+from lizard_workspace.views import CollageContext
+from lizard_workspace.views import CollageView
+from lizard_workspace.views import save_xls
+
+
+def _events(values, start=datetime.datetime(2012, 1, 1),
+            step=datetime.timedelta(hours=1)):
+    return [(start + i * step, (value, 0, None))
+            for i, value in enumerate(values)]
+
+
+# Statistics computed directly from the events: the exact reference
+# that the partial aggregates (and sketches) are compared with.
+
+def between(arrays, start=None, end=None):
+    """Return events with start <= timestamp <= end, like
+    get_events(start_date=start, end_date=end)."""
+    first, last = 0, len(arrays)
+    if start is not None:
+        first = np.searchsorted(
+            arrays.timestamps, stats.datetime_to_epoch(start), side='left')
+    if end is not None:
+        last = np.searchsorted(
+            arrays.timestamps, stats.datetime_to_epoch(end), side='right')
+    return arrays.take(np.arange(first, last))
+
+
+def filter_period(arrays, months=None, hours=None, weekday=None):
+    """Return EventArrays with only the events in the calendar period,
+    arrays itself is not changed."""
+    calendar = arrays.calendar
+    mask = np.ones(len(arrays), dtype=np.bool_)
+    if months is not None:
+        mask &= np.in1d(calendar.month, list(months))
+    if hours is not None:
+        mask &= np.in1d(calendar.hour, list(hours))
+    if weekday is not None:
+        mask &= calendar.weekday == weekday
+    return arrays.take(mask)
+
+
+def calc_stats(arrays, boundary_value=None, percentile_value=None):
+    """Return info_stats result for EventArrays."""
+    values = arrays.values
+    if not len(arrays):
+        return stats.values_stats(values, boundary_value=boundary_value)
+    # argmin/argmax return the first occurrence.
+    return stats.values_stats(
+        values, boundary_value=boundary_value,
+        percentile_value=percentile_value,
+        values_sum=float(values.sum()),
+        min_event=arrays.event(int(values.argmin())),
+        max_event=arrays.event(int(values.argmax())))
 
 
 class ExampleTest(TestCase):
 
     def test_something(self):
         self.assertEquals(1, 1)
+
+
+class StatsTest(TestCase):
+
+    def test_empty(self):
+        arrays = stats.EventArrays.from_events([])
+        result = calc_stats(arrays, boundary_value=1.0)
+        self.assertEquals(result['item_count'], 0)
+        self.assertEquals(result['boundary']['amount_less_equal'], 0)
+        self.assertFalse('standard' in result)
+
+    def test_standard(self):
+        events = _events([3.0, 1.0, 5.0, 1.0, 5.0])
+        result = calc_stats(stats.EventArrays.from_events(events))
+        self.assertEquals(result['item_count'], 5)
+        # First occurrence of min and max, as full events.
+        self.assertEquals(result['standard']['min'], events[1])
+        self.assertEquals(result['standard']['max'], events[2])
+        self.assertEquals(result['standard']['sum'], 15.0)
+        self.assertEquals(result['standard']['avg'], 3.0)
+
+    def test_boundary(self):
+        arrays = stats.EventArrays.from_events(_events([1.0, 2.0, 3.0]))
+        result = calc_stats(arrays, boundary_value=2.0)
+        self.assertEquals(result['boundary']['amount_less_equal'], 2)
+        self.assertEquals(result['boundary']['amount_greater'], 1)
+
+    def test_percentiles(self):
+        arrays = stats.EventArrays.from_events(
+            _events([float(v) for v in range(100, 0, -1)]))
+        result = calc_stats(arrays, percentile_value=25.0)
+        self.assertEquals(result['percentile']['median'], 51.0)
+        self.assertEquals(result['percentile']['90'], 91.0)
+        self.assertEquals(result['percentile']['user'], 26.0)
+
+    def test_dumps_loads(self):
+        arrays = stats.EventArrays.from_events(_events([3.0, 1.0, 5.0]))
+        result = calc_stats(arrays, boundary_value=2.0)
+        self.assertEquals(stats.loads_stats(stats.dumps_stats(result)),
+                          result)
+
+    def test_invalid_percentile(self):
+        arrays = stats.EventArrays.from_events(_events([1.0, 2.0]))
+        result = calc_stats(arrays, percentile_value=100.0)
+        self.assertEquals(result['percentile']['user'], None)
+
+
+class CacheKeysTest(TestCase):
+
+    def test_canonical(self):
+        start = datetime.datetime(2012, 1, 1)
+        family = cachekeys.CacheFamily('test')
+        self.assertEquals(
+            family.key({'a': 1, 'b': None}, start),
+            family.key({'b': None, 'a': 1}, start))
+        self.assertNotEquals(
+            family.key({'a': 1}, start),
+            family.key({'a': 2}, start))
+
+    def test_bump_namespace_version(self):
+        family = cachekeys.CacheFamily('test')
+        key = family.key('x')
+        cachekeys.bump_namespace_version()
+        self.assertNotEquals(family.key('x'), key)
+
+    def test_counters(self):
+        family = cachekeys.CacheFamily('test_counters')
+        key = family.key('x')
+        family.get(key)
+        family.set(key, 1)
+        family.get(key)
+        self.assertEquals(cachekeys.counters()['test_counters'],
+                          {'hits': 1, 'misses': 1})
+
+    def test_compress(self):
+        family = cachekeys.CacheFamily('test_compress', compress=True)
+        small = {'a': 1}
+        large = range(100000)
+        self.assertEquals(family.encode(small)[0], cachekeys.PICKLED)
+        self.assertEquals(family.encode(large)[0], cachekeys.COMPRESSED)
+        self.assertEquals(family.decode(family.encode(large)), large)
+        # Values of older versions are returned as they are.
+        self.assertEquals(family.decode((1, 'old')), (1, 'old'))
+        metrics = cachekeys.metrics()['test_compress']
+        self.assertEquals(metrics['encoded'], 3)
+        self.assertEquals(metrics['compressed'], 2)
+        self.assertTrue(metrics['stored_bytes'] < metrics['raw_bytes'])
+
+
+class FetchPlanTest(TestCase):
+
+    def test_plan_fetches(self):
+        identifiers = [
+            {'fews_norm_source_slug': 'hhnk', 'geo_ident': 'a',
+             'par_ident': 'Cl', 'qua_ident': None},
+            {'fews_norm_source_slug': 'hhnk', 'geo_ident': 'b',
+             'par_ident': 'Cl', 'qua_ident': None},
+            {'fews_norm_source_slug': 'hhnk', 'geo_ident': 'a',
+             'par_ident': 'P'},
+            {'fews_norm_source_slug': 'other', 'geo_ident': 'a',
+             'par_ident': 'Cl'},
+            {'par_ident': 'Cl'},
+            ]
+        groups = fetch.plan_fetches(identifiers)
+        self.assertEquals(len(groups), 3)
+        locations = sorted(group.locations() for group in groups)
+        self.assertEquals(locations, [['a'], ['a'], ['a', 'b']])
+
+
+class PeriodFilterTest(TestCase):
+
+    def test_calendar_fields(self):
+        dts = [datetime.datetime(1969, 12, 31, 23),
+               datetime.datetime(2000, 2, 29, 5),
+               datetime.datetime(2012, 10, 1, 0)]
+        arrays = stats.EventArrays.from_events(
+            [(dt, (1.0, 0, None)) for dt in dts])
+        calendar = arrays.calendar
+        self.assertEquals(list(calendar.year), [dt.year for dt in dts])
+        self.assertEquals(list(calendar.month), [dt.month for dt in dts])
+        self.assertEquals(list(calendar.hour), [dt.hour for dt in dts])
+        self.assertEquals(list(calendar.weekday),
+                          [dt.weekday() for dt in dts])
+
+    def test_filter_period(self):
+        events = _events(range(24 * 7))
+        arrays = stats.EventArrays.from_events(events)
+        filtered = filter_period(arrays, hours=[3], weekday=0)
+        # 2012-01-02 is a monday.
+        self.assertEquals(
+            [filtered.event(i) for i in range(len(filtered))],
+            [events[24 + 3]])
+        # Original is untouched.
+        self.assertEquals(len(arrays), 24 * 7)
+
+
+class TimeSeriesCacheTest(TestCase):
+
+    def test_roundtrip(self):
+        class FakeTimeSeries(object):
+            def get_events(self):
+                return events
+        events = _events([1.0, None, 3.0])
+        events[2] = (events[2][0], (3.0, None, 'comment'))
+        payload = tscache.encode_time_series({'key': FakeTimeSeries()})
+        arrays = tscache.decode_time_series(payload)['key']
+        self.assertEquals(
+            [arrays.event(i) for i in range(len(arrays))], events)
+
+    def test_old_payload(self):
+        self.assertEquals(tscache.decode_time_series(None), None)
+        self.assertEquals(
+            tscache.decode_time_series({'old': 'format'}), None)
+
+
+class DiskCacheTest(TestCase):
+
+    def setUp(self):
+        self.settings = (diskcache.DIRECTORY, diskcache.MIN_EVENTS)
+        diskcache.DIRECTORY = tempfile.mkdtemp()
+        diskcache.MIN_EVENTS = 1
+
+    def tearDown(self):
+        shutil.rmtree(diskcache.DIRECTORY)
+        diskcache.DIRECTORY, diskcache.MIN_EVENTS = self.settings
+
+    def test_roundtrip(self):
+        events = _events([1.0, None, 3.0])
+        events[2] = (events[2][0], (3.0, 2, 'comment'))
+        time_series = {'key': stats.EventArrays.from_events(events)}
+        self.assertTrue(diskcache.set_time_series('a', time_series))
+        self.assertTrue(diskcache.contains('a'))
+        arrays = diskcache.get_time_series('a')['key']
+        self.assertEquals(
+            [arrays.event(i) for i in range(len(arrays))], events)
+        self.assertEquals(diskcache.get_time_series('b'), None)
+
+    def test_evict(self):
+        time_series = {'key': stats.EventArrays.from_events(
+                _events(range(100)))}
+        diskcache.set_time_series('a', time_series)
+        diskcache.set_time_series('b', time_series)
+        diskcache.get_time_series('a')
+        self.assertEquals(diskcache.evict(max_size=4000), 1)
+        self.assertTrue(diskcache.contains('a'))
+        self.assertFalse(diskcache.contains('b'))
+
+
+class PartialAggregatesTest(TestCase):
+
+    def setUp(self):
+        # Three months of 5-hourly values with ties and a comment.
+        self.events = _events(
+            [float(i % 17) for i in range(440)],
+            start=datetime.datetime(2012, 1, 20),
+            step=datetime.timedelta(hours=5))
+        self.events[7] = (self.events[7][0], (16.0, 3, 'comment'))
+        self.arrays = stats.EventArrays.from_events(self.events)
+
+    def buckets(self, start, end):
+        return [partials.Bucket.from_arrays(
+                self.arrays.take(range(*self.arrays.timestamps.searchsorted(
+                            bucket_range))), *bucket_range)
+                for bucket_range in partials.bucket_ranges(start, end)]
+
+    def test_bucket_ranges(self):
+        ranges = partials.bucket_ranges(
+            datetime.datetime(2012, 1, 20), datetime.datetime(2012, 3, 1))
+        self.assertEquals(
+            [tuple(stats.epoch_to_datetime(t) for t in bucket_range)
+             for bucket_range in ranges],
+            [(datetime.datetime(2012, 1, 20), datetime.datetime(2012, 2, 1)),
+             (datetime.datetime(2012, 2, 1), datetime.datetime(2012, 3, 1)),
+             (datetime.datetime(2012, 3, 1),
+              datetime.datetime(2012, 3, 1, 0, 0, 0, 1))])
+
+    def test_same_as_calc_stats(self):
+        start = datetime.datetime(2012, 1, 25, 13)
+        end = datetime.datetime(2012, 4, 1)
+        buckets = self.buckets(start, end)
+        for period in ({}, {'months': set([2, 3])}, {'hours': range(0, 6)},
+                       {'weekday': 2, 'hours': range(5, 24)}):
+            expected = calc_stats(
+                filter_period(between(self.arrays, start, end),
+                                    **period),
+                boundary_value=8.0, percentile_value=75.0)
+            result = partials.calc_stats(
+                buckets, boundary_value=8.0, percentile_value=75.0,
+                **period)
+            self.assertEquals(result, expected)
+
+    def test_split_stats(self):
+        start = datetime.datetime(2012, 1, 25, 13)
+        end = datetime.datetime(2012, 4, 1)
+        buckets = self.buckets(start, end)
+        result = partials.split_stats(
+            buckets, partials.SPLIT_SEASON, boundary_value=8.0)
+        self.assertEquals([label for label, split in result],
+                          ['winter 2011-2012', 'zomer 2012'])
+        months = partials.split_stats(
+            buckets, partials.SPLIT_MONTH, months=set([2, 3]))
+        self.assertEquals([label for label, split in months],
+                          ['2012-01', '2012-02', '2012-03', '2012-04'])
+        self.assertEquals(months[0][1]['item_count'], 0)
+        expected = calc_stats(
+            filter_period(
+                between(self.arrays, start, end), months=set([2])))
+        self.assertEquals(months[1][1], expected)
+
+    def test_period_buckets(self):
+        fetched = []
+
+        def time_series(identifier, start, end):
+            fetched.append((start, end))
+            arrays = between(self.arrays, start, end)
+            if not len(arrays):
+                return {}
+            if identifier['par_ident'] == 'twice':
+                return {'a': arrays, 'b': arrays}
+            return {'key': arrays}
+        originals = fetch.time_series, fetch.cached_time_series
+        fetch.time_series = fetch.cached_time_series = time_series
+        try:
+            identifier = {'par_ident': 'period_buckets'}
+            start = datetime.datetime(2012, 1, 1)
+            end = datetime.datetime(2012, 5, 31)
+            now = datetime.datetime(2012, 5, 15)
+            self.assertTrue(partials.nothing_cached(identifier, start, end))
+            buckets = partials.period_buckets(identifier, start, end, now=now)
+            self.assertEquals(fetched, [(start, end)])
+            self.assertFalse(partials.nothing_cached(identifier, start, end))
+            expected = calc_stats(between(self.arrays, start, end))
+            self.assertEquals(partials.calc_stats(buckets), expected)
+
+            # Only the month that ended after now is fetched again, it
+            # has no events.
+            del fetched[:]
+            buckets = partials.period_buckets(identifier, start, end, now=now)
+            self.assertEquals(
+                fetched, [(datetime.datetime(2012, 5, 1), end)])
+            self.assertEquals(partials.calc_stats(buckets), expected)
+
+            # Months before the series started are empty buckets.
+            del fetched[:]
+            buckets = partials.period_buckets(
+                identifier, datetime.datetime(2011, 11, 1),
+                datetime.datetime(2012, 2, 29, 23, 59, 59, 999999), now=now)
+            self.assertEquals(len(fetched), 1)
+            self.assertEquals(
+                [bucket.counts.sum() for bucket in buckets][:2], [0, 0])
+
+            # No time series at all, or more than one.
+            self.assertEquals(partials.period_buckets(
+                    identifier, datetime.datetime(2010, 1, 1),
+                    datetime.datetime(2010, 2, 1), now=now), None)
+            self.assertEquals(partials.period_buckets(
+                    {'par_ident': 'twice'}, start, end, now=now), None)
+        finally:
+            fetch.time_series, fetch.cached_time_series = originals
+
+    def test_reversed_period(self):
+        start = datetime.datetime(2012, 3, 15)
+        self.assertEquals(partials.bucket_ranges(
+                start, datetime.datetime(2012, 3, 10)), [])
+        self.assertEquals(
+            partials.period_stats({'par_ident': 'reversed'}, start,
+                                  datetime.datetime(2012, 1, 1),
+                                  boundary_value=3.0),
+            stats.values_stats(np.empty(0), boundary_value=3.0))
+
+    def test_encode_decode(self):
+        bucket = self.buckets(
+            datetime.datetime(2012, 2, 1), datetime.datetime(2012, 2, 2))[0]
+        decoded = partials.Bucket.decode(bucket.encode())
+        self.assertEquals(list(decoded.values), list(bucket.values))
+        self.assertEquals(partials.Bucket.decode(None), None)
+
+
+class SketchTest(TestCase):
+
+    def test_small_is_exact(self):
+        values, weights = sketch.compact([3.0, 1.0, 2.0], 10)
+        self.assertEquals(list(values), [1.0, 2.0, 3.0])
+        self.assertEquals(list(sketch.at_ranks(values, weights, [0, 2])),
+                          [1.0, 3.0])
+
+    def test_rank_error(self):
+        original = [float((i * 7919) % 10007) for i in range(10007)]
+        epsilon = 0.05
+        values, weights = sketch.compact(
+            original, sketch.capacity(epsilon))
+        self.assertTrue(len(values) < len(original) / 10)
+        self.assertEquals(weights.sum(), len(original))
+        for value in (100.0, 5000.0, 9000.0):
+            exact = len([v for v in original if v <= value])
+            self.assertTrue(abs(sketch.rank(values, weights, value) - exact)
+                            <= epsilon * len(original))
+
+    def test_period_stats_sketch(self):
+        # Four months of 5 minute values, about 200 per cell.
+        events = _events([float((i * 7919) % 1001) for i in range(35000)],
+                         step=datetime.timedelta(minutes=5))
+        arrays = stats.EventArrays.from_events(events)
+        fetched = []
+
+        def time_series(identifier, start, end):
+            fetched.append((start, end))
+            return {'key': between(arrays, start, end)}
+        originals = (fetch.time_series, fetch.cached_time_series,
+                     partials.SKETCH_THRESHOLD, partials.SKETCH_EPSILON)
+        fetch.time_series = fetch.cached_time_series = time_series
+        partials.SKETCH_THRESHOLD = 10000
+        partials.SKETCH_EPSILON = 0.05
+        try:
+            identifier = {'par_ident': 'period_stats'}
+            start = datetime.datetime(2012, 1, 1)
+            end = datetime.datetime(2012, 5, 31)
+            now = datetime.datetime(2013, 1, 1)
+            buckets = partials.period_buckets(identifier, start, end, now=now)
+            merged = partials.Bucket.merge(buckets)
+            merged.sketch()
+            self.assertTrue(merged.is_sketched)
+            self.assertTrue(len(merged.values) < len(arrays) / 2)
+            self.assertEquals(merged.weights.sum(), len(arrays))
+
+            hours = range(6, 18)
+            expected = calc_stats(
+                filter_period(arrays, hours=hours),
+                boundary_value=250.0)
+            values = np.sort(filter_period(arrays, hours=hours).values)
+            count = len(values)
+            for percentile_value in (10.0, 75.0):
+                result = partials.period_stats(
+                    identifier, start, end, hours=hours,
+                    boundary_value=250.0, percentile_value=percentile_value,
+                    now=now)
+                self.assertEquals(result['item_count'], count)
+                self.assertEquals(result['standard'], expected['standard'])
+                self.assertEquals(result['boundary'], expected['boundary'])
+                for key, index in (('median', count // 2),
+                                   ('user', int(percentile_value * count /
+                                                100.0))):
+                    value = result['percentile'][key]
+                    # Within the rank error of the right rank.
+                    self.assertTrue(
+                        np.searchsorted(values, value, side='left') -
+                        partials.SKETCH_EPSILON * count <= index <=
+                        np.searchsorted(values, value, side='right') +
+                        partials.SKETCH_EPSILON * count)
+            # The second percentile came from the cached sketch.
+            self.assertEquals(len(fetched), 1)
+        finally:
+            (fetch.time_series, fetch.cached_time_series,
+             partials.SKETCH_THRESHOLD, partials.SKETCH_EPSILON) = originals
+
+
+class FakeCollageItem(object):
+    """Collage item with info_stats that sleep or fail."""
+    fews_norm_source_slug = None
+
+    def __init__(self, item_id, seconds=0, fail=False):
+        self.id = item_id
+        self.seconds = seconds
+        self.fail = fail
+        self.stored = None
+
+    def parsed_identifier(self):
+        return {}
+
+    def stats_settings(self):
+        return {}
+
+    def empty_stats(self):
+        return {'item_count': 0}
+
+    def info_stats(self, start, end):
+        time.sleep(self.seconds)
+        if self.fail:
+            raise ValueError('broken item')
+        return {'item_count': self.id}
+
+    def store_info_stats(self, start, end, result):
+        self.stored = result
+
+
+class CollageStatsTest(TestCase):
+
+    def setUp(self):
+        self.start = datetime.datetime(2012, 1, 1)
+        self.end = datetime.datetime(2012, 2, 1)
+
+    def test_order_and_errors(self):
+        collage_items = [FakeCollageItem(101, seconds=0.2),
+                         FakeCollageItem(102, fail=True),
+                         FakeCollageItem(103)]
+        result = collagestats.compute_stats(
+            collage_items, self.start, self.end, threads=3)
+        self.assertEquals([item_stats['id'] for item_stats in result],
+                          [101, 102, 103])
+        self.assertEquals(result[0]['item_count'], 101)
+        self.assertTrue(result[1]['error'])
+        self.assertEquals(result[2]['item_count'], 103)
+
+    def test_pending(self):
+        slow = FakeCollageItem(201, seconds=0.5)
+        collage_items = [slow, FakeCollageItem(202)]
+        result = list(collagestats.iter_compute_stats(
+                collage_items, self.start, self.end, threads=2,
+                item_budget=0.05))
+        self.assertTrue(result[0]['pending'])
+        self.assertEquals(result[1]['item_count'], 202)
+        # The slow item is finished and stored in the background.
+        time.sleep(1)
+        self.assertEquals(slow.stored, {'item_count': 201, 'id': 201})
+
+    def test_warm_periods(self):
+        self.assertEquals(
+            collagestats.warm_periods([30, 365], datetime.date(2012, 3, 15)),
+            [(datetime.datetime(2012, 2, 1),
+              datetime.datetime(2012, 2, 29, 23, 59, 59, 999999)),
+             (datetime.datetime(2011, 3, 1),
+              datetime.datetime(2012, 2, 29, 23, 59, 59, 999999))])
+        self.assertEquals(
+            collagestats.warm_stats_periods([30], datetime.date(2012, 3, 15)),
+            [(datetime.datetime(2012, 2, 14), datetime.datetime(2012, 3, 15))])
+
+
+class FakeTask(object):
+
+    def __init__(self):
+        self.started = []
+
+    def delay(self, *args):
+        self.started.append(args)
+
+
+class CollageStatsJobTest(TestCase):
+
+    def setUp(self):
+        LayerCollage.objects.create(name='collage', secret_slug='jobtest')
+        self.task = api_views.collage_stats_job
+        api_views.collage_stats_job = FakeTask()
+
+    def tearDown(self):
+        api_views.collage_stats_job = self.task
+
+    def get(self, **params):
+        response = self.client.get(
+            reverse('lizard_workspace_api_collage_stats'), params,
+            HTTP_ACCEPT='application/json')
+        self.assertEquals(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_job(self):
+        started = api_views.collage_stats_job.started
+        result = self.get(secret_slug='jobtest', dt_start='2012-01-01',
+                          dt_end='2012-02-01')
+        job_id = result['job_id']
+        self.assertEquals(result['status'], collagestats.JOB_PENDING)
+        self.assertEquals(started, [(job_id, )])
+        self.get(secret_slug='jobtest', dt_start='2012-01-01',
+                 dt_end='2012-02-01')
+        self.assertEquals(len(started), 1)
+
+        collagestats.run_job(job_id)
+        result = self.get(job_id=job_id, offset=0)
+        self.assertEquals(result['status'], collagestats.JOB_DONE)
+        self.assertEquals((result['total'], result['done']), (0, 0))
+
+        # The worker of a running job died.
+        state = collagestats.job_state(job_id)
+        state['status'] = collagestats.JOB_RUNNING
+        state['updated'] -= collagestats.JOB_STALE + 1
+        collagestats._set_job_state(state)
+        self.assertEquals(self.get(job_id=job_id)['status'],
+                          collagestats.JOB_PENDING)
+        self.get(job_id=job_id)
+        self.assertEquals(started, [(job_id, ), (job_id, )])
+
+        response = self.client.get(
+            reverse('lizard_workspace_api_collage_stats'),
+            {'job_id': 'unknown'}, HTTP_ACCEPT='application/json')
+        self.assertEquals(response.status_code, 404)
+
+    def test_load_items(self):
+        collage = LayerCollage.objects.get(secret_slug='jobtest')
+        for name in ('a', 'b'):
+            LayerCollageItem.objects.create(
+                name=name, identifier='{}', layer_collage=collage,
+                layer=Layer.objects.create(name=name, slug=name))
+        with self.assertNumQueries(1):
+            collage_items = collagestats.load_collage_items(collage)
+            for collage_item in collage_items:
+                collage_item.layer_collage.name
+                collage_item.layer.name
+        self.assertEquals(len(collage_items), 2)
+
+
+class CollageItemStatsTest(TestCase):
+
+    def setUp(self):
+        self.collage_item = LayerCollageItem.objects.create(
+            name='item', identifier='{}',
+            layer_collage=LayerCollage.objects.create(name='collage'),
+            layer=Layer.objects.create(name='layer', slug='layer'))
+        self.start = datetime.datetime(2012, 1, 1, 13, 5)
+        self.end = datetime.datetime(2012, 2, 1, 13, 5)
+
+    def stored(self):
+        return collagestats.stored_stats(
+            [self.collage_item], self.start, self.end)
+
+    def test_store_info_stats(self):
+        self.collage_item.store_info_stats(
+            self.start, self.end, {'item_count': 1})
+        self.collage_item.store_info_stats(
+            self.start, self.end, {'item_count': 2})
+        self.assertEquals(LayerCollageItemStats.objects.count(), 1)
+        self.assertEquals(
+            self.stored()[self.collage_item.id]['item_count'], 2)
+        self.collage_item.boundary_value = 1.0
+        self.assertEquals(self.stored(), {})
+
+    def test_read(self):
+        self.collage_item.store_info_stats(
+            self.start, self.end, {'item_count': 1})
+        long_ago = datetime.datetime.now() - datetime.timedelta(days=30)
+        LayerCollageItemStats.objects.update(timestamp_read=long_ago)
+        collagestats.stored_stats(
+            [self.collage_item], self.start, self.end, mark_read=False)
+        self.assertEquals(
+            LayerCollageItemStats.objects.get().timestamp_read, long_ago)
+        self.stored()
+        self.assertTrue(
+            LayerCollageItemStats.objects.get().timestamp_read > long_ago)
+
+
+class CollageItemIdentifierTest(TestCase):
+
+    def test_sync_on_save(self):
+        collage_item = LayerCollageItem.objects.create(
+            name='item', layer_collage=LayerCollage.objects.create(
+                name='collage'),
+            layer=Layer.objects.create(name='layer', slug='layer'),
+            identifier=json.dumps({'fews_norm_source_slug': 'hhnk',
+                                   'geo_ident': 1234,
+                                   'par_ident': 'WNS1400'}))
+        self.assertEquals(LayerCollageItem.objects.get(
+                fews_norm_source_slug='hhnk', geo_ident='1234',
+                par_ident='WNS1400', mod_ident=None), collage_item)
+
+        collage_item.identifier = json.dumps({'par_ident': 'WNS1401'})
+        collage_item.save()
+        saved = LayerCollageItem.objects.get(id=collage_item.id)
+        self.assertEquals((saved.par_ident, saved.geo_ident),
+                          ('WNS1401', None))
+
+        # Identifiers that are not a json object have no fields.
+        for identifier in ('not json', '[1, 2]'):
+            collage_item.identifier = identifier
+            collage_item.save()
+            saved = LayerCollageItem.objects.get(id=collage_item.id)
+            self.assertEquals(
+                [getattr(saved, field)
+                 for field in LayerCollageItem.IDENTIFIER_FIELDS],
+                [None] * len(LayerCollageItem.IDENTIFIER_FIELDS))
+
+
+class CollageContextTest(TestCase):
+
+    def setUp(self):
+        collage = LayerCollage.objects.create(name='collage', secret_slug='ctx')
+        layer = Layer.objects.create(name='layer', slug='layer')
+        for name in ('a', 'b'):
+            LayerCollageItem.objects.create(
+                name=name, identifier='{}', layer_collage=collage,
+                layer=layer)
+        self.passes = []
+
+        def iter_collage_stats(collage_items, start, end, **kwargs):
+            self.passes.append(sorted(item.name for item in collage_items))
+            for collage_item in collage_items:
+                yield {'id': collage_item.id}
+
+        def collage_stats(collage_items, start, end, **kwargs):
+            return list(iter_collage_stats(collage_items, start, end))
+        self.originals = (collagestats.iter_collage_stats,
+                          collagestats.collage_stats)
+        collagestats.iter_collage_stats = iter_collage_stats
+        collagestats.collage_stats = collage_stats
+
+    def tearDown(self):
+        (collagestats.iter_collage_stats,
+         collagestats.collage_stats) = self.originals
+
+    def test_one_pass(self):
+        context = CollageContext.load('ctx')
+        start = datetime.datetime(2012, 1, 1)
+        end = datetime.datetime(2012, 2, 1)
+        # Page, graphs and export of one request.
+        streamed = list(context.iter_stats(start, end))
+        self.assertEquals(context.stats(start, end), streamed)
+        self.assertEquals(list(context.iter_stats(start, end)), streamed)
+        self.assertEquals(self.passes, [['a', 'b']])
+        # The items share the collage and are loaded once.
+        self.assertTrue(context.items() is context.items())
+        self.assertTrue(all(item.layer_collage is context.collage
+                            for item in context.items()))
+        # Another period is another pass.
+        context.stats(start, datetime.datetime(2012, 3, 1))
+        self.assertEquals(len(self.passes), 2)
+        self.assertRaises(Http404, CollageContext.load, 'unknown')
+
+
+def _export_stats(name, **extra):
+    """Return info_stats like LayerCollageItem.info_stats."""
+    result = {
+        'name': name, 'item_count': 2,
+        'standard': {'min': (datetime.datetime(2012, 1, 1), (1.0, 0, '')),
+                     'max': (datetime.datetime(2012, 1, 2), (3.0, 0, '')),
+                     'avg': 2.0, 'sum': 4.0},
+        'boundary': {'value': None, 'amount_less_equal': None,
+                     'amount_greater': None},
+        'percentile': {'median': 2.0, '90': 3.0, 'user': None,
+                       'value': None}}
+    result.update(extra)
+    return result
+
+
+class CollageExportTest(TestCase):
+
+    def setUp(self):
+        LayerCollage.objects.create(name='collage', secret_slug='export')
+        self.computed = []
+
+        def iter_collage_stats(collage_items, start, end, **kwargs):
+            for name, extra in (('a', {}), ('b', {'pending': True})):
+                self.computed.append(name)
+                yield _export_stats(name, **extra)
+        self.original = collagestats.iter_collage_stats
+        collagestats.iter_collage_stats = iter_collage_stats
+
+    def tearDown(self):
+        collagestats.iter_collage_stats = self.original
+
+    def view(self):
+        view = CollageView()
+        view.request = RequestFactory().get('/')
+        view.request.session = {}
+        view.collage_slug = 'export'
+        return view
+
+    def test_csv_streams(self):
+        lines = iter(self.view().csv_response())
+        header = [lines.next() for index in range(7)]
+        # The header is out before any item is computed.
+        self.assertEquals(self.computed, [])
+        self.assertEquals(list(csv.reader(header))[-1], COLLAGE_HEADER)
+        rows = list(csv.reader(lines))
+        self.assertEquals(self.computed, ['a', 'b'])
+        # Only rows with a status get the extra column.
+        self.assertEquals([len(row) for row in rows], [15, 16])
+        self.assertEquals(rows[1][-1], 'wordt berekend, download later opnieuw')
+
+    def test_xls(self):
+        response = self.view().xls_response()
+        content = ''.join(response)
+        self.assertEquals(int(response['Content-Length']), len(content))
+        # An OLE2 compound document, as xlwt writes it.
+        self.assertEquals(content[:8], '\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1')
+        self.assertTrue('wordt berekend' in content)
+        self.assertEquals(self.computed, ['a', 'b'])
+
+    def test_save_xls(self):
+        xls, size = save_xls([['naam', 'collage'], [1, 2.5, None]])
+        content = xls.read()
+        self.assertEquals(len(content), size)
+        self.assertEquals(xls.read(), '')
+
+
+class LayerTreeCacheTest(TestCase):
+
+    def test_cached_json(self):
+        builds = []
+
+        def build():
+            builds.append(1)
+            return '[]'
+        self.assertEquals(layertree.cached_json(build, 1), '[]')
+        self.assertEquals(layertree.cached_json(build, 1), '[]')
+        self.assertEquals(len(builds), 1)
+        layertree.invalidate()
+        layertree.cached_json(build, 1)
+        self.assertEquals(len(builds), 2)
+
+    def test_deferred_invalidation(self):
+        version = layertree.catalog_version()
+        with layertree.deferred_invalidation():
+            layertree.invalidate()
+            with layertree.deferred_invalidation():
+                layertree.invalidate()
+            self.assertEquals(layertree.catalog_version(), version)
+        self.assertTrue(layertree.catalog_version() > version)
+
+    def test_deferred_callbacks(self):
+        calls = []
+        layertree.on_deferred_change(lambda: calls.append(
+                layertree.deferred()))
+        try:
+            with layertree.deferred_invalidation():
+                pass
+            self.assertEquals(calls, [])
+            with layertree.deferred_invalidation():
+                layertree.invalidate()
+            self.assertEquals(calls, [False])
+        finally:
+            layertree._deferred_callbacks.pop()
+
+    def test_deferred_errors(self):
+        calls = []
+
+        def failing():
+            calls.append('failing')
+            raise ValueError()
+        layertree.on_deferred_change(failing)
+        layertree.on_deferred_change(lambda: calls.append('next'))
+        try:
+            # A failing callback is logged, the others still run and
+            # the version is bumped.
+            version = layertree.catalog_version()
+            with layertree.deferred_invalidation():
+                layertree.invalidate()
+            self.assertEquals(calls, ['failing', 'next'])
+            self.assertTrue(layertree.catalog_version() > version)
+
+            # The changes before an error are committed, so the
+            # callbacks run. The error of the block is not hidden.
+            version = layertree.catalog_version()
+
+            def failing_block():
+                with layertree.deferred_invalidation():
+                    layertree.invalidate()
+                    raise KeyError()
+            self.assertRaises(KeyError, failing_block)
+            self.assertEquals(calls, ['failing', 'next'] * 2)
+            self.assertTrue(layertree.catalog_version() > version)
+            self.assertFalse(layertree.deferred())
+        finally:
+            del layertree._deferred_callbacks[-2:]
+
+
+class CatalogView(api_views.CatalogVersionMixin, View):
+    """Counts the requests that reach it."""
+    calls = 0
+
+    def get(self, request):
+        CatalogView.calls += 1
+        return HttpResponse('tree')
+
+
+class CatalogVersionTest(TestCase):
+
+    def get(self, user=None, data_set_ids=None, etag=None):
+        headers = {}
+        if etag is not None:
+            headers['HTTP_IF_NONE_MATCH'] = etag
+        request = RequestFactory().get('/tree/', **headers)
+        request.user = user or AnonymousUser()
+        if data_set_ids is not None:
+            request.allowed_data_set_ids = data_set_ids
+        return CatalogView.as_view()(request)
+
+    def test_not_modified(self):
+        calls = CatalogView.calls
+        response = self.get()
+        self.assertEquals(response.status_code, 200)
+        etag = response['ETag']
+        response = self.get(etag=etag)
+        self.assertEquals(response.status_code, 304)
+        self.assertEquals(response['ETag'], etag)
+        self.assertEquals(CatalogView.calls, calls + 1)
+
+        layertree.bump_catalog_version()
+        response = self.get(etag=etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertNotEquals(response['ETag'], etag)
+        self.assertEquals(CatalogView.calls, calls + 2)
+
+    def test_per_user(self):
+        etags = set([
+                self.get()['ETag'],
+                self.get(user=User(id=1, username='a'))['ETag'],
+                self.get(user=User(id=2, username='b'))['ETag'],
+                self.get(user=User(id=1, username='a'),
+                         data_set_ids=[3])['ETag'],
+                self.get(user=User(id=1, username='a', is_superuser=True),
+                         data_set_ids=[3])['ETag']])
+        self.assertEquals(len(etags), 5)
+        # Another user with the same permissions may not reuse it.
+        etag = self.get(user=User(id=1, username='a'))['ETag']
+        self.assertEquals(
+            self.get(user=User(id=2, username='b'), etag=etag).status_code,
+            200)
+
+
+class LayerSearchTest(TestCase):
+
+    def setUp(self):
+        self.index = layersearch.LayerIndex()
+        self.index.update({
+                1: ('Chlorofyl KRW001', 'chlorofyl-krw001', None, ('krw', )),
+                2: ('Chloride KRW002', 'chloride-krw002', None, ()),
+                3: ('Waterstand', 'waterstand', 'sync_task::krw', ())})
+
+    def test_prefix(self):
+        self.assertEquals(
+            [layer_id for layer_id, score in self.index.search('chlor')],
+            [2, 1])
+        self.assertEquals(
+            [layer_id for layer_id, score in self.index.search('krw chlorof')],
+            [1])
+
+    def test_ranking(self):
+        # Name words weigh more than tags and source_ident.
+        result = self.index.search('krw')
+        self.assertEquals(sorted(layer_id for layer_id, score in result[:2]),
+                          [1, 2])
+        self.assertEquals(result[2][0], 3)
+
+    def test_typo(self):
+        self.assertEquals(
+            [layer_id for layer_id, score in self.index.search('watrstand')],
+            [3])
+
+    def test_update(self):
+        self.assertEquals(self.index.update({
+                    1: ('Chlorofyl KRW001', 'chlorofyl-krw001', None,
+                        ('krw', )),
+                    3: ('Debiet', 'debiet', None, ())}), 2)
+        self.assertEquals(self.index.search('waterstand'), [])
+        self.assertEquals(self.index.search('chloride'), [])
+        self.assertEquals(
+            [layer_id for layer_id, score in self.index.search('deb')], [3])
+
+    def test_latency(self):
+        documents = benchmark_layer_search.documents(20000)
+        index = layersearch.LayerIndex()
+        index.update(documents)
+        for query, milliseconds in benchmark_layer_search.timings(index):
+            # About 1 ms on a laptop, leave room for slow test hosts.
+            self.assertTrue(milliseconds < 20, (query, milliseconds))
+        # Common words are cut off at MAX_CANDIDATES, rare ones are
+        # exact.
+        self.assertEquals(len(index.search('w', limit=30)), 30)
+        location = [word for word in layersearch.words(documents[0][0])
+                    if word[-5:].isdigit()][0]
+        self.assertEquals(index.search(location)[0], (
+                0, layersearch.EXACT_SCORE * layersearch.NAME_WEIGHT))
+
+
+class LayerSearchViewTest(TestCase):
+
+    def setUp(self):
+        self.layers = [
+            Layer.objects.create(name='Chloride %02d' % index,
+                                 slug='chloride-%02d' % index)
+            for index in range(30)]
+        Layer.objects.create(name='Waterstand', slug='waterstand')
+
+    def test_hidden_layers(self):
+        # The best 25 matches are not in the layers of the user.
+        hidden = [layer.id for layer in self.layers[:25]]
+        found = layersearch.search_layers(
+            'chlor', limit=10, layers=Layer.objects.exclude(id__in=hidden))
+        self.assertEquals([layer.name for layer, score in found],
+                          ['Chloride %02d' % index for index in range(25, 30)])
+
+    def test_view(self):
+        response = self.client.get(
+            reverse('lizard_workspace_api_layer_search'),
+            {'query': 'chlorid', 'limit': 3}, HTTP_ACCEPT='application/json')
+        result = json.loads(response.content)
+        self.assertEquals(result['count'], 3)
+        self.assertEquals([item['title'] for item in result['data']],
+                          ['Chloride 00', 'Chloride 01', 'Chloride 02'])
+        response = self.client.get(
+            reverse('lizard_workspace_api_layer_search'),
+            {'query': 'watrstand'}, HTTP_ACCEPT='application/json')
+        self.assertEquals(
+            [item['title'] for item in json.loads(response.content)['data']],
+            ['Waterstand'])
+
+
+class LayerFolderTreeTest(TestCase):
+
+    def test_same_as_layers_dict(self):
+        tag = Tag.objects.create(slug='tag')
+        direct = Layer.objects.create(name='b', slug='b', valid=False)
+        tagged = Layer.objects.create(name='a', slug='a')
+        tagged.tags.add(tag)
+        invalid = Layer.objects.create(name='c', slug='c', valid=False)
+        invalid.tags.add(tag)
+        root = LayerFolder.objects.create(name='root')
+        child = LayerFolder.objects.create(name='child', parent=root)
+        child.layers.add(direct)
+        child.layer_tag.add(tag)
+        LayerFolder.objects.create(name='empty', parent=root)
+
+        tree = LayerFolderTree.load()
+        self.assertEquals(tree.layers_dict(child.id), child.layers_dict())
+        self.assertEquals(
+            [item['plid'] for item in tree.layers_dict(child.id)],
+            [tagged.id, direct.id])
+        self.assertEquals(
+            tree.tree_dict(root.id),
+            [{'text': 'child', 'children': child.layers_dict()}])
+
+    def test_memberships(self):
+        tag = Tag.objects.create(slug='tag')
+        layer = Layer.objects.create(name='a', slug='a')
+        folder = LayerFolder.objects.create(name='folder')
+        folder.layer_tag.add(tag)
+        layer.tags.add(tag)
+        self.assertEquals(list(folder.folder_layers()), [layer])
+        layer.valid = False
+        layer.save()
+        self.assertEquals(list(folder.folder_layers()), [])
+        folder.layers.add(layer)
+        self.assertEquals(list(folder.folder_layers()), [layer])
+        folder.layers.clear()
+
+        # Sync tasks update the memberships once, at the end.
+        with layertree.deferred_invalidation():
+            layer.valid = True
+            layer.save()
+            self.assertEquals(list(folder.folder_layers()), [])
+        self.assertEquals(list(folder.folder_layers()), [layer])
+
+        # A failing sync task keeps the changes it made.
+        def failing_sync():
+            with layertree.deferred_invalidation():
+                layer.tags.remove(tag)
+                raise ValueError()
+        self.assertRaises(ValueError, failing_sync)
+        self.assertEquals(list(folder.folder_layers()), [])
+        layer.tags.add(tag)
+
+        # Queryset updates send no signals, invalidate() stands in.
+        with layertree.deferred_invalidation():
+            Layer.objects.filter(id=layer.id).update(valid=False)
+            layertree.invalidate()
+        self.assertEquals(list(folder.folder_layers()), [])
+        Layer.objects.filter(id=layer.id).update(valid=True)
+        LayerFolder.update_memberships()
+        self.assertEquals(list(folder.folder_layers()), [layer])
+
+        # Deleting a tag only updates the folders that had the tag.
+        other = LayerFolder.objects.create(name='other')
+        other.layers.add(layer)
+        other.layerfoldermembership_set.all().delete()
+        tag.delete()
+        self.assertEquals(LayerFolderMembership.objects.count(), 0)
+        self.assertEquals(other.update_membership(), 1)
+
+    def test_folder_page(self):
+        folder = LayerFolder.objects.create(name='folder')
+        LayerFolder.objects.create(name='child', parent=folder)
+        for name in ('c', 'a', 'ab', 'b'):
+            folder.layers.add(Layer.objects.create(name=name, slug=name))
+        page = folder.folder_page(start=1, limit=2)
+        self.assertEquals(page['count'], 4)
+        self.assertEquals([item['text'] for item in page['layers']],
+                          ['ab', 'b'])
+        self.assertEquals(
+            [(item['text'], item['layer_count'], item['folder_count'])
+             for item in page['folders']], [('child', 0, 0)])
+        page = folder.folder_page(query='A')
+        self.assertEquals([item['text'] for item in page['layers']],
+                          ['a', 'ab'])
+        self.assertEquals(
+            [(item['text'], item['layer_count'], item['folder_count'])
+             for item in LayerFolder.root_page()['folders']],
+            [('folder', 4, 1)])
+
+        url = reverse('lizard_workspace_api_layer_folder')
+        response = self.client.get(url, {'object_id': 'x'},
+                                   HTTP_ACCEPT='application/json')
+        self.assertEquals(response.status_code, 404)
+        response = self.client.get(url, {'object_id': folder.id},
+                                   HTTP_ACCEPT='application/json')
+        self.assertEquals(json.loads(response.content)['count'], 4)
@@ -0,0 +1,80 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Compact cache payloads for time series.
+
+Event.time_series returns a dict {(location, parameter, unit):
+timeseries}, where each timeseries holds datetime -> (value, flag,
+comment). Pickled, that is many times bigger than the numbers it
+holds, and long series go over memcached's item size limit (and are
+then silently not cached at all).
+
+In the cache we store packed arrays instead: int64 epoch
+timestamps, float64 values, int8 flags and a sparse dict of
+comments. See stats.EventArrays.
+"""
+import cPickle as pickle
+
+import numpy as np
+
+from lizard_workspace.stats import EventArrays
+
+# Bump when the payload layout changes, old payloads are then ignored.
+PAYLOAD_VERSION = 1
+
+
+def _pack(arrays):
+    """Return picklable tuple for EventArrays."""
+    flags = arrays.flags
+    if len(flags) and flags.min() >= -128 and flags.max() <= 127:
+        flags = flags.astype(np.int8)
+    return (arrays.timestamps, arrays.values, flags,
+            arrays.comments, arrays.tzinfo)
+
+
+def _unpack(packed):
+    timestamps, values, flags, comments, tzinfo = packed
+    return EventArrays(timestamps, values, flags, comments, tzinfo)
+
+
+def _unversioned(payload):
+    """Return contents of payload, or None if it is not a (current)
+    compact payload."""
+    try:
+        version, contents = payload
+    except (TypeError, ValueError):
+        return None
+    if version != PAYLOAD_VERSION:
+        return None
+    return contents
+
+
+def time_series_arrays(time_series):
+    """Return dict {key: EventArrays} for the result of
+    Event.time_series."""
+    return dict((key, EventArrays.from_events(ts.get_events()))
+                for key, ts in time_series.items())
+
+
+def encode_time_series(time_series):
+    """Return compact cache payload for the result of
+    Event.time_series."""
+    series = []
+    for key, ts in time_series.items():
+        arrays = EventArrays.from_events(ts.get_events())
+        series.append((key, _pack(arrays)))
+    return (PAYLOAD_VERSION, series)
+
+
+def decode_time_series(payload):
+    """Return dict {key: EventArrays} for payload, or None if the
+    payload is not a (current) compact payload."""
+    series = _unversioned(payload)
+    if series is None:
+        return None
+    return dict((key, _unpack(packed)) for key, packed in series)
+
+
+def payload_size(obj):
+    """Return size in bytes of obj pickled like the django cache
+    does."""
+    return len(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
@@ -2,11 +2,14 @@
 import datetime
 import iso8601
 import csv
+import tempfile
 import xlwt as excel
 from StringIO import StringIO
 
+from django.core.servers.basehttp import FileWrapper
 from django.core.urlresolvers import reverse
 from django.http import HttpResponse
+from django.http import HttpResponseBadRequest
 from django.http import HttpResponseRedirect
 from django.http import Http404
 
@@ -16,10 +19,119 @@ from lizard_map.views import DateRangeMixin
 from lizard_ui.views import ViewContextMixin
 from django.views.generic.base import TemplateView
 
+from lizard_workspace import collagestats
+from lizard_workspace import partials
 from lizard_workspace.models import LayerCollage
 from lizard_workspace.models import LayerCollageItem
 
 
+# Size of the chunks in which xls exports are sent.
+XLS_CHUNK_SIZE = 64 * 1024
+
+# Column names of the collage exports, see CollageView.stats_row.
+COLLAGE_HEADER = [
+    'locatie', 'aantal waardes',
+    'min', 'datum min',
+    'max', 'datum max',
+    'gem',
+    'som',
+    'grenswaarde', 'aantal <= grenswaarde', 'aantal > grenswaarde',
+    'percentiel mediaan', 'percentiel 90',
+    'percentiel gebruiker', 'percentiel instelling']
+
+
+class XLSWriter(object):
+    """csv.writer like interface for a xlwt worksheet."""
+    def __init__(self, ws):
+        self.ws = ws
+        self.row_nr = 0
+
+    def writerow(self, row):
+        for col_nr, item in enumerate(row):
+            self.ws.write(self.row_nr, col_nr, str(item))
+        self.row_nr += 1
+
+
+def save_xls(rows, sheet_name='collage'):
+    """Write rows to a single sheet workbook in a temporary file.
+
+    Return the file, positioned at the start, and its size.
+    """
+    wb = excel.Workbook()
+    writer = XLSWriter(wb.add_sheet(sheet_name))
+    for row in rows:
+        writer.writerow(row)
+    xls = tempfile.TemporaryFile()
+    wb.save(xls)
+    del wb
+    size = xls.tell()
+    xls.seek(0)
+    return xls, size
+
+
+class CollageContext(object):
+    """
+    A collage with its items, loaded once per request.
+
+    The items are fetched with their layers in one query and share the
+    collage object, so the view, the template and the exports use the
+    same item objects (with their parsed identifiers) and the same
+    stats.
+    """
+    def __init__(self, collage):
+        self.collage = collage
+        self._items = None
+        self._stats = {}
+
+    @classmethod
+    def load(cls, secret_slug):
+        """Return CollageContext for secret_slug, raise Http404 if
+        there is no such collage."""
+        try:
+            collage = LayerCollage.objects.get(secret_slug=secret_slug)
+        except LayerCollage.DoesNotExist:
+            raise Http404
+        return cls(collage)
+
+    def items(self):
+        """Return list of the collage items."""
+        if self._items is None:
+            self._items = list(
+                self.collage.layercollageitem_set.select_related(
+                    'layer', 'layer__server'))
+            for collage_item in self._items:
+                collage_item.layer_collage = self.collage
+            collagestats.mark_accessed(self._items)
+        return self._items
+
+    def stats(self, start, end):
+        """Return info_stats of the items, see
+        collagestats.collage_stats. Items that take longer than the
+        budgets are pending placeholders."""
+        if (start, end) not in self._stats:
+            self._stats[(start, end)] = collagestats.collage_stats(
+                self.items(), start=start, end=end,
+                item_budget=collagestats.ITEM_BUDGET,
+                request_budget=collagestats.REQUEST_BUDGET)
+        return self._stats[(start, end)]
+
+    def iter_stats(self, start, end):
+        """Like stats, but yield the info_stats of each item as soon as
+        it is ready."""
+        if (start, end) in self._stats:
+            for item_stats in self._stats[(start, end)]:
+                yield item_stats
+            return
+        result = []
+        for item_stats in collagestats.iter_collage_stats(
+            self.items(), start=start, end=end,
+            item_budget=collagestats.ITEM_BUDGET,
+            request_budget=collagestats.REQUEST_BUDGET):
+            result.append(item_stats)
+            yield item_stats
+        self._stats[(start, end)] = result
+
+
 class CollageView(DateRangeMixin, ViewContextMixin, TemplateView):
     template_name = 'lizard_workspace/collage.html'
 
@@ -28,132 +140,148 @@ class CollageView(DateRangeMixin, ViewContextMixin, TemplateView):
             self.request, for_form=True)
         return '&dt_start=%(dt_start)s&dt_end=%(dt_end)s' % date_range
 
+    def collage_context(self):
+        """Return CollageContext of this request"""
+        if not hasattr(self, '_collage_context'):
+            self._collage_context = CollageContext.load(self.collage_slug)
+        return self._collage_context
+
     def collage(self):
         """Return collage"""
-        if not hasattr(self, '_collage'):
-            if self.collage_slug:
-                self._collage = LayerCollage.objects.get(
-                    secret_slug=self.collage_slug)
-            else:
-                self._collage = None
-        return self._collage
+        return self.collage_context().collage
+
+    def collage_items(self):
+        """Return collage items"""
+        return self.collage_context().items()
 
     def collage_stats(self):
         """Info of individual collage items"""
-        result = []
-        start = self.date_start_period()
-        end = self.date_end_period()
-        for collage_item in self.collage().layercollageitem_set.all():
-            stats = collage_item.info_stats(start=start, end=end)
-            stats['id'] = collage_item.id
-            result.append(stats)
-        return result
+        return self.collage_context().stats(
+            start=self.date_start_period(),
+            end=self.date_end_period())
+
+    def write_collage_rows(self, writer, split=None):
+        """
+        Write collage_rows to a csv.writer like writer.
+        """
+        for row in self.collage_rows(split=split):
+            writer.writerow(row)
 
-    def write_collage_rows(self, writer):
+    def collage_rows(self, split=None):
         """
-        Common function used by csv_response and xls_response
+        Yield the rows of write_collage_rows. The header rows come
+        first, then a row per collage item as soon as its stats are
+        ready.
+
+        With split ('year', 'season' or 'month', see
+        partials.SPLITS) the table is in long format: a row per
+        collage item and sub-period of the period, all computed from
+        one fetch per item.
+
+        Rows of items that failed or are not ready yet get their status
+        in an extra column, see stats_row.
         """
         collage = self.collage()
         date_range = current_start_end_dates(
             self.request, for_form=True)
-        writer.writerow(['naam', collage.name])
-        writer.writerow(['periode', date_range['dt_start'], date_range['dt_end']])
-        writer.writerow(['zomer of winter', LayerCollage.SUMMER_WINTER_DICT[collage.summer_or_winter]])
-        writer.writerow(['dag of nacht', LayerCollage.DAY_NIGHT_DICT[collage.summer_or_winter]])
-        writer.writerow(['maand', collage.display_month()])
-        writer.writerow(['dag van de week', collage.display_day()])
-
-        writer.writerow([
-                'locatie', 'aantal waardes',
-                'min', 'datum min',
-                'max', 'datum max',
-                'gem',
-                'som',
-                'grenswaarde', 'aantal <= grenswaarde', 'aantal > grenswaarde',
-                'percentiel mediaan', 'percentiel 90',
-                'percentiel gebruiker', 'percentiel instelling'])
-
-        for stats in self.collage_stats():
-            writer.writerow([
-                    stats['name'], stats['item_count'],
-                    stats['standard']['min'][1][0], stats['standard']['min'][0],
-                    stats['standard']['max'][1][0], stats['standard']['max'][0],
-                    stats['standard']['avg'],
-                    stats['standard']['sum'],
-                    stats['boundary']['value'],
-                    stats['boundary']['amount_less_equal'],
-                    stats['boundary']['amount_greater'],
-                    stats['percentile']['median'],
-                    stats['percentile']['90'],
-                    stats['percentile']['user'],
-                    stats['percentile']['value'],
-                    ])
-
-    def csv_response(self):
+        yield ['naam', collage.name]
+        yield ['periode', date_range['dt_start'], date_range['dt_end']]
+        yield ['zomer of winter', LayerCollage.SUMMER_WINTER_DICT[collage.summer_or_winter]]
+        yield ['dag of nacht', LayerCollage.DAY_NIGHT_DICT[collage.summer_or_winter]]
+        yield ['maand', collage.display_month()]
+        yield ['dag van de week', collage.display_day()]
+        if split:
+            yield ['opsplitsing', split]
+
+        header = list(COLLAGE_HEADER)
+        if split:
+            header.insert(1, 'periode')
+        yield header
+
+        if split:
+            for item_stats in collagestats.iter_split_stats(
+                self.collage_items(), start=self.date_start_period(),
+                end=self.date_end_period(), split=split):
+                for stats in item_stats:
+                    row = self.stats_row(stats)
+                    row.insert(1, stats['period'])
+                    yield row
+            return
+
+        for stats in self.collage_context().iter_stats(
+            start=self.date_start_period(),
+            end=self.date_end_period()):
+            yield self.stats_row(stats)
+
+    def stats_status(self, stats):
+        """Return the status column of info_stats: empty, or why the
+        numbers are missing, like the html page shows."""
+        if stats.get('error'):
+            return 'fout bij berekenen'
+        if stats.get('pending'):
+            return 'wordt berekend, download later opnieuw'
+        return ''
+
+    def stats_row(self, stats):
+        """Return the collage_rows row of info_stats, with
+        stats_status as the last column if there is one."""
+        # min and max are events (datetime, (value, flag,
+        # comment)), or None if there are no numbers.
+        stats_min = stats['standard']['min'] or (None, (None, ))
+        stats_max = stats['standard']['max'] or (None, (None, ))
+        row = [
+                stats['name'], stats['item_count'],
+                stats_min[1][0], stats_min[0],
+                stats_max[1][0], stats_max[0],
+                stats['standard']['avg'],
+                stats['standard']['sum'],
+                stats['boundary']['value'],
+                stats['boundary']['amount_less_equal'],
+                stats['boundary']['amount_greater'],
+                stats['percentile']['median'],
+                stats['percentile']['90'],
+                stats['percentile']['user'],
+                stats['percentile']['value'],
+                ]
+        status = self.stats_status(stats)
+        if status:
+            row.append(status)
+        return row
+
+    def csv_response(self, split=None):
         """
         Return common collage information and stats of collage items.
+
+        The csv is streamed: the header rows are sent straight away,
+        the row of each item as soon as its stats are ready.
         """
-        response = HttpResponse(mimetype='text/csv')
+        response = HttpResponse(
+            self.csv_lines(split=split), mimetype='text/csv')
         response['Content-Disposition'] = 'attachment; filename=collage.csv'
-
-        writer = csv.writer(response)
-        self.write_collage_rows(writer)
-
         return response
 
-    def xls_response(self):
+    def csv_lines(self, split=None):
+        """Yield collage_rows as csv lines."""
+        line = StringIO()
+        writer = csv.writer(line)
+        for row in self.collage_rows(split=split):
+            writer.writerow(row)
+            yield line.getvalue()
+            line.seek(0)
+            line.truncate()
+
+    def xls_response(self, split=None):
         """
         Return common collage information and stats of collage items in xls.
-        """
-        class XLSWriter():
-            def __init__(self, ws):
-                self.ws = ws
-                self.row_nr = 0
-
-            def writerow(self, row):
-                for col_nr, item in enumerate(row):
-                    self.ws.write(self.row_nr, col_nr, str(item))
-                self.row_nr += 1
 
-        # Set up xls styling (copy-pasted)
-        wb = excel.Workbook()
-        ws = wb.add_sheet('collage')
-        writer = XLSWriter(ws)
-
-        font1 = excel.Formatting.Font()
-        font1.name = 'Arial'
-        font1.height = 200
-        font1.bold = True
-
-        font2 = excel.Formatting.Font()
-        font2.name = 'Arial'
-        font2.height = 160
-
-        borders = excel.Borders()
-        borders.bottom = 10
-
-        st1 = excel.XFStyle()
-        st2 = excel.XFStyle()
-
-        st1.font = font1
-        st2.font = font2
-        st1.borders = borders
-
-        wb.add_style(st1)
-        wb.add_style(st2)
-
-        col_nr = 0
-        row_nr = 0
-
-        self.write_collage_rows(writer)
-
-        xls = StringIO()
-        wb.save(xls)
-        del wb
-        xls.seek(0)
-
-        response = HttpResponse(xls.read(), mimetype='application/xls')
+        The workbook is spooled to a temporary file and streamed from
+        there in chunks, instead of being copied around in memory.
+        """
+        xls, size = save_xls(self.collage_rows(split=split))
+        response = HttpResponse(
+            FileWrapper(xls, XLS_CHUNK_SIZE), mimetype='application/xls')
         response['Content-Disposition'] = 'attachment; filename=collage.xls'
+        response['Content-Length'] = str(size)
         return response
 
     def get(self, request, *args, **kwargs):
@@ -165,10 +293,8 @@ class CollageView(DateRangeMixin, ViewContextMixin, TemplateView):
         ?dt_start=2001-06-15%2015:06:32.118341&dt_end=2012-06-14%2015:06:32.118341
         """
         self.collage_slug = kwargs.get('collage_slug', None)
-        # check collage_slug
-        if LayerCollage.objects.filter(
-            secret_slug=self.collage_slug).count() == 0:
-            raise Http404
+        # check collage_slug, raises Http404
+        self.collage_context()
 
         # date_range: see lizard_map.daterange
         # 5 = last year
@@ -184,12 +310,16 @@ class CollageView(DateRangeMixin, ViewContextMixin, TemplateView):
             return HttpResponseRedirect('./')
 
         response_format = request.GET.get('format', 'html')
+        # Statistics per year, season or month in one table.
+        split = request.GET.get('split', None)
+        if split is not None and split not in partials.SPLITS:
+            return HttpResponseBadRequest('Unknown split %s' % split)
         if response_format == 'csv':
             # Return csv format
-            return self.csv_response()
+            return self.csv_response(split=split)
         if response_format == 'xls':
             # Return xls format
-            return self.xls_response()
+            return self.xls_response(split=split)
         else:
             # Return normal page, 'html'
             return super(CollageView, self).get(request, *args, **kwargs)
@@ -199,7 +329,7 @@ class CollageView(DateRangeMixin, ViewContextMixin, TemplateView):
 
         # collect urls by grouping hint
         grouped_items = {}
-        for collage_item in self.collage().layercollageitem_set.all():
+        for collage_item in self.collage_items():
             grouping_hint = collage_item.grouping_hint
             if grouping_hint not in grouped_items:
                 grouped_items[grouping_hint] = []
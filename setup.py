@@ -21,6 +21,7 @@ install_requires = [
     'lizard-graph >= 0.23',
     'lizard-history',
     'lizard-registration',
+    'numpy',
     'OWSLib',
     ],
 